@@ -0,0 +1,62 @@
+'''
+Benchmark encoding the packets of an image, serially and in a process pool.
+
+::
+
+    python benchmark/encode_frames.py --size 256 --workers 1 2 4 8
+
+Prints the time taken and throughput of :meth:`xmodem.FrameTable.encode`
+for each number of workers, and the speedup over encoding serially in the
+current process, as :meth:`xmodem.XMODEM.send` does.
+'''
+from __future__ import division, print_function
+
+import argparse
+import os
+import time
+
+from xmodem import FrameTable
+
+
+def _time(data, packet_size, crc_mode, integrity, workers):
+    started = time.perf_counter()
+    table = FrameTable.encode(data, packet_size, crc_mode,
+                              integrity=integrity, workers=workers)
+    elapsed = time.perf_counter() - started
+    assert len(table) == -(-len(data) // packet_size)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--size', type=int, default=64,
+                        help='image size in MiB (default: 64)')
+    parser.add_argument('--packet-size', type=int, choices=(128, 1024),
+                        default=1024)
+    parser.add_argument('--checksum', action='store_true',
+                        help='use checksums instead of CRCs')
+    parser.add_argument('--integrity', default=None,
+                        help='integrity backend (default: preferred)')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[1, 2, 4, os.cpu_count() or 1],
+                        help='numbers of worker processes to try')
+    args = parser.parse_args()
+
+    data = os.urandom(args.size * 1024 * 1024)
+    crc_mode = 0 if args.checksum else 1
+    print('{0} MiB, {1} byte packets, {2}, {3} CPUs'.format(
+        args.size, args.packet_size, 'checksum' if args.checksum else 'CRC',
+        os.cpu_count()))
+
+    serial = _time(data, args.packet_size, crc_mode, args.integrity, 0)
+    print('{0:>8} {1:8.3f}s {2:8.1f} MiB/s'.format(
+        'serial', serial, args.size / serial))
+    for workers in sorted(set(args.workers)):
+        elapsed = _time(data, args.packet_size, crc_mode, args.integrity,
+                        workers)
+        print('{0:>8} {1:8.3f}s {2:8.1f} MiB/s {3:6.2f}x'.format(
+            workers, elapsed, args.size / elapsed, serial / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+'''
+Benchmark goodput of YMODEM-g against XMODEM-1k over a pseudo terminal.
+
+::
+
+    python benchmark/ymodem_g.py --size 4 --rounds 3
+
+Sends an image from one end of a raw pty to the other, the sender and the
+receiver running in threads, and prints the best time and goodput (image
+bytes per second) of XMODEM-1k, YMODEM and YMODEM-g. A pty has next to no
+latency, so this shows the cost of waiting for each acknowledgement at its
+lowest; on a serial line or modem the difference is larger.
+'''
+from __future__ import division, print_function
+
+import argparse
+import os
+import select
+import threading
+import time
+import tty
+from io import BytesIO
+
+from xmodem import XMODEM
+from xmodem.ymodem import YMODEM
+
+
+def _port(fd):
+    def getc(size, timeout=1):
+        data = b''
+        deadline = time.monotonic() + timeout
+        while len(data) < size:
+            remaining = deadline - time.monotonic()
+            if not select.select([fd], [], [], max(remaining, 0))[0]:
+                break
+            data += os.read(fd, size - len(data))
+        return data or None
+
+    def putc(data, timeout=1):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        return len(data)
+
+    return getc, putc
+
+
+def _xmodem(sender, receiver, data):
+    target = BytesIO()
+    thread = threading.Thread(
+        target=lambda: XMODEM(*receiver).recv(target, timeout=5))
+    thread.start()
+    XMODEM(*sender, mode='xmodem1k').send(BytesIO(data), timeout=5)
+    thread.join()
+    return target.getvalue()
+
+
+def _ymodem(sender, receiver, data, streaming):
+    target = BytesIO()
+    thread = threading.Thread(
+        target=lambda: YMODEM(*receiver).recv(
+            lambda header: target, timeout=5, streaming=streaming))
+    thread.start()
+    YMODEM(*sender).send([('image', BytesIO(data))], timeout=5)
+    thread.join()
+    return target.getvalue()
+
+
+def _time(transfer, data, rounds):
+    best = None
+    for _ in range(rounds):
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        try:
+            started = time.perf_counter()
+            received = transfer(_port(master), _port(slave), data)
+            elapsed = time.perf_counter() - started
+        finally:
+            os.close(master)
+            os.close(slave)
+        assert received[:len(data)] == data
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--size', type=int, default=4,
+                        help='image size in MiB (default: 4)')
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='transfers per protocol, the best counts')
+    args = parser.parse_args()
+
+    data = os.urandom(args.size * 1024 * 1024)
+    print('{0} MiB over a pty, best of {1}'.format(args.size, args.rounds))
+    baseline = None
+    for name, transfer in (
+            ('xmodem1k', _xmodem),
+            ('ymodem', lambda s, r, d: _ymodem(s, r, d, False)),
+            ('ymodem-g', lambda s, r, d: _ymodem(s, r, d, True))):
+        elapsed = _time(transfer, data, args.rounds)
+        baseline = baseline or elapsed
+        print('{0:>10} {1:8.3f}s {2:10.1f} KiB/s {3:6.2f}x'.format(
+            name, elapsed, len(data) / 1024 / elapsed, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,6 +13,8 @@ def _multi_which(prog_names):
 
 recv_prog = _multi_which(('rb', 'lrb'))
 send_prog = _multi_which(('sb', 'lsb'))
+zrecv_prog = _multi_which(('rz', 'lrz'))
+zsend_prog = _multi_which(('sz', 'lsz'))
 
 CHUNKSIZE = 521
 
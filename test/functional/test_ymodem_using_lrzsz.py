@@ -0,0 +1,67 @@
+"""
+Functional tests for YMODEM batch transfers, using the lrzsz programs.
+"""
+import subprocess
+import functools
+import os
+
+import pytest
+
+from .accessories import recv_prog, send_prog
+from .test_xmodem_using_lrzsz import (
+    MISSING_LRB_MSG,
+    MISSING_LSB_MSG,
+    _proc_getc,
+    _proc_putc,
+)
+from xmodem.ymodem import YMODEM
+
+SIZES = (0, 100, 1024, 5000)
+
+
+def _make_files(directory):
+    paths = []
+    for size in SIZES:
+        path = directory.join('file{0}.bin'.format(size))
+        path.write_binary(bytes(bytearray(n % 251 for n in range(size))))
+        paths.append(str(path))
+    return paths
+
+
+@pytest.mark.skipif(recv_prog is None, reason=MISSING_LRB_MSG)
+def test_ymodem_send_with_lrb(tmpdir):
+    """ Using external program for receive, verify YMODEM.send(). """
+    paths = _make_files(tmpdir.mkdir('source'))
+    target = tmpdir.mkdir('target')
+    proc = subprocess.Popen((recv_prog, '--ymodem', '--verbose'),
+                            cwd=str(target), stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, bufsize=0)
+    getc = functools.partial(_proc_getc, proc=proc)
+    putc = functools.partial(_proc_putc, proc=proc)
+
+    assert YMODEM(getc, putc).send(paths, timeout=5) is True
+    proc.wait()
+    assert proc.returncode == 0
+    for path in paths:
+        copy = target.join(os.path.basename(path))
+        assert copy.read_binary() == open(path, 'rb').read()
+
+
+@pytest.mark.skipif(send_prog is None, reason=MISSING_LSB_MSG)
+def test_ymodem_recv_with_lsb(tmpdir):
+    """ Using external program for send, verify YMODEM.recv(). """
+    paths = _make_files(tmpdir.mkdir('source'))
+    target = tmpdir.mkdir('target')
+    proc = subprocess.Popen((send_prog, '--ymodem', '--verbose') +
+                            tuple(paths), stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, bufsize=0)
+    getc = functools.partial(_proc_getc, proc=proc)
+    putc = functools.partial(_proc_putc, proc=proc)
+
+    received = YMODEM(getc, putc).recv(str(target), timeout=5)
+    proc.wait()
+    assert proc.returncode == 0
+    assert [header.size for header in received] == list(SIZES)
+    for path in paths:
+        copy = target.join(os.path.basename(path))
+        assert copy.read_binary() == open(path, 'rb').read()
@@ -0,0 +1,105 @@
+"""
+Functional tests for ZMODEM transfers, using the lrzsz programs.
+"""
+import subprocess
+import functools
+import os
+import select
+
+import pytest
+
+from .accessories import zrecv_prog, zsend_prog
+from xmodem.transport import BufferedTransport
+from xmodem.zmodem import ZMODEM
+
+MISSING_LRZ_MSG = "'rz' or 'lrz' required. Try installing the 'lrzsz' package"
+MISSING_LSZ_MSG = "'sz' or 'lsz' required. Try installing the 'lrzsz' package"
+
+SIZES = (0, 100, 1024, 5000, 100000)
+
+
+def _proc_getc(size, timeout=1, proc=None):
+    # unlike the XMODEM tests, a timeout is not a failure: the ZMODEM
+    # sender polls for interruptions with a timeout of 0 while streaming
+    ready_read, _, _ = select.select([proc.stdout], [], [], timeout)
+    if proc.stdout not in ready_read:
+        return None
+    return os.read(proc.stdout.fileno(), size) or None
+
+
+def _proc_putc(data, timeout=1, proc=None):
+    proc.stdin.write(data)
+    proc.stdin.flush()
+    return len(data)
+
+
+def _modem(proc):
+    transport = BufferedTransport(functools.partial(_proc_getc, proc=proc),
+                                  functools.partial(_proc_putc, proc=proc))
+    return ZMODEM(transport.getc, transport.putc)
+
+
+def _make_files(directory):
+    paths = []
+    for size in SIZES:
+        path = directory.join('file{0}.bin'.format(size))
+        path.write_binary(bytes(bytearray(n % 251 for n in range(size))))
+        paths.append(str(path))
+    return paths
+
+
+@pytest.mark.skipif(zrecv_prog is None, reason=MISSING_LRZ_MSG)
+def test_zmodem_send_with_lrz(tmpdir):
+    """ Using external program for receive, verify ZMODEM.send(). """
+    paths = _make_files(tmpdir.mkdir('source'))
+    target = tmpdir.mkdir('target')
+    proc = subprocess.Popen((zrecv_prog, '--binary', '--verbose'),
+                            cwd=str(target), stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, bufsize=0)
+
+    assert _modem(proc).send(paths, timeout=5) is True
+    proc.wait()
+    assert proc.returncode == 0
+    for path in paths:
+        copy = target.join(os.path.basename(path))
+        assert copy.read_binary() == open(path, 'rb').read()
+
+
+@pytest.mark.skipif(zrecv_prog is None, reason=MISSING_LRZ_MSG)
+def test_zmodem_send_resume_with_lrz(tmpdir):
+    """ Using external program for receive, verify ZMODEM.send(resume=True)
+    only sends the rest of a partial file. """
+    path = _make_files(tmpdir.mkdir('source'))[-1]
+    target = tmpdir.mkdir('target')
+    data = open(path, 'rb').read()
+    target.join(os.path.basename(path)).write_binary(data[:60000])
+    proc = subprocess.Popen((zrecv_prog, '--binary', '--verbose'),
+                            cwd=str(target), stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, bufsize=0)
+    offsets = []
+
+    assert _modem(proc).send(
+        [path], timeout=5, resume=True,
+        callback=lambda size, offset, errors: offsets.append(offset)) is True
+    proc.wait()
+    assert proc.returncode == 0
+    assert offsets[0] > 60000
+    assert target.join(os.path.basename(path)).read_binary() == data
+
+
+@pytest.mark.skipif(zsend_prog is None, reason=MISSING_LSZ_MSG)
+def test_zmodem_recv_with_lsz(tmpdir):
+    """ Using external program for send, verify ZMODEM.recv(). """
+    paths = _make_files(tmpdir.mkdir('source'))
+    target = tmpdir.mkdir('target')
+    proc = subprocess.Popen((zsend_prog, '--binary', '--verbose') +
+                            tuple(paths), stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, bufsize=0)
+
+    received = _modem(proc).recv(str(target), timeout=5)
+    proc.wait()
+    assert proc.returncode == 0
+    assert [header.size for header in received] == list(SIZES)
+    for path in paths:
+        copy = target.join(os.path.basename(path))
+        assert copy.read_binary() == open(path, 'rb').read()
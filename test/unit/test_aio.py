@@ -0,0 +1,111 @@
+"""
+Unit tests for the asyncio XMODEM driver.
+"""
+# std imports
+from io import BytesIO
+import asyncio
+import socket
+import sys
+
+# local
+from xmodem.aio import AsyncXMODEM
+
+# 3rd-party
+import pytest
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 7),
+                                reason='xmodem.aio requires Python 3.7')
+
+
+async def _open_socketpair():
+    sock_a, sock_b = socket.socketpair()
+    reader_a, writer_a = await asyncio.open_connection(sock=sock_a)
+    reader_b, writer_b = await asyncio.open_connection(sock=sock_b)
+    return (reader_a, writer_a), (reader_b, writer_b)
+
+
+async def _transfer(payload, mode, crc_mode):
+    (reader_a, writer_a), (reader_b, writer_b) = await _open_socketpair()
+    sender = AsyncXMODEM.from_streams(reader_a, writer_a, mode=mode)
+    receiver = AsyncXMODEM.from_streams(reader_b, writer_b)
+    destination = BytesIO()
+    try:
+        return (await asyncio.gather(
+            sender.send(BytesIO(payload), timeout=5),
+            receiver.recv(destination, crc_mode=crc_mode, timeout=5)
+        )) + [destination.getvalue()]
+    finally:
+        writer_a.close()
+        writer_b.close()
+
+
+@pytest.mark.parametrize('mode,packet_size', [('xmodem', 128),
+                                              ('xmodem1k', 1024)])
+@pytest.mark.parametrize('crc_mode', [0, 1])
+def test_async_xmodem_socketpair(mode, packet_size, crc_mode):
+    """Verify an AsyncXMODEM send and recv over a socket pair."""
+    payload = bytes(bytearray(n % 251 for n in range(5000)))
+
+    sent, received, data = asyncio.run(_transfer(payload, mode, crc_mode))
+
+    padded_size = -(-len(payload) // packet_size) * packet_size
+    assert sent is True
+    assert received == padded_size
+    assert data == payload.ljust(padded_size, b'\x1a')
+
+
+def test_async_xmodem_concurrent_transfers():
+    """Verify many transfers run concurrently in one event loop."""
+    payloads = [bytes([n]) * (300 + n) for n in range(1, 33)]
+
+    async def run_all():
+        return await asyncio.gather(*[
+            _transfer(payload, 'xmodem', 1) for payload in payloads])
+
+    for payload, (sent, received, data) in zip(payloads,
+                                                asyncio.run(run_all())):
+        assert sent is True
+        assert received == len(data)
+        assert data == payload.ljust(len(data), b'\x1a')
+
+
+def test_async_xmodem_recv_timeout_callables():
+    """Verify recv() with async callables gives up after its retries."""
+    sent = []
+
+    async def getc(size, timeout=1):
+        return None
+
+    async def putc(data, timeout=1):
+        sent.append(bytes(data))
+        return len(data)
+
+    modem = AsyncXMODEM(getc, putc)
+
+    assert asyncio.run(modem.recv(BytesIO(), retry=4)) is None
+    assert sent[-2:] == [b'\x18', b'\x18']
+    assert sent[:2] == [b'C', b'C']
+    assert sent[2:4] == [b'\x15', b'\x15']
+
+
+def test_async_xmodem_recv_fragmented_block():
+    """Verify recv() reads the rest of a block arriving in fragments."""
+    data = b'\xaa' * 128
+    crc = AsyncXMODEM(None, None).integrity.crc(data)
+    block = b'\x01\xfe' + data + bytes([crc >> 8, crc & 0xff])
+    replies = [b'\x01', block[:60], block[60:], b'\x04']
+    sent = []
+
+    async def getc(size, timeout=1):
+        return replies.pop(0) if replies else None
+
+    async def putc(data, timeout=1):
+        sent.append(bytes(data))
+        return len(data)
+
+    destination = BytesIO()
+    modem = AsyncXMODEM(getc, putc)
+
+    assert asyncio.run(modem.recv(destination)) == 128
+    assert destination.getvalue() == data
+    assert sent == [b'C', b'\x06', b'\x06']
@@ -0,0 +1,110 @@
+"""
+Unit tests for the persistent frame cache.
+"""
+# std imports
+from concurrent.futures import ProcessPoolExecutor
+import os
+import time
+
+# local
+from xmodem import FrameSet, FrameTable
+from xmodem.cache import FrameCache
+
+# 3rd-party
+import pytest
+
+
+PAYLOAD = bytes(bytearray(n % 251 for n in range(5000)))
+
+
+def _cached_files(directory):
+    return sorted(name for name in os.listdir(str(directory))
+                  if name.endswith('.frames'))
+
+
+@pytest.mark.parametrize('packet_size,crc_mode', [(128, 0), (1024, 1)])
+def test_frame_cache_miss_then_hit(tmpdir, packet_size, crc_mode):
+    """Verify a cached table is mapped from disk by a later cache."""
+    expected = FrameTable.encode(PAYLOAD, packet_size, crc_mode)
+    cache = FrameCache(str(tmpdir))
+    assert bytes(cache.table(PAYLOAD, packet_size, crc_mode)._data) == (
+        bytes(expected._data))
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    cache = FrameCache(str(tmpdir))
+    table = cache.table(PAYLOAD, packet_size, crc_mode)
+    assert (cache.hits, cache.misses) == (1, 0)
+    assert len(table) == len(expected)
+    assert table.size == len(PAYLOAD)
+    assert [bytes(frame) for frame in table] == (
+        [bytes(frame) for frame in expected])
+
+
+def test_frame_cache_key(tmpdir):
+    """Verify the packet size, checksum type and padding are in the key."""
+    cache = FrameCache(str(tmpdir))
+    cache.table(PAYLOAD, 128, 1)
+    cache.table(PAYLOAD, 1024, 1)
+    cache.table(PAYLOAD, 128, 0)
+    cache.table(PAYLOAD, 128, 1, pad=b'\xff')
+    cache.table(PAYLOAD[:-1], 128, 1)
+    assert cache.misses == 5
+    assert len(_cached_files(tmpdir)) == 5
+
+
+def test_frame_cache_eviction(tmpdir):
+    """Verify the least recently used files are evicted over max_size."""
+    cache = FrameCache(str(tmpdir), max_size=12000)
+    images = [bytes([n]) * 5000 for n in range(3)]
+    for image in images[:2]:
+        cache.table(image, 128, 1)
+    old = time.time() - 60
+    for name in _cached_files(tmpdir):
+        os.utime(str(tmpdir.join(name)), (old, old))
+    # a hit marks the first image as recently used
+    cache.table(images[0], 128, 1)
+    cache.table(images[2], 128, 1)
+    assert len(_cached_files(tmpdir)) == 2
+
+    cache.table(images[0], 128, 1)
+    cache.table(images[1], 128, 1)
+    assert (cache.hits, cache.misses) == (2, 4)
+
+
+def test_frame_cache_corrupt_file(tmpdir):
+    """Verify a corrupt file is replaced instead of used."""
+    cache = FrameCache(str(tmpdir))
+    cache.table(PAYLOAD, 128, 1)
+    path = str(tmpdir.join(_cached_files(tmpdir)[0]))
+    with open(path, 'r+b') as stream:
+        stream.truncate(100)
+
+    table = cache.table(PAYLOAD, 128, 1)
+    assert cache.misses == 2
+    assert len(table) == 40
+    assert os.path.getsize(path) == 16 + 40 * 133
+
+
+def test_frame_set_cache(tmpdir):
+    """Verify a frame set looks up its tables in the cache."""
+    cache = FrameCache(str(tmpdir))
+    FrameSet(PAYLOAD, cache=cache).table(128, 1)
+    frames = FrameSet(PAYLOAD, cache=cache)
+    assert len(frames.table(128, 1)) == 40
+    assert frames.table(128, 1) is frames.table(128, 1)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def _encode_cached(directory):
+    table = FrameCache(directory, max_size=10 ** 6).table(PAYLOAD, 128, 1)
+    return bytes(table._data)
+
+
+def test_frame_cache_concurrent_processes(tmpdir):
+    """Verify processes sharing a cache all get the same table."""
+    with ProcessPoolExecutor(4) as executor:
+        results = list(executor.map(_encode_cached, [str(tmpdir)] * 8))
+    assert set(results) == {bytes(FrameTable.encode(PAYLOAD, 128, 1)._data)}
+    assert len(_cached_files(tmpdir)) == 1
+    assert not [name for name in os.listdir(str(tmpdir))
+                if name.endswith('.tmp')]
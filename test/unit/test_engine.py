@@ -0,0 +1,167 @@
+"""
+Unit tests for the selector based XMODEM engine.
+"""
+# std imports
+from io import BytesIO
+import os
+import socket
+import tty
+
+# local
+from xmodem import CAN
+from xmodem import FrameSet
+from xmodem.engine import Engine, broadcast
+
+# 3rd-party
+import pytest
+
+
+def _padded(payload, packet_size):
+    size = -(-len(payload) // packet_size) * packet_size
+    return payload.ljust(size, b'\x1a')
+
+
+@pytest.mark.parametrize('mode,packet_size', [('xmodem', 128),
+                                              ('xmodem1k', 1024)])
+@pytest.mark.parametrize('crc_mode', [0, 1])
+def test_engine_socketpair(mode, packet_size, crc_mode):
+    """Verify both ends of a transfer run in one engine."""
+    payload = bytes(bytearray(n % 251 for n in range(5000)))
+    sock_a, sock_b = socket.socketpair()
+    destination = BytesIO()
+    engine = Engine()
+    try:
+        sender = engine.submit_send(sock_a, BytesIO(payload), mode=mode,
+                                    timeout=5)
+        receiver = engine.submit_recv(sock_b, destination, crc_mode=crc_mode,
+                                      timeout=5)
+        assert engine.run(timeout=30)
+    finally:
+        sock_a.close()
+        sock_b.close()
+
+    assert sender.result() is True
+    assert receiver.result() == len(_padded(payload, packet_size))
+    assert destination.getvalue() == _padded(payload, packet_size)
+
+
+def test_engine_many_sessions():
+    """Verify many concurrent transfers and the aggregate statistics."""
+    engine = Engine()
+    sockets, transfers = [], []
+    for n in range(1, 33):
+        payload = bytes([n]) * (300 + 7 * n)
+        sock_a, sock_b = socket.socketpair()
+        sockets.extend((sock_a, sock_b))
+        destination = BytesIO()
+        transfers.append((
+            payload, destination,
+            engine.submit_send(sock_a, BytesIO(payload), timeout=5),
+            engine.submit_recv(sock_b, destination, timeout=5)))
+    try:
+        assert engine.run(timeout=60)
+    finally:
+        for sock in sockets:
+            sock.close()
+
+    for payload, destination, sender, receiver in transfers:
+        assert sender.result() is True
+        assert destination.getvalue() == _padded(payload, 128)
+    stats = engine.stats()
+    assert stats.transfers == 64
+    assert stats.active == 0
+    assert stats.bytes_sent == stats.bytes_received > 0
+    assert stats.throughput > 0
+
+
+def test_engine_pty():
+    """Verify a transfer over a pseudo terminal."""
+    payload = b'pseudo terminal ' * 100
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    destination = BytesIO()
+    engine = Engine()
+    try:
+        sender = engine.submit_send(master, BytesIO(payload), timeout=5)
+        receiver = engine.submit_recv(slave, destination, timeout=5)
+        assert receiver.result(timeout=30) == len(_padded(payload, 128))
+        assert sender.result(timeout=30) is True
+    finally:
+        os.close(master)
+        os.close(slave)
+
+    assert destination.getvalue() == _padded(payload, 128)
+
+
+def test_engine_cancel():
+    """Verify a cancelled transfer sends the abort sequence to the peer."""
+    sock_a, sock_b = socket.socketpair()
+    engine = Engine()
+    try:
+        transfer = engine.submit_recv(sock_a, BytesIO(), timeout=5)
+        assert not engine.run(timeout=0.1)
+        assert not os.get_blocking(sock_a.fileno())
+        with pytest.raises(TimeoutError):
+            transfer.result(timeout=0.1)
+        transfer.cancel()
+        assert transfer.done()
+        assert transfer.cancelled
+        assert transfer.result() is None
+        # the descriptor is left as it was found
+        assert os.get_blocking(sock_a.fileno())
+        assert sock_b.recv(64).endswith(CAN + CAN)
+    finally:
+        sock_a.close()
+        sock_b.close()
+
+
+def test_engine_peer_closed():
+    """Verify a transfer fails when the peer closes the connection."""
+    sock_a, sock_b = socket.socketpair()
+    engine = Engine()
+    try:
+        transfer = engine.submit_send(sock_a, BytesIO(b'data'), timeout=5)
+        sock_b.close()
+        assert transfer.result(timeout=5) is False
+        assert transfer.error is not None
+    finally:
+        sock_a.close()
+
+
+def test_engine_one_transfer_per_descriptor():
+    """Verify a descriptor runs one transfer at a time."""
+    sock_a, sock_b = socket.socketpair()
+    engine = Engine()
+    try:
+        engine.submit_send(sock_a, BytesIO(b'data'))
+        with pytest.raises(ValueError):
+            engine.submit_recv(sock_a.fileno(), BytesIO())
+    finally:
+        sock_a.close()
+        sock_b.close()
+
+
+def test_broadcast():
+    """Verify one image is sent to many devices, each choosing its mode."""
+    payload = bytes(bytearray(n % 251 for n in range(3000)))
+    frames = FrameSet(payload)
+    engine = Engine()
+    sockets, receivers = [], []
+    for n in range(8):
+        sock_a, sock_b = socket.socketpair()
+        sockets.extend((sock_a, sock_b))
+        destination = BytesIO()
+        receivers.append((destination, engine.submit_recv(
+            sock_b, destination, crc_mode=n % 2, timeout=5)))
+    try:
+        results = broadcast(sockets[::2], frames, timeout=5, engine=engine)
+        engine.run(timeout=10)
+    finally:
+        for sock in sockets:
+            sock.close()
+
+    assert results == [True] * 8
+    assert sorted(frames.tables) == [(128, 0), (128, 1)]
+    for destination, receiver in receivers:
+        assert receiver.result() == len(_padded(payload, 128))
+        assert destination.getvalue() == _padded(payload, 128)
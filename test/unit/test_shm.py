@@ -0,0 +1,95 @@
+"""
+Unit tests for the shared memory frame store.
+"""
+# std imports
+import multiprocessing
+
+# local
+from xmodem import ACK, CRC, XMODEM, FrameSet
+
+# 3rd-party
+import pytest
+
+shm = pytest.importorskip('xmodem.shm')
+
+PAYLOAD = bytes(bytearray(n % 251 for n in range(3000)))
+
+
+def _segment_exists(name):
+    try:
+        segment = shm._attach_segment(name)
+    except FileNotFoundError:
+        return False
+    segment.close()
+    return True
+
+
+def _send(frames):
+    sent = []
+
+    def getc(size, timeout=1):
+        return CRC if not sent else ACK
+
+    def putc(data, timeout=1):
+        sent.append(bytes(data))
+        return len(data)
+
+    assert XMODEM(getc, putc).send(frames)
+    return b''.join(sent)
+
+
+def test_shared_frames_creator():
+    """Verify the creator can send from the segment, and removes it."""
+    frames = FrameSet(PAYLOAD)
+    shared = shm.SharedFrames([frames.table(128, 0), frames.table(128, 1)])
+    try:
+        attached = shared.attach()
+        assert shared.attach() is attached
+        assert shared.references == 1
+        assert sorted(attached.tables) == [(128, 0), (128, 1)]
+        assert _send(attached) == _send(frames)
+        with pytest.raises(ValueError):
+            attached.table(1024, 1)
+    finally:
+        shared.close()
+    shared.close()
+    assert not _segment_exists(shared.name)
+
+
+def _worker(shared, attached, release, results):
+    frames = shared.attach()
+    attached.set()
+    release.wait(10)
+    try:
+        results.put(_send(frames))
+    finally:
+        shared.close()
+
+
+@pytest.mark.parametrize('method', ['fork', 'spawn'])
+def test_shared_frames_workers(method):
+    """Verify workers send from the segment and the last one removes it."""
+    context = multiprocessing.get_context(method)
+    frames = FrameSet(PAYLOAD)
+    expected = _send(frames)
+    shared = shm.SharedFrames([frames.table(128, 1)], context=context)
+    release, results = context.Event(), context.Queue()
+    workers = []
+    for _ in range(3):
+        attached = context.Event()
+        worker = context.Process(target=_worker,
+                                 args=(shared, attached, release, results))
+        worker.start()
+        assert attached.wait(30)
+        workers.append(worker)
+
+    assert shared.references == 4
+    # the creator lets go first, the workers keep the segment alive
+    shared.close()
+    assert _segment_exists(shared.name)
+    release.set()
+    assert [results.get(timeout=30) for _ in workers] == [expected] * 3
+    for worker in workers:
+        worker.join(30)
+        assert worker.exitcode == 0
+    assert not _segment_exists(shared.name)
@@ -0,0 +1,141 @@
+"""
+Unit tests for the transport adapters.
+"""
+# std imports
+from io import BytesIO
+import time
+
+# local
+from xmodem import XMODEM, BufferedTransport, SOH, EOT, ACK, NAK
+
+
+class MockLine(object):
+    """A raw getc that returns whatever arrived, in the given chunks."""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.calls = []
+
+    def getc(self, size, timeout=1):
+        self.calls.append((size, timeout))
+        if not self.chunks:
+            return None
+        chunk = self.chunks.pop(0)
+        if chunk is None:
+            return None
+        if len(chunk) > size:
+            # the rest stays pending on the line
+            self.chunks.insert(0, chunk[size:])
+        return chunk[:size]
+
+    def putc(self, data, timeout=1):
+        return len(data)
+
+
+def test_buffered_transport_serves_small_reads_from_buffer():
+    """Verify single byte reads are served from one bulk read."""
+    line = MockLine([b'\x06\x15CC'])
+    transport = BufferedTransport(line.getc, line.putc)
+
+    assert transport.getc(1) == ACK
+    assert transport.getc(1) == NAK
+    assert transport.getc(2, 0) == b'CC'
+    assert transport.getc(1, 0) is None
+
+    assert line.calls[0] == (4096, 1)
+    assert transport.reads == 4
+    assert transport.raw_reads == 2
+    assert transport.saved == 2
+
+
+def test_buffered_transport_accumulates_fragments():
+    """Verify a read waits for more fragments until it has enough bytes."""
+    line = MockLine([b'abc', b'defg', b'hij'])
+    transport = BufferedTransport(line.getc, line.putc)
+
+    assert transport.getc(5) == b'abcde'
+    assert transport.buffered == 2
+    assert transport.getc(4) == b'fghi'
+    assert transport.getc(4) == b'j'
+    assert transport.getc(1) is None
+
+
+def test_buffered_transport_getc_into():
+    """Verify getc_into() copies buffered bytes into the given buffer."""
+    line = MockLine([b'0123456789'])
+    transport = BufferedTransport(line.getc, line.putc)
+    buffer = bytearray(4)
+
+    assert transport.getc_into(memoryview(buffer)) == 4
+    assert buffer == b'0123'
+    assert transport.getc_into(memoryview(buffer)[:3]) == 3
+    assert buffer == b'4563'
+    assert transport.getc(10) == b'789'
+    assert transport.getc_into(memoryview(buffer)) is None
+
+
+def test_buffered_transport_timeout():
+    """Verify the remaining time is passed down while waiting."""
+    line = MockLine([b'a'])
+    transport = BufferedTransport(line.getc, line.putc, size=16)
+
+    assert transport.getc(2, timeout=5) == b'a'
+    assert line.calls[0] == (16, 5)
+    assert 0 < line.calls[1][1] <= 5
+
+
+def test_buffered_transport_with_xmodem_recv(monkeypatch):
+    """Verify recv() through the adapter saves raw reads."""
+    monkeypatch.setattr(time, 'sleep', lambda t: None)
+    modem = XMODEM(getc=None, putc=None)
+
+    def block(sequence, data):
+        crc = modem.calc_crc(data)
+        return (SOH + bytes([sequence, 0xff - sequence]) + data +
+                bytes([crc >> 8, crc & 0xff]))
+
+    # the sender's blocks arrive in bursts, each with the next header
+    line = MockLine([block(1, b'a' * 128) + block(2, b'b' * 128)[:1],
+                     block(2, b'b' * 128)[1:] + EOT])
+    transport = BufferedTransport(line.getc, line.putc)
+    modem = XMODEM(transport.getc, transport.putc,
+                   getc_into=transport.getc_into)
+
+    destination = BytesIO()
+    assert modem.recv(destination) == 256
+    assert destination.getvalue() == b'a' * 128 + b'b' * 128
+    assert transport.raw_reads == 2
+    assert transport.saved == 3
+
+
+def test_buffered_transport_flush_input():
+    """Verify flush_input() discards input until the line is quiet."""
+    line = MockLine([b'abcdef', b'ghi', None, b'jk'])
+    transport = BufferedTransport(line.getc, line.putc)
+
+    assert transport.getc(1) == b'a'
+    assert transport.flush_input(0.02) == 8
+    assert line.calls[1:] == [(4096, 0.02), (4096, 0.02)]
+    assert transport.getc(2) == b'jk'
+
+
+def test_buffered_transport_flush_input_with_xmodem_recv():
+    """Verify recv() flushes the input of a bad block before the NAK."""
+    modem = XMODEM(getc=None, putc=None)
+    data = b'a' * 128
+    crc = modem.calc_crc(data)
+    block = (SOH + b'\x01\xfe' + data + bytes([crc >> 8, crc & 0xff]))
+    bad = block[:10] + b'b' + block[11:]
+
+    line = MockLine([bad + b'noise', b'more noise', None, block + EOT])
+    sent = []
+    transport = BufferedTransport(line.getc, lambda data, timeout=1:
+                                  sent.append(data) or len(data))
+    modem = XMODEM(transport.getc, transport.putc,
+                   flush_input=transport.flush_input)
+
+    destination = BytesIO()
+    assert modem.recv(destination, purge_timeout=0.02) == 128
+    assert destination.getvalue() == data
+    assert sent == [b'C', NAK, ACK, ACK]
+    assert (4096, 0.02) in line.calls
@@ -10,9 +10,32 @@ except ImportError:
     from StringIO import StringIO as BytesIO
 import time
 import logging
+import mmap
+import os
 
 # local
 from xmodem import NAK, CRC, ACK, XMODEM, STX, SOH, EOT, CAN
+from xmodem import (
+    FrameSet,
+    FrameTable,
+    INTEGRITY_BACKENDS,
+    IntegrityBackend,
+    verify_integrity_backends,
+)
+from xmodem import (
+    XMODEMSender,
+    XMODEMReceiver,
+    SendData,
+    NeedData,
+    NeedFrame,
+    Purge,
+    BlockReceived,
+    EndOfTransmission,
+    Progress,
+    Done,
+    RTTEstimator,
+)
+import xmodem
 
 # 3rd-party
 import pytest
@@ -427,6 +450,47 @@ def test_xmodem_recv_bad_sequence_number(monkeypatch):
     assert result == 128
 
 
+def test_xmodem_recv_duplicate_block(monkeypatch):
+    """Verify recv() acknowledges and discards a block sent again after its
+    ACK was lost, without a purge or NAK."""
+    monkeypatch.setattr(time, 'sleep', lambda t: None)
+
+    def getc_generator():
+        yield SOH
+        yield _make_block(1, 128, data=b'\xaa' * 128, crc_mode=1)
+        # block 1 again
+        yield SOH
+        yield _make_block(1, 128, data=b'\xaa' * 128, crc_mode=1)
+        yield SOH
+        yield _make_block(2, 128, data=b'\xbb' * 128, crc_mode=1)
+        yield EOT
+
+    mock = getc_generator()
+    sent = []
+    progress = []
+
+    def mock_getc(size, timeout=1):
+        return next(mock)
+
+    def mock_putc(data, timeout=1):
+        sent.append(data)
+        return len(data)
+
+    xmodem = XMODEM(getc=mock_getc, putc=mock_putc)
+
+    # exercise
+    destination = BytesIO()
+    result = xmodem.recv(stream=destination, retry=16, stats=True,
+                         callback=lambda *args: progress.append(args))
+
+    # verify
+    assert result == 256
+    assert destination.getvalue() == b'\xaa' * 128 + b'\xbb' * 128
+    assert sent == [CRC, ACK, ACK, ACK, ACK]
+    assert progress[-1][4].duplicate_count == 1
+    assert all(args[2] == 0 for args in progress)
+
+
 def test_xmodem_recv_bad_sequence_complement(monkeypatch):
     """Verify recv() rejects blocks where seq2 != 0xff - seq1."""
     monkeypatch.setattr(time, 'sleep', lambda t: None)
@@ -520,6 +584,9 @@ def test_xmodem_recv_short_block(monkeypatch):
         # short block (badly sized)
         yield short_data
 
+        # the rest never arrives
+        yield None
+
         # purge -> timeout
         yield None
 
@@ -545,6 +612,65 @@ def test_xmodem_recv_short_block(monkeypatch):
     assert result == 128
 
 
+def test_xmodem_recv_fragmented_block(monkeypatch):
+    """Verify recv() reads the rest of a block arriving in fragments."""
+    monkeypatch.setattr(time, 'sleep', lambda t: None)
+    block = _make_block(1, 128, data=b'\xaa' * 128, crc_mode=1)
+
+    def getc_generator():
+        yield SOH
+        yield block[:50]
+        yield block[50:51]
+        yield block[51:]
+        yield EOT
+
+    mock = getc_generator()
+    sizes = []
+    sent = []
+    progress = []
+
+    def mock_getc(size, timeout=1):
+        sizes.append(size)
+        return next(mock)
+
+    def mock_putc(data, timeout=1):
+        sent.append(data)
+        return len(data)
+
+    xmodem = XMODEM(getc=mock_getc, putc=mock_putc)
+
+    # exercise
+    destination = BytesIO()
+    result = xmodem.recv(stream=destination, retry=16, stats=True,
+                         callback=lambda *args: progress.append(args))
+
+    # verify: no NAK, and the rest of the block was asked for
+    assert result == 128
+    assert destination.getvalue() == b'\xaa' * 128
+    assert sent == [CRC, ACK, ACK]
+    assert sizes == [1, 132, 82, 81, 1]
+    assert progress[-1][4].fragment_count == 2
+
+
+def test_xmodem_empty_reads_time_out(monkeypatch):
+    """Verify a getc returning b'' on a timeout, as pyserial does, counts
+    as a timeout rather than data to wait for the rest of."""
+    monkeypatch.setattr(time, 'sleep', lambda t: None)
+    calls = []
+
+    def mock_getc(size, timeout=1):
+        calls.append(size)
+        assert len(calls) < 100
+        return b''
+
+    xmodem = XMODEM(getc=mock_getc, putc=dummy_putc)
+
+    assert xmodem.send(BytesIO(b'data'), retry=3) is False
+    assert len(calls) == 4
+    del calls[:]
+    assert xmodem.recv(BytesIO(), retry=4) is None
+
+
 def test_xmodem_recv_very_short_block_does_not_crash(monkeypatch):
     """Verify recv() NAKs instead of crashing on a 3-byte block."""
     monkeypatch.setattr(time, 'sleep', lambda t: None)
@@ -560,6 +686,9 @@ def test_xmodem_recv_very_short_block_does_not_crash(monkeypatch):
         # very short block — should NAK, not IndexError
         yield very_short
 
+        # the rest never arrives
+        yield None
+
         # purge -> timeout
         yield None
 
@@ -749,3 +878,804 @@ def test_xmodem_recv_exceeds_retry_limit(monkeypatch):
 
     # verify: should abort (return None)
     assert result is None
+
+
+def _reference_crc(data, crc=0):
+    # the original byte-at-a-time implementation, kept as a reference
+    for char in bytearray(data):
+        crctbl_idx = ((crc >> 8) ^ char) & 0xff
+        crc = ((crc << 8) ^ XMODEM.crctable[crctbl_idx]) & 0xffff
+    return crc & 0xffff
+
+
+@pytest.mark.parametrize('integrity', sorted(INTEGRITY_BACKENDS))
+@pytest.mark.parametrize('length', [0, 1, 3, 4, 5, 127, 128, 1023, 1024, 1029])
+def test_calc_crc_matches_reference(length, integrity):
+    """Verify calc_crc() matches the byte-wise CRC for every backend."""
+    modem = XMODEM(getc=dummy_getc, putc=dummy_putc, integrity=integrity)
+    data = bytes(bytearray((n * 7 + 3) & 0xff for n in range(length)))
+
+    assert modem.calc_crc(data) == _reference_crc(data)
+    assert modem.calc_crc(bytearray(data)) == _reference_crc(data)
+    assert modem.calc_crc(memoryview(data)) == _reference_crc(data)
+    # incremental updates over an unaligned split
+    split = length // 3
+    crc = modem.calc_crc(data[:split])
+    assert modem.calc_crc(data[split:], crc) == _reference_crc(data)
+
+
+def test_calc_crc_python_memoryview_format():
+    """Verify the pure Python CRC reads wider memoryview formats as bytes."""
+    data = bytes(bytearray(range(64)))
+    crc = INTEGRITY_BACKENDS['python'].crc
+    assert crc(memoryview(data).cast('H')) == _reference_crc(data)
+
+
+def test_integrity_backends_agree():
+    """Verify the self-test passes for all registered backends."""
+    assert 'python' in INTEGRITY_BACKENDS
+    verify_integrity_backends()
+
+
+def test_integrity_backend_disagreement_is_reported(monkeypatch):
+    """Verify the self-test names a backend with a broken CRC."""
+    monkeypatch.setitem(INTEGRITY_BACKENDS, 'broken', IntegrityBackend(
+        'broken', INTEGRITY_BACKENDS['python'].checksum,
+        lambda data, crc=0: 0))
+    with pytest.raises(ValueError, match='broken'):
+        verify_integrity_backends()
+
+
+def test_integrity_backend_rejecting_memoryview_is_reported(monkeypatch):
+    """Verify the self-test names a backend failing on memoryview blocks."""
+    crc = INTEGRITY_BACKENDS['python'].crc
+
+    def bytes_only_crc(data, value=0):
+        if isinstance(data, memoryview):
+            raise TypeError('memoryview not supported')
+        return crc(data, value)
+
+    monkeypatch.setitem(INTEGRITY_BACKENDS, 'bytes-only', IntegrityBackend(
+        'bytes-only', INTEGRITY_BACKENDS['python'].checksum, bytes_only_crc))
+    with pytest.raises(ValueError, match='bytes-only'):
+        verify_integrity_backends(['bytes-only'])
+
+
+def test_xmodem_bad_integrity_backend():
+    with pytest.raises(ValueError):
+        XMODEM(getc=dummy_getc, putc=dummy_putc, integrity='XXX')
+
+
+def test_calc_checksum():
+    modem = XMODEM(getc=dummy_getc, putc=dummy_putc)
+    csum = modem.calc_checksum(b'hello')
+    assert modem.calc_checksum(b'world', csum) == 0x3c
+
+
+@pytest.mark.parametrize('packet_size,start', [(128, SOH), (1024, STX)])
+def test_send_headers(packet_size, start):
+    """Verify the packet headers for every sequence number."""
+    headers = xmodem._SEND_HEADERS[packet_size]
+    assert len(headers) == 0x100
+    for sequence, header in enumerate(headers):
+        assert header == start + bytes([sequence, 0xff - sequence])
+
+
+class _NoReadinto(object):
+    """A stream offering only read(), like many file-like wrappers."""
+
+    def __init__(self, data):
+        self._stream = BytesIO(data)
+
+    def read(self, size):
+        return self._stream.read(size)
+
+
+@pytest.mark.parametrize('crc_mode', [0, 1])
+@pytest.mark.parametrize('mode,packet_size', [('xmodem', 128),
+                                              ('xmodem1k', 1024)])
+@pytest.mark.parametrize('stream_type', [BytesIO, _NoReadinto])
+@pytest.mark.parametrize('prefetch', [0, 1, 4])
+def test_xmodem_send_frames(mode, packet_size, crc_mode, stream_type,
+                            prefetch):
+    """Verify send() encodes every packet in place, padding the last one."""
+    payload = bytes(bytearray(n & 0xff for n in range(packet_size * 2 + 5)))
+    sent = []
+
+    def mock_getc(size, timeout=1):
+        return (CRC if crc_mode else NAK) if not sent else ACK
+
+    def mock_putc(data, timeout=1):
+        sent.append(bytes(data))
+        return len(data)
+
+    modem = XMODEM(getc=mock_getc, putc=mock_putc, mode=mode, pad=b'\xbb')
+    assert modem.send(stream_type(payload), retry=0, prefetch=prefetch)
+
+    assert sent[-1] == EOT
+    frames = sent[:-1]
+    assert len(frames) == 3
+    expected = payload.ljust(packet_size * 3, b'\xbb')
+    for index, frame in enumerate(frames):
+        block = expected[index * packet_size:(index + 1) * packet_size]
+        start = SOH if packet_size == 128 else STX
+        assert frame == start + _make_block(index + 1, packet_size,
+                                            data=block, crc_mode=crc_mode)
+
+
+def test_xmodem_send_retransmits_same_buffer():
+    """Verify a retransmitted packet is not encoded again."""
+    sent = []
+    responses = [NAK, None, ACK, ACK]
+
+    def mock_getc(size, timeout=1):
+        return responses.pop(0)
+
+    def mock_putc(data, timeout=1):
+        sent.append(data)
+        return len(data)
+
+    modem = XMODEM(getc=mock_getc, putc=mock_putc)
+    assert modem.send(BytesIO(b'x' * 100), retry=1)
+    assert sent[0] is sent[1]
+    assert sent[0].obj is sent[1].obj
+
+
+def test_xmodem_send_prefetch_many_blocks():
+    """Verify prefetched packets stay intact while the ring of buffers wraps."""
+    payload = bytes(bytearray(n % 251 for n in range(128 * 300 + 1)))
+    received = BytesIO()
+    sent = []
+
+    def mock_getc(size, timeout=1):
+        return NAK if not sent else ACK
+
+    def mock_putc(data, timeout=1):
+        sent.append(1)
+        if len(data) > 1:
+            received.write(bytes(data[3:-1]))
+        return len(data)
+
+    modem = XMODEM(getc=mock_getc, putc=mock_putc)
+    assert modem.send(BytesIO(payload), prefetch=2)
+    assert received.getvalue() == payload.ljust(128 * 301, b'\x1a')
+
+
+def test_xmodem_send_prefetch_read_error():
+    """Verify an error reading the stream ahead is raised by send()."""
+    class FailingStream(object):
+        def read(self, size):
+            raise IOError('disk on fire')
+
+    modem = XMODEM(getc=lambda size, timeout=1: NAK, putc=dummy_putc)
+    with pytest.raises(IOError, match='disk on fire'):
+        modem.send(FailingStream(), prefetch=2)
+
+
+@pytest.mark.parametrize('crc_mode', [0, 1])
+@pytest.mark.parametrize('packet_size', [128, 1024])
+def test_frame_table_matches_send(packet_size, crc_mode):
+    """Verify a frame table holds the packets send() would encode."""
+    payload = bytes(bytearray(n % 253 for n in range(packet_size * 260 + 9)))
+    table = FrameTable.encode(payload, packet_size, crc_mode, pad=b'\xbb')
+    reader = xmodem._FrameReader(BytesIO(payload), packet_size, crc_mode,
+                                 b'\xbb', xmodem.get_integrity_backend())
+
+    assert len(table) == 261
+    assert table.size == len(payload)
+    for index in range(len(table)):
+        assert table[index] == reader.get()
+    assert reader.get() is None
+    with pytest.raises(IndexError):
+        table[len(table)]
+
+
+@pytest.mark.parametrize('crc_mode', [0, 1])
+def test_frame_table_parallel_encode(crc_mode):
+    """Verify encoding in a process pool gives the same table."""
+    payload = bytes(bytearray(n % 251 for n in range(128 * 64 * 5 + 3)))
+    serial = FrameTable.encode(payload, 128, crc_mode)
+    parallel = FrameTable.encode(payload, 128, crc_mode, workers=2)
+
+    assert len(parallel) == len(serial) == 64 * 5 + 1
+    assert parallel.size == serial.size
+    assert bytes(parallel._data) == bytes(serial._data)
+
+
+def test_frame_table_bad_buffer():
+    """Verify a buffer not holding whole packets is rejected."""
+    with pytest.raises(ValueError):
+        FrameTable(b'\x00' * 100, 128, 1, 100)
+
+
+def test_xmodem_send_frame_set():
+    """Verify a frame set is encoded once per checksum type and shared."""
+    payload = bytes(bytearray(n % 251 for n in range(1000)))
+    frames = FrameSet(BytesIO(payload), pad=b'\xbb')
+
+    def run(start, mode='xmodem'):
+        received = []
+
+        def mock_getc(size, timeout=1):
+            return start if not received else ACK
+
+        def mock_putc(data, timeout=1):
+            received.append(bytes(data))
+            return len(data)
+
+        modem = XMODEM(getc=mock_getc, putc=mock_putc, mode=mode)
+        assert modem.send(frames, retry=0)
+        return received[:-1]
+
+    first, second = run(CRC), run(CRC)
+    assert first == second
+    assert len(first) == 8
+    assert len(frames.tables) == 1
+    assert len(run(NAK)) == 8
+    assert len(run(CRC, mode='xmodem1k')) == 1
+    assert sorted(frames.tables) == [(128, 0), (128, 1), (1024, 1)]
+    table = frames.table(128, 1)
+    assert frames.table(128, 1) is table
+    assert b''.join(bytes(frame[3:-2]) for frame in first) == (
+        payload.ljust(1024, b'\xbb'))
+
+
+def _send_collect(source, mode='xmodem'):
+    sent = []
+
+    def mock_getc(size, timeout=1):
+        return CRC if not sent else ACK
+
+    def mock_putc(data, timeout=1):
+        sent.append(bytes(data))
+        return len(data)
+
+    modem = XMODEM(getc=mock_getc, putc=mock_putc, mode=mode, pad=b'\xbb')
+    assert modem.send(source, retry=0)
+    assert sent[-1] == EOT
+    return b''.join(frame[3:-2] for frame in sent[:-1])
+
+
+@pytest.mark.parametrize('mode,packet_size', [('xmodem', 128),
+                                              ('xmodem1k', 1024)])
+def test_xmodem_send_mapped_sources(tmpdir, mode, packet_size):
+    """Verify paths, memory maps and files are sent from a memory map."""
+    payload = bytes(bytearray(n % 251 for n in range(packet_size * 3 + 7)))
+    path = tmpdir.join('image.bin')
+    path.write_binary(payload)
+    expected = payload.ljust(packet_size * 4, b'\xbb')
+
+    assert _send_collect(str(path), mode) == expected
+
+    with open(str(path), 'rb') as stream:
+        mapping = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        assert _send_collect(mapping, mode) == expected
+        assert mapping.tell() == len(payload)
+        mapping.close()
+
+    with open(str(path), 'rb') as stream:
+        stream.read(10)
+        assert isinstance(xmodem._open_frames(stream, packet_size, 1, b'',
+                                              xmodem.get_integrity_backend()),
+                          xmodem._MappedFrameReader)
+        assert _send_collect(stream, mode) == (
+            payload[10:].ljust(packet_size * 3, b'\xbb'))
+        assert stream.tell() == len(payload)
+        assert stream.read() == b''
+
+
+def test_xmodem_send_empty_path(tmpdir):
+    """Verify an empty file is sent as no packets at all."""
+    path = tmpdir.join('empty.bin')
+    path.write_binary(b'')
+    assert _send_collect(str(path)) == b''
+
+
+def test_xmodem_send_pipe_not_mapped():
+    """Verify a stream that is not a regular file is read as before."""
+    read_fd, write_fd = os.pipe()
+    with os.fdopen(read_fd, 'rb') as stream:
+        os.write(write_fd, b'piped' * 100)
+        os.close(write_fd)
+        assert xmodem._map_source(stream) is None
+        assert _send_collect(stream) == (b'piped' * 100).ljust(512, b'\xbb')
+
+
+def test_xmodem_send_compressed_file_not_mapped(tmpdir):
+    """Verify a stream decoding a regular file, such as gzip, is read
+    rather than the file under it mapped."""
+    import gzip
+
+    payload = bytes(bytearray(n % 251 for n in range(10240)))
+    path = str(tmpdir.join('image.bin.gz'))
+    with gzip.open(path, 'wb') as stream:
+        stream.write(payload)
+    with gzip.open(path, 'rb') as stream:
+        assert xmodem._map_source(stream) is None
+        assert _send_collect(stream) == payload
+
+
+def test_xmodem_recv_write_behind(monkeypatch):
+    """Verify recv(write_behind=n) writes every block and returns its size."""
+    monkeypatch.setattr(time, 'sleep', lambda t: None)
+    blocks = [bytes([n]) * 128 for n in range(1, 6)]
+
+    def getc_generator():
+        for sequence, block in enumerate(blocks, 1):
+            yield SOH
+            yield _make_block(sequence, 128, data=block, crc_mode=1)
+        yield EOT
+
+    mock = getc_generator()
+
+    def mock_getc(size, timeout=1):
+        return next(mock)
+
+    xmodem = XMODEM(getc=mock_getc, putc=dummy_putc)
+
+    destination = BytesIO()
+    result = xmodem.recv(stream=destination, retry=16, write_behind=2)
+
+    assert result == 5 * 128
+    assert destination.getvalue() == b''.join(blocks)
+
+
+@pytest.mark.parametrize('fail_at', [1, 3])
+def test_xmodem_recv_write_behind_error_aborts(monkeypatch, fail_at):
+    """Verify a failed background write cancels the transfer.
+
+    Depending on how far the writer is behind, the failure is noticed
+    before acknowledging a later block, or at the latest at EOT.
+    """
+    monkeypatch.setattr(time, 'sleep', lambda t: None)
+
+    class FailingStream(BytesIO):
+        def write(self, data):
+            if self.tell() >= 128 * (fail_at - 1):
+                raise IOError('disk full')
+            return BytesIO.write(self, data)
+
+    def getc_generator():
+        for sequence in range(1, 4):
+            yield SOH
+            yield _make_block(sequence, 128, crc_mode=1)
+        yield EOT
+
+    mock = getc_generator()
+    sent = []
+
+    def mock_getc(size, timeout=1):
+        return next(mock)
+
+    def mock_putc(data, timeout=1):
+        sent.append(bytes(data))
+        return len(data)
+
+    xmodem = XMODEM(getc=mock_getc, putc=mock_putc)
+
+    result = xmodem.recv(stream=FailingStream(), retry=16, write_behind=1)
+
+    assert result is None
+    assert sent[-2:] == [CAN, CAN]
+
+
+def test_xmodem_recv_getc_into(monkeypatch):
+    """Verify recv() reads blocks with getc_into() when it is given."""
+    monkeypatch.setattr(time, 'sleep', lambda t: None)
+    wire = BytesIO(SOH + _make_block(1, 128, data=b'\xaa' * 128) +
+                   STX + _make_block(2, 1024, data=b'\xbb' * 1024) +
+                   SOH + _make_block(3, 128, data=b'\xcc' * 10) +
+                   EOT)
+    sizes = []
+
+    def mock_getc(size, timeout=1):
+        sizes.append(size)
+        return wire.read(size) or None
+
+    def mock_getc_into(buffer, timeout=1):
+        return wire.readinto(buffer) or None
+
+    xmodem = XMODEM(getc=mock_getc, putc=dummy_putc,
+                    getc_into=mock_getc_into)
+
+    destination = BytesIO()
+    result = xmodem.recv(stream=destination, retry=16)
+
+    assert result == 128 + 1024 + 128
+    assert destination.getvalue() == (b'\xaa' * 128 + b'\xbb' * 1024 +
+                                      b'\xcc' * 10 + b'\x1a' * 118)
+    assert set(sizes) == {1}
+
+
+def test_xmodem_recv_getc_into_timeout(monkeypatch):
+    """Verify recv() NAKs when getc_into() times out."""
+    monkeypatch.setattr(time, 'sleep', lambda t: None)
+    blocks = [None, _make_block(1, 128, crc_mode=1)]
+
+    def getc_generator():
+        yield SOH
+        # purge -> timeout
+        yield None
+        yield SOH
+        yield EOT
+
+    mock = getc_generator()
+
+    def mock_getc(size, timeout=1):
+        return next(mock)
+
+    def mock_getc_into(buffer, timeout=1):
+        block = blocks.pop(0)
+        if block is None:
+            return None
+        buffer[:len(block)] = block
+        return len(block)
+
+    xmodem = XMODEM(getc=mock_getc, putc=dummy_putc,
+                    getc_into=mock_getc_into)
+
+    assert xmodem.recv(stream=BytesIO(), retry=16) == 128
+
+
+def _run_loopback(sender, receiver, stream):
+    """Drive a sender and a receiver protocol connected back to back."""
+    reader = None
+    received = BytesIO()
+    progress = True
+    while progress:
+        progress = False
+        event = sender.next_event()
+        if isinstance(event, NeedFrame):
+            if reader is None:
+                reader = xmodem._open_frames(
+                    stream, event.packet_size, event.crc_mode, b'\x1a',
+                    xmodem.get_integrity_backend())
+            sender.send_frame(reader.get())
+            progress = True
+        elif isinstance(event, SendData):
+            receiver.receive_data(bytes(event.data))
+            sender.sent(len(event.data))
+            progress = True
+        elif isinstance(event, Progress):
+            progress = True
+        event = receiver.next_event()
+        if isinstance(event, BlockReceived):
+            received.write(event.data)
+            progress = True
+        elif isinstance(event, SendData):
+            sender.receive_data(bytes(event.data))
+            receiver.sent(len(event.data))
+            progress = True
+        elif isinstance(event, (Progress, EndOfTransmission)):
+            progress = True
+    return sender.next_event(), receiver.next_event(), received.getvalue()
+
+
+@pytest.mark.parametrize('mode', ['xmodem', 'xmodem1k'])
+@pytest.mark.parametrize('crc_mode', [0, 1])
+def test_protocol_loopback(mode, crc_mode):
+    """Verify the sender and receiver protocols transfer data between them."""
+    payload = bytes(bytearray(n % 253 for n in range(3000)))
+    sender = XMODEMSender(mode)
+    receiver = XMODEMReceiver(crc_mode=crc_mode)
+
+    sender_done, receiver_done, received = _run_loopback(
+        sender, receiver, BytesIO(payload))
+
+    assert sender_done == Done(True)
+    packet_size = sender.packet_size
+    padded_size = -(-len(payload) // packet_size) * packet_size
+    assert receiver_done == Done(padded_size)
+    assert received == payload.ljust(padded_size, b'\x1a')
+    assert sender.crc_mode == crc_mode
+
+
+def test_protocol_receiver_batched_input():
+    """Verify the receiver accepts a whole transmission in one go."""
+    wire = (SOH + _make_block(1, 128, data=b'\xaa' * 128) +
+            SOH + _make_block(2, 128, data=b'\xbb' * 128) +
+            EOT)
+    receiver = XMODEMReceiver()
+    events = []
+
+    assert receiver.next_event() == SendData(CRC, None)
+    receiver.sent(1)
+    assert receiver.next_event() == NeedData(1, 60)
+    receiver.receive_data(wire)
+    while not receiver.done:
+        event = receiver.next_event()
+        events.append(type(event).__name__)
+        if isinstance(event, SendData):
+            receiver.sent(len(event.data))
+
+    assert receiver.next_event() == Done(256)
+    assert events.count('BlockReceived') == 2
+    assert events.count('SendData') == 3
+
+
+def test_protocol_receiver_timeout_and_cancel():
+    """Verify timeouts lead to NAK, and cancel() sends the abort sequence."""
+    receiver = XMODEMReceiver(retry=4)
+    receiver.next_event()
+    receiver.sent(1)
+    receiver.receive_data(SOH + b'\x01\xfe' + b'\x00' * 10)
+    assert receiver.next_event() == NeedData(2 + 128 + 2, 60)
+    # the rest of the block does not arrive in time
+    receiver.timeout()
+    assert receiver.next_event() == Purge(1)
+    receiver.receive_data(b'garbage')
+    receiver.timeout()
+    assert receiver.next_event() == Progress(0, 0, 1, 128)
+    assert receiver.next_event() == SendData(NAK, None)
+
+    receiver.cancel()
+    assert receiver.next_event() == SendData(CAN, 60)
+    receiver.sent(1)
+    assert receiver.next_event() == SendData(CAN, 60)
+    receiver.sent(1)
+    assert receiver.next_event() == Done(None)
+    with pytest.raises(RuntimeError):
+        receiver.timeout()
+
+
+def _sender_events(sender, replies, frames):
+    """Run a sender on scripted replies, returning the events it emits."""
+    events = []
+    while not sender.done:
+        event = sender.next_event()
+        if isinstance(event, NeedData) and not replies:
+            break
+        events.append(event)
+        if isinstance(event, NeedFrame):
+            sender.send_frame(frames.pop(0) if frames else None)
+        elif isinstance(event, SendData):
+            sender.sent(len(event.data))
+        elif isinstance(event, NeedData):
+            reply = replies.pop(0)
+            if reply is None:
+                sender.timeout()
+            else:
+                sender.receive_data(reply)
+    return events
+
+
+def test_protocol_sender_window():
+    """Verify a window of packets is sent once the receiver acknowledges
+    with sequence numbers, and a NAK goes back to the packet named."""
+    frames = [bytearray([n]) for n in range(1, 8)]
+    sender = XMODEMSender(window=4)
+    events = _sender_events(sender, [CRC, ACK + b'\x01\xfe',
+                                     NAK + b'\x03\xfc'], frames)
+
+    assert sender.windowed
+    sent = [bytes(event.data) for event in events
+            if isinstance(event, SendData)]
+    # block 1, then blocks 2 to 5 in flight, then 3 to 5 again and 6 in
+    # the room made by the NAK implying block 2 arrived
+    assert sent == [b'\x01', b'\x02', b'\x03', b'\x04', b'\x05',
+                    b'\x03', b'\x04', b'\x05', b'\x06']
+    assert sender.success_count == 2
+    assert sender.next_event() == NeedData(1, 60)
+
+
+def test_protocol_sender_window_fallback():
+    """Verify a sender goes on with stop-and-wait when the first ACK has no
+    sequence number."""
+    sender = XMODEMSender(window=4)
+    events = _sender_events(sender, [CRC, ACK, None], [b'1', b'2', b'3'])
+
+    assert not sender.windowed
+    assert [event for event in events if isinstance(event, NeedData)] == [
+        NeedData(1, None), NeedData(1, 60), NeedData(2, 1)]
+    # block 2 is sent alone, and waited for
+    assert [bytes(event.data) for event in events
+            if isinstance(event, SendData)] == [b'1', b'2']
+    assert NeedFrame(1, 2, 128, 1) in events
+    assert sender.next_event() == NeedData(1, 60)
+    with pytest.raises(ValueError):
+        XMODEMSender(window=128)
+
+
+@pytest.mark.parametrize('corrupt', [None, 700, 2000])
+def test_xmodem_windowed_transfer(corrupt):
+    """Verify a windowed transfer recovers from a corrupt packet."""
+    import socket
+    import threading
+
+    payload = bytes(bytearray(n % 251 for n in range(128 * 40)))
+    sock_a, sock_b = socket.socketpair()
+    written = [0]
+
+    def modem(sock):
+        def getc(size, timeout=1):
+            sock.settimeout(timeout)
+            data = b''
+            try:
+                while len(data) < size:
+                    chunk = sock.recv(size - len(data))
+                    if not chunk:
+                        break
+                    data += chunk
+            except (socket.timeout, BlockingIOError):
+                pass
+            return data or None
+
+        def putc(data, timeout=1):
+            data = bytearray(data)
+            if sock is sock_a and corrupt is not None and (
+                    written[0] <= corrupt < written[0] + len(data)):
+                data[corrupt - written[0]] ^= 0xff
+            written[0] += len(data)
+            sock.sendall(data)
+            return len(data)
+
+        return XMODEM(getc, putc)
+
+    received = BytesIO()
+    results = []
+    receiver = threading.Thread(target=lambda: results.append(
+        modem(sock_b).recv(received, timeout=2, windowed=True)))
+    receiver.start()
+    try:
+        assert modem(sock_a).send(BytesIO(payload), timeout=2,
+                                  window=8) is True
+        receiver.join(30)
+    finally:
+        sock_a.close()
+        sock_b.close()
+    assert results == [len(payload)]
+    assert received.getvalue() == payload
+
+
+def test_protocol_sender_adaptive():
+    """Verify an adaptive sender drops to 128 byte packets after errors,
+    and goes back to 1024 byte packets after a run without."""
+    sender = XMODEMSender('xmodem1k', adaptive=True)
+    sender.adaptive_clean_run = 2
+    events = _sender_events(sender, [CRC, NAK, NAK, None, ACK, ACK, ACK,
+                                     ACK], [b'1', b'2', b'3', b'4', b'5'])
+
+    assert [event.packet_size for event in events
+            if isinstance(event, NeedFrame)] == [1024, 128, 128, 1024, 1024]
+    # each switch is reported before the packet it applies to
+    assert [event.packet_size for event in events
+            if isinstance(event, Progress)] == [1024] * 4 + [128] * 3 + [
+                1024] * 2
+    with pytest.raises(ValueError):
+        XMODEMSender('xmodem', adaptive=True)
+
+
+def test_xmodem_send_adaptive():
+    """Verify an adaptive transfer re-encodes the stream in smaller packets,
+    and passes the packet size to the callback."""
+    payload = bytes(bytearray(n % 251 for n in range(1500)))
+    replies = [CRC, NAK, NAK, NAK] + [ACK] * 6
+    sent = []
+    progress = []
+
+    def getc(size, timeout=1):
+        return replies.pop(0) if replies else None
+
+    def putc(data, timeout=1):
+        sent.append(bytes(data))
+        return len(data)
+
+    modem = XMODEM(getc, putc, mode='xmodem1k')
+    assert modem.send(BytesIO(payload), adaptive=True,
+                      callback=lambda *args: progress.append(args)) is True
+
+    packets = [packet for packet in sent if packet[:1] in (SOH, STX)]
+    assert [len(packet) for packet in packets] == [1029] * 4 + [133] * 4
+    data = packets[3][3:-2] + b''.join(packet[3:-2] for packet in packets[4:])
+    assert data.rstrip(b'\x1a') == payload
+    assert progress[-1] == (5, 5, 0, 128)
+    with pytest.raises(ValueError):
+        modem.send(BytesIO(payload), adaptive=True, prefetch=2)
+
+
+def test_rtt_estimator():
+    """Verify the timeout follows the measured turnaround, within bounds."""
+    now = [0.0]
+    rtt = RTTEstimator(initial=3, floor=0.1, ceiling=4, clock=lambda: now[0])
+    assert rtt.timeout == 3
+    rtt.start()
+    now[0] += 0.2
+    rtt.stop()
+    assert (rtt.srtt, rtt.rttvar) == (0.2, 0.1)
+    assert rtt.timeout == pytest.approx(0.6)
+    rtt.update(0.2)
+    assert rtt.timeout == pytest.approx(0.5)
+    rtt.backoff()
+    assert rtt.timeout == pytest.approx(1.0)
+    # no sample without a start, nor after a discard
+    rtt.stop()
+    rtt.start()
+    rtt.discard()
+    rtt.stop()
+    assert rtt.timeout == pytest.approx(1.0)
+    for _ in range(50):
+        rtt.update(0.001)
+    assert rtt.timeout == 0.1
+    for _ in range(10):
+        rtt.backoff()
+    assert rtt.timeout == 4
+    with pytest.raises(ValueError):
+        RTTEstimator(floor=0)
+
+
+def test_protocol_sender_rtt():
+    """Verify a sender waits for each ACK as long as the estimator tells,
+    and does not measure the ACK of a retransmitted packet."""
+    now = [0.0]
+    rtt = RTTEstimator(initial=3, clock=lambda: now[0])
+    sender = XMODEMSender(rtt=rtt)
+    # seconds until each reply, and the reply
+    replies = [(0, CRC), (0.2, ACK), (0.6, None), (1.0, ACK)]
+    waits = []
+    while replies:
+        event = sender.next_event()
+        if isinstance(event, NeedFrame):
+            sender.send_frame(b'frame')
+        elif isinstance(event, SendData):
+            sender.sent(len(event.data))
+        elif isinstance(event, NeedData):
+            waits.append(event.timeout)
+            delay, reply = replies.pop(0)
+            now[0] += delay
+            if reply is None:
+                sender.timeout()
+            else:
+                sender.receive_data(reply)
+
+    assert waits == [None, 3, pytest.approx(0.6), pytest.approx(1.2)]
+    assert rtt.srtt == pytest.approx(0.2)
+    assert rtt.timeout == pytest.approx(1.2)
+    assert sender.success_count == 2
+
+
+def test_xmodem_rtt_transfer():
+    """Verify a transfer with estimated timeouts on both ends."""
+    import socket
+    import threading
+
+    payload = bytes(bytearray(n % 251 for n in range(128 * 20)))
+    sock_a, sock_b = socket.socketpair()
+
+    def modem(sock):
+        def getc(size, timeout=1):
+            sock.settimeout(timeout)
+            data = b''
+            try:
+                while len(data) < size:
+                    chunk = sock.recv(size - len(data))
+                    if not chunk:
+                        break
+                    data += chunk
+            except (socket.timeout, BlockingIOError):
+                pass
+            return data or None
+
+        def putc(data, timeout=1):
+            sock.sendall(data)
+            return len(data)
+
+        return XMODEM(getc, putc)
+
+    received = BytesIO()
+    results = []
+    recv_rtt = RTTEstimator(initial=2)
+    receiver = threading.Thread(target=lambda: results.append(
+        modem(sock_b).recv(received, timeout=5, rtt=recv_rtt)))
+    receiver.start()
+    send_rtt = RTTEstimator(initial=2)
+    try:
+        assert modem(sock_a).send(BytesIO(payload), timeout=5,
+                                  rtt=send_rtt) is True
+        receiver.join(30)
+    finally:
+        sock_a.close()
+        sock_b.close()
+    assert results == [len(payload)]
+    assert received.getvalue() == payload
+    assert send_rtt.srtt is not None and recv_rtt.srtt is not None
+    assert send_rtt.timeout < 2
@@ -0,0 +1,230 @@
+"""
+Unit tests for YMODEM batch transfers.
+"""
+# std imports
+from io import BytesIO
+import os
+import socket
+import threading
+
+# local
+from xmodem import ACK, CAN, CRC, EOT, SOH
+from xmodem.ymodem import (
+    GO,
+    YMODEM,
+    FileHeader,
+    YMODEMReceiver,
+    YMODEMSender,
+    _decode_header,
+    _encode_header,
+)
+
+# 3rd-party
+import pytest
+
+
+def _socket_modem(sock, **kwargs):
+    sock.settimeout(5)
+
+    def getc(size, timeout=1):
+        sock.settimeout(timeout)
+        data = b''
+        try:
+            while len(data) < size:
+                chunk = sock.recv(size - len(data))
+                if not chunk:
+                    break
+                data += chunk
+        except (socket.timeout, BlockingIOError):
+            pass
+        return data or None
+
+    def putc(data, timeout=1):
+        sock.sendall(data)
+        return len(data)
+
+    return YMODEM(getc, putc, **kwargs)
+
+
+def _transfer(files, destination, mode='xmodem1k', crc_mode=1,
+              streaming=False):
+    sock_a, sock_b = socket.socketpair()
+    received = []
+    receiver = threading.Thread(target=lambda: received.append(
+        _socket_modem(sock_b).recv(destination, crc_mode=crc_mode,
+                                   timeout=5, streaming=streaming)))
+    receiver.start()
+    try:
+        sent = _socket_modem(sock_a, mode=mode).send(files, timeout=5)
+        receiver.join(30)
+    finally:
+        sock_a.close()
+        sock_b.close()
+    return sent, received[0]
+
+
+def test_header_encoding():
+    """Verify block 0 holds the name, size in decimal and mtime in octal."""
+    header = FileHeader('foo.c', 1234, 0o13413731563)
+    payload = _encode_header(header)
+    assert payload == b'foo.c\x001234 13413731563'
+    assert _decode_header(payload.ljust(128, b'\x00')) == header
+    assert _decode_header(b'bar\x00'.ljust(128, b'\x00')) == (
+        FileHeader('bar', None, None))
+    assert _decode_header(b'\x00' * 128).name == ''
+
+
+@pytest.mark.parametrize('mode', ['xmodem', 'xmodem1k'])
+@pytest.mark.parametrize('crc_mode,streaming', [(0, False), (1, False),
+                                                (1, True)])
+def test_ymodem_batch(tmpdir, mode, crc_mode, streaming):
+    """Verify several files are sent in one session, truncated to size."""
+    source = tmpdir.mkdir('source')
+    target = tmpdir.mkdir('target')
+    sizes = [0, 1, 127, 128, 1000, 1024, 3000]
+    paths = []
+    for index, size in enumerate(sizes):
+        path = source.join('file{0}.bin'.format(index))
+        path.write_binary(bytes(bytearray((index + n) % 256
+                                          for n in range(size))))
+        os.utime(str(path), (1000000000, 1000000000 + index))
+        paths.append(str(path))
+
+    sent, received = _transfer(paths, str(target), mode, crc_mode,
+                               streaming)
+
+    assert sent is True
+    assert [(header.name, header.size) for header in received] == [
+        (os.path.basename(path), size) for path, size in zip(paths, sizes)]
+    for path in paths:
+        copy = target.join(os.path.basename(path))
+        assert copy.read_binary() == open(path, 'rb').read()
+        assert int(os.stat(str(copy)).st_mtime) == int(os.stat(path).st_mtime)
+
+
+def test_ymodem_streams():
+    """Verify streams are sent and received through a callback."""
+    streams = {}
+
+    def destination(header):
+        streams[header.name] = BytesIO()
+        return streams[header.name]
+
+    first = BytesIO(b'first' * 100)
+    first.read(5)
+    sent, received = _transfer(
+        [('first', first), ('second', BytesIO(b'second'))], destination)
+
+    assert sent is True
+    assert [tuple(header) for header in received] == [
+        ('first', 495, None), ('second', 6, None)]
+    assert streams['first'].getvalue() == b'first' * 99
+    assert streams['second'].getvalue() == b'second'
+
+
+def test_ymodem_compressed_file(tmpdir):
+    """Verify the size sent for a gzip file is that of the data in it."""
+    import gzip
+
+    payload = bytes(bytearray(n % 251 for n in range(10240)))
+    path = str(tmpdir.join('image.bin.gz'))
+    with gzip.open(path, 'wb') as stream:
+        stream.write(payload)
+    target = BytesIO()
+    with gzip.open(path, 'rb') as stream:
+        sent, received = _transfer([('image.bin', stream)],
+                                   lambda header: target)
+
+    assert sent is True
+    assert received == [FileHeader('image.bin', len(payload), None)]
+    assert target.getvalue() == payload
+
+
+def _feed(protocol, replies, frames=None):
+    # Run a sender state machine on scripted replies, returning the
+    # frames it sends.
+    sent = []
+    while not protocol.done:
+        event = protocol.next_event()
+        kind = type(event).__name__
+        if kind == 'SendData':
+            sent.append(bytes(event.data))
+            protocol.sent(len(event.data))
+        elif kind == 'NeedData':
+            reply = replies.pop(0)
+            if reply is None:
+                protocol.timeout()
+            else:
+                protocol.receive_data(reply)
+        elif kind == 'NeedFrame':
+            protocol.send_frame(frames.pop(0) if frames else None)
+    return sent
+
+
+def test_ymodem_sender_protocol():
+    """Verify the sender exchange for one empty file and the batch end."""
+    protocol = YMODEMSender([FileHeader('empty', 0, None)], mode='xmodem')
+    sent = _feed(protocol, [CRC, ACK, CRC, ACK, CRC, ACK])
+
+    assert protocol.next_event().result is True
+    assert [frame[:3] for frame in sent] == [
+        SOH + b'\x00\xff', EOT, SOH + b'\x00\xff']
+    assert sent[0][3:12] == b'empty\x000\x00\x00'
+    assert sent[2][3:-2] == b'\x00' * 128
+
+
+def test_ymodem_receiver_cancelled():
+    """Verify the receiver gives up on CAN CAN."""
+    protocol = YMODEMReceiver()
+    assert protocol.next_event().data == CRC
+    protocol.sent(1)
+    protocol.receive_data(b'\x18\x18')
+    assert protocol.next_event().data == CRC
+    protocol.sent(1)
+    assert protocol.next_event().result is None
+
+
+def test_ymodem_g_sender_protocol():
+    """Verify a streaming sender only polls for an abort between blocks."""
+    frames = [b'frame1', b'frame2', b'frame3']
+    protocol = YMODEMSender([FileHeader('f', 3, None)], mode='xmodem')
+    sent = _feed(protocol, [GO, GO, None, None, None, ACK, GO], list(frames))
+
+    assert protocol.streaming
+    assert protocol.next_event().result is True
+    assert sent[1:5] == frames + [EOT]
+    assert sent[5][3:-2] == b'\x00' * 128
+
+
+def test_ymodem_g_sender_aborted():
+    """Verify a streaming sender stops when the receiver aborts."""
+    frames = [b'frame1', b'frame2', b'frame3']
+    protocol = YMODEMSender([FileHeader('f', 3, None)], mode='xmodem')
+    sent = _feed(protocol, [GO, GO, CAN, CAN], list(frames))
+
+    assert protocol.next_event().result is False
+    assert sent[1:] == frames[:1]
+
+
+def test_ymodem_g_receiver_aborts_on_error():
+    """Verify a streaming receiver aborts at a bad block instead of NAK."""
+    protocol = YMODEMReceiver(streaming=True)
+    header = SOH + b'\x00\xff' + b'f\x00'.ljust(128, b'\x00')
+    crc = protocol._calc_crc(header[3:])
+    header += bytes([crc >> 8, crc & 0xff])
+    sent = []
+    replies = [header, SOH + b'\x01\xfe' + b'x' * 130]
+    while not protocol.done:
+        event = protocol.next_event()
+        kind = type(event).__name__
+        if kind == 'SendData':
+            sent.append(bytes(event.data))
+            protocol.sent(len(event.data))
+        elif kind in ('NeedData', 'Purge'):
+            if replies:
+                protocol.receive_data(replies.pop(0))
+            else:
+                protocol.timeout()
+
+    assert protocol.next_event().result is None
+    assert sent == [GO, GO, CAN, CAN]
@@ -0,0 +1,228 @@
+"""
+Unit tests for ZMODEM transfers.
+"""
+# std imports
+from io import BytesIO
+import os
+import socket
+import threading
+
+# local
+from xmodem.transport import BufferedTransport
+from xmodem.ymodem import FileHeader
+from xmodem.zmodem import (
+    ABORT,
+    ZBIN32,
+    ZCRCE,
+    ZCRCG,
+    ZDATA,
+    ZMODEM,
+    ZRPOS,
+    ZMODEMReceiver,
+    ZMODEMSender,
+    _args,
+    _escape,
+)
+
+# 3rd-party
+import pytest
+
+PAYLOAD = bytes(bytearray(n % 251 for n in range(20000)))
+
+
+def _socket_modem(sock, corrupt=None):
+    # corrupt: offset into the bytes written at which one byte is flipped
+    written = [0]
+
+    def getc(size, timeout=1):
+        sock.settimeout(timeout)
+        try:
+            return sock.recv(size) or None
+        except (socket.timeout, BlockingIOError):
+            return None
+
+    def putc(data, timeout=1):
+        data = bytes(data)
+        if corrupt is not None and (
+                written[0] <= corrupt < written[0] + len(data)):
+            data = bytearray(data)
+            data[corrupt - written[0]] ^= 0x01
+            data = bytes(data)
+        written[0] += len(data)
+        sock.sendall(data)
+        return len(data)
+
+    transport = BufferedTransport(getc, putc)
+    return ZMODEM(transport.getc, transport.putc)
+
+
+def _transfer(files, destination, corrupt=None, send_kwargs=None,
+              recv_kwargs=None):
+    sock_a, sock_b = socket.socketpair()
+    received = []
+    receiver = threading.Thread(target=lambda: received.append(
+        _socket_modem(sock_b).recv(destination, timeout=5,
+                                   **(recv_kwargs or {}))))
+    receiver.start()
+    try:
+        sent = _socket_modem(sock_a, corrupt).send(files, timeout=5,
+                                                   **(send_kwargs or {}))
+        receiver.join(30)
+    finally:
+        sock_a.close()
+        sock_b.close()
+    return sent, received[0]
+
+
+def _escaped_bytes():
+    # every byte value, including those escaped after @
+    return bytes(range(256)) + b'@\r\xc0\x8d'
+
+
+def test_escape():
+    """Verify escaped data holds no flow control or lone ZDLE bytes."""
+    escaped = _escape(_escaped_bytes())
+    for char in (0x10, 0x11, 0x13, 0x90, 0x91, 0x93):
+        assert bytes([char]) not in escaped
+    assert b'@\x18M' in escaped and b'\xc0\x18\xcd' in escaped
+    assert escaped.count(b'\x18') == 9
+
+
+@pytest.mark.parametrize('crc32', [False, True])
+def test_headers_and_subpackets(crc32):
+    """Verify headers and subpackets are read back as they were sent."""
+    sender = ZMODEMSender([])
+    sender.crc32 = crc32
+    receiver = ZMODEMReceiver()
+    stream = (sender._hex_header(ZRPOS, _args(0x12345678)) +
+              b'garbage*' +
+              sender._bin_header(ZDATA, _args(1000)) +
+              sender._subpacket(_escaped_bytes(), ZCRCG) +
+              sender._subpacket(b'', ZCRCE))
+    receiver._pending = stream
+    results = []
+    for reader in (receiver._recv_header(1), receiver._recv_header(1),
+                   receiver._recv_subpacket(), receiver._recv_subpacket()):
+        with pytest.raises(StopIteration) as stop:
+            next(reader)
+        results.append(stop.value.value)
+
+    assert results == [(ZRPOS, _args(0x12345678)), (ZDATA, _args(1000)),
+                       (ZCRCG, _escaped_bytes()), (ZCRCE, b'')]
+    assert receiver._crc32_in is crc32
+    assert stream.startswith(b'**\x18B0978563412')
+    assert (b'*\x18' + bytes([ZBIN32]) in stream) is crc32
+
+
+def test_cancelled():
+    """Verify five CANs cancel the transfer."""
+    receiver = ZMODEMReceiver()
+    receiver._pending = b'**' + ABORT
+    with pytest.raises(StopIteration) as stop:
+        next(receiver._recv_header(1))
+    assert stop.value.value[0] < 0
+
+
+@pytest.mark.parametrize('crc32', [False, True])
+def test_zmodem_batch(tmpdir, crc32):
+    """Verify several files are sent in one session."""
+    source = tmpdir.mkdir('source')
+    target = tmpdir.mkdir('target')
+    sizes = [0, 1, 1023, 1024, 1025, 20000]
+    paths = []
+    for index, size in enumerate(sizes):
+        path = source.join('file{0}.bin'.format(index))
+        path.write_binary((PAYLOAD * 2)[index:index + size])
+        os.utime(str(path), (1000000000, 1000000000 + index))
+        paths.append(str(path))
+
+    sent, received = _transfer(paths, str(target),
+                               recv_kwargs={'crc32': crc32})
+
+    assert sent is True
+    assert [(header.name, header.size) for header in received] == [
+        (os.path.basename(path), size) for path, size in zip(paths, sizes)]
+    for path in paths:
+        copy = target.join(os.path.basename(path))
+        assert copy.read_binary() == open(path, 'rb').read()
+        assert int(os.stat(str(copy)).st_mtime) == int(os.stat(path).st_mtime)
+
+
+def test_zmodem_recovers_from_bad_subpacket():
+    """Verify the sender goes back to where the receiver asks for."""
+    stream = BytesIO()
+    progress = []
+    sent, received = _transfer(
+        [('payload', BytesIO(PAYLOAD))], lambda header: stream,
+        corrupt=10000,
+        recv_kwargs={'callback': lambda *args: progress.append(args)})
+
+    assert sent is True
+    assert received == [FileHeader('payload', len(PAYLOAD), None)]
+    assert stream.getvalue() == PAYLOAD
+    assert any(error_count for _, _, error_count in progress)
+
+
+def test_zmodem_resume(tmpdir):
+    """Verify a receiver resumes a partial file from its end."""
+    source = tmpdir.join('image.bin')
+    source.write_binary(PAYLOAD)
+    target = tmpdir.mkdir('target')
+    target.join('image.bin').write_binary(PAYLOAD[:15000])
+    progress = []
+
+    sent, received = _transfer(
+        [str(source)], str(target),
+        send_kwargs={'callback': lambda *args: progress.append(args)},
+        recv_kwargs={'resume': True})
+
+    assert sent is True
+    assert target.join('image.bin').read_binary() == PAYLOAD
+    # only the rest of the file was sent
+    assert progress[0][1] == 16024
+    assert received[0].size == len(PAYLOAD)
+
+
+def test_zmodem_skip():
+    """Verify files the receiver has no stream for are skipped."""
+    stream = BytesIO()
+    sent, received = _transfer(
+        [('skipped', BytesIO(b'skipped')), ('kept', BytesIO(b'kept'))],
+        lambda header: stream if header.name == 'kept' else None)
+
+    assert sent is True
+    assert received == [FileHeader('kept', 4, None)]
+    assert stream.getvalue() == b'kept'
+
+
+def test_zmodem_sender_aborted():
+    """Verify the sender stops when the receiver aborts."""
+    protocol = ZMODEMSender([FileHeader('f', 3, None)])
+    receiver = ZMODEMReceiver()
+    init = receiver.next_event().data
+    assert init.startswith(b'**\x18B01')
+
+    sent = []
+    replies = [init, ABORT]
+    while not protocol.done:
+        event = protocol.next_event()
+        kind = type(event).__name__
+        if kind == 'SendData':
+            sent.append(bytes(event.data))
+            protocol.sent(len(event.data))
+        elif kind == 'NeedData':
+            if replies:
+                protocol.receive_data(replies.pop(0))
+            else:
+                protocol.timeout()
+
+    assert protocol.next_event().result is False
+    assert protocol.crc32
+    assert sent[0] == b'rz\r'
+    assert sent[-1].startswith(b'*\x18C\x04')
+
+
+def test_block_size():
+    """Verify data subpackets are at most 8 KiB."""
+    with pytest.raises(ValueError):
+        ZMODEMSender([], block_size=8193)
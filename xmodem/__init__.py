@@ -6,10 +6,10 @@
 .. $Id$
 
 This is a literal implementation of XMODEM.TXT_, XMODEM1K.TXT_ and
-XMODMCRC.TXT_, support for YMODEM and ZMODEM is pending. YMODEM should
-be fairly easy to implement as it is a hack on top of the XMODEM
+XMODMCRC.TXT_. YMODEM batch transfers, a hack on top of the XMODEM
 protocol using sequence bytes ``0x00`` for sending file names (and some
-meta data).
+meta data), are implemented in :mod:`xmodem.ymodem`, and ZMODEM in
+:mod:`xmodem.zmodem`.
 
 .. _XMODEM.TXT: doc/XMODEM.TXT
 .. _XMODEM1K.TXT: doc/XMODEM1K.TXT
@@ -104,6 +104,53 @@ YMODEM Batch Transmission Session (1 file)
     SOH 00 FF NUL[128] CRC CRC              -->
                                             <-- ACK
 
+Protocol state machines
+=======================
+
+The protocol logic is implemented by :class:`XMODEMSender` and
+:class:`XMODEMReceiver`, which do no I/O of their own. They are fed the
+bytes received from the peer, and emit events telling their driver what to
+do next: write bytes, wait for bytes or a timeout, or handle a received
+block. :class:`XMODEM` drives them with blocking ``getc`` and ``putc``
+functions; other drivers can run them from an event loop, or feed them
+input in batches.
+
+.. code-block:: python
+
+    import time
+    from xmodem import (XMODEMReceiver, SendData, NeedData, Purge,
+                        NeedTimeout, BlockReceived, Done)
+
+    protocol = XMODEMReceiver()
+    while True:
+        event = protocol.next_event()
+        if isinstance(event, SendData):
+            protocol.sent(write(event.data))
+        elif isinstance(event, NeedData):
+            data = read(event.size, event.timeout)
+            if data:
+                protocol.receive_data(data)
+            else:
+                protocol.timeout()
+        elif isinstance(event, Purge):
+            # discard input until the line is quiet for event.timeout
+            data = read(1024, event.timeout)
+            while data:
+                data = read(1024, event.timeout)
+            protocol.timeout()
+        elif isinstance(event, NeedTimeout):
+            time.sleep(event.timeout)
+            protocol.timeout()
+        elif isinstance(event, BlockReceived):
+            stream.write(event.data)
+        elif isinstance(event, Done):
+            break
+        # other events, such as EndOfTransmission and Progress, are
+        # informational: they are returned once and need no handling
+
+Every event that is not informational is returned by :meth:`next_event`
+again until it is handled, so a driver must handle all of them.
+
 
 '''
 from __future__ import division, print_function
@@ -114,13 +161,27 @@ __copyright__ = ['Copyright (c) 2010 Wijnand Modderman',
 __license__ = 'MIT'
 __version__ = '0.4.5'
 
-import platform
+import hashlib
+import io
 import logging
+import mmap
+import os
+import queue
 import select
+import stat
+import threading
 import time
 import sys
+from collections import OrderedDict, deque, namedtuple
 from functools import partial
 
+try:
+    from binascii import crc_hqx as _crc_hqx
+except ImportError:  # pragma: no cover
+    _crc_hqx = None
+
+from xmodem.transport import BufferedTransport
+
 # Protocol bytes
 SOH = b'\x01'
 STX = b'\x02'
@@ -131,6 +192,14 @@ NAK = b'\x15'
 CAN = b'\x18'
 CRC = b'C'
 
+#: Packet headers (start byte, sequence and complement), indexed by packet
+#: size and sequence number.
+_SEND_HEADERS = dict(
+    (packet_size, tuple(bytes(bytearray([ord(start), seq, 0xff - seq]))
+                        for seq in range(0x100)))
+    for packet_size, start in ((128, SOH), (1024, STX))
+)
+
 
 class XMODEM(object):
     '''
@@ -160,12 +229,32 @@ class XMODEM(object):
     :param putc: Function to transmit bytes to a stream. The function takes the
         bytes to be written and a timeout in seconds as parameters. It must
         return the number of bytes written to the stream, or ``None`` in case of
-        a timeout.
+        a timeout. Packets are passed as a :class:`memoryview` of a buffer that
+        is reused for the next packet, so ``putc`` should not keep a reference
+        to it after returning.
     :type putc: callable
     :param mode: Either ``xmodem`` or ``xmodem1k``, defaults to ``xmodem``.
     :type mode: string
     :param pad: Padding character to make the packets match the packet size
     :type pad: char
+    :param integrity: Name of the integrity backend used to calculate
+        checksums and CRCs, see :data:`INTEGRITY_BACKENDS`. Defaults to the
+        preferred backend available.
+    :type integrity: str
+    :param getc_into: Optional function to receive data blocks into a buffer
+        instead of using ``getc``. The function takes a writable
+        :class:`memoryview` and a timeout in seconds as parameters, reads up
+        to ``len(buffer)`` bytes into it, and must return the number of bytes
+        read, or ``None`` if a timeout occurred.
+    :type getc_into: callable
+    :param flush_input: Optional function to discard input before a block is
+        NAKed, instead of reading it with ``getc`` one byte at a time until
+        none arrives for the purge timeout of :meth:`recv`. The function
+        takes that quiet interval in seconds as parameter, discards what was
+        received and what arrives until the line stays quiet that long, and
+        returns the number of bytes discarded, see
+        :meth:`xmodem.transport.BufferedTransport.flush_input`.
+    :type flush_input: callable
 
     '''
 
@@ -205,12 +294,19 @@ class XMODEM(object):
         0x6e17, 0x7e36, 0x4e55, 0x5e74, 0x2e93, 0x3eb2, 0x0ed1, 0x1ef0,
     ]
 
-    def __init__(self, getc, putc, mode='xmodem', pad=b'\x1a'):
+    def __init__(self, getc, putc, mode='xmodem', pad=b'\x1a',
+                 integrity=None, getc_into=None, flush_input=None):
         self.getc = getc
         self.putc = putc
+        self.getc_into = getc_into
+        self.flush_input = flush_input
         self.mode = mode
         self.pad = pad
         self.log = logging.getLogger('xmodem.XMODEM')
+        self.integrity = get_integrity_backend(integrity)
+        self._calc_checksum = self.integrity.checksum
+        self._calc_crc = self.integrity.crc
+        self._block = None
 
     def abort(self, count=2, timeout=60):
         '''
@@ -224,7 +320,8 @@ class XMODEM(object):
         for _ in range(count):
             self.putc(CAN, timeout)
 
-    def send(self, stream, retry=16, timeout=60, quiet=False, callback=None):
+    def send(self, stream, retry=16, timeout=60, quiet=False, callback=None,
+             prefetch=0, window=0, adaptive=False, rtt=None):
         '''
         Send a stream via the XMODEM protocol.
 
@@ -235,8 +332,13 @@ class XMODEM(object):
         Returns ``True`` upon successful transmission or ``False`` in case of
         failure.
 
-        :param stream: The stream object to send data from.
-        :type stream: stream (file, etc.)
+        :param stream: The stream object to send data from, or a
+                       :class:`FrameSet` of packets encoded in advance. The
+                       padding and integrity backend of a :class:`FrameSet`
+                       are its own. Regular files, memory maps and paths
+                       are memory mapped and sent from the current position
+                       to the end, after which a stream is positioned.
+        :type stream: stream (file, etc.), mmap, path or FrameSet
         :param retry: The maximum number of times to try to resend a failed
                       packet before failing.
         :type retry: int
@@ -252,217 +354,1288 @@ class XMODEM(object):
                          Expected callback signature:
                          def callback(total_packets, success_count, error_count)
         :type callback: callable
+        :param prefetch: If non-zero, read and encode up to this many packets
+                         ahead in a background thread while waiting for the
+                         receiver to acknowledge the current one. Useful when
+                         reading from ``stream`` is slow.
+        :type prefetch: int
+        :param window: If greater than 1, keep up to this many packets in
+                       flight without waiting for each to be acknowledged,
+                       when the receiver supports it. Like SEAlink, the
+                       receiver then follows each ``ACK`` and ``NAK`` with
+                       the sequence number and its complement, and a ``NAK``
+                       makes the sender go back to the packet named. If the
+                       first packet is acknowledged with a plain ``ACK``,
+                       the transfer goes on with one packet at a time. At
+                       most 127.
+        :type window: int
+        :param adaptive: If ``True``, in ``xmodem1k`` mode, switch to 128
+                         byte packets when more than a quarter of recent
+                         transmissions failed, and back to 1024 byte packets
+                         after a run of 32 without errors. The callback is
+                         then passed the size of the packets as fourth
+                         argument, as for :meth:`recv`. Not for
+                         :class:`FrameSet` and :class:`FrameTable` sources,
+                         nor with ``prefetch``.
+        :type adaptive: bool
+        :param rtt: If given, wait for the ACK of each packet as long as
+                    this :class:`RTTEstimator` tells, from the turnaround
+                    times of earlier packets, rather than ``timeout``
+                    seconds. Not used with ``window``.
+        :type rtt: RTTEstimator
+        '''
+        if adaptive and (prefetch or isinstance(stream,
+                                                (FrameSet, FrameTable))):
+            raise ValueError('adaptive packet sizes need a stream read as '
+                             'it is sent')
+        protocol = XMODEMSender(self.mode, retry=retry, timeout=timeout,
+                                quiet=quiet, window=window, adaptive=adaptive,
+                                rtt=rtt)
+
+        # Packets are encoded into buffers owned by the frame reader, which
+        # are handed to putc() as is, also when a packet is retransmitted.
+        frames = None
+        try:
+            while True:
+                event = protocol.next_event()
+                if isinstance(event, NeedFrame):
+                    if frames is None:
+                        frames = _open_frames(stream, event.packet_size,
+                                              event.crc_mode, self.pad,
+                                              self.integrity, prefetch)
+                    elif adaptive:
+                        frames.resize(event.packet_size)
+                    frame = frames.get()
+                    if frame is None:
+                        frames.close()
+                    protocol.send_frame(frame)
+                elif isinstance(event, Progress):
+                    if not callable(callback):
+                        pass
+                    elif adaptive:
+                        callback(event.total_packets, event.success_count,
+                                 event.error_count, event.packet_size)
+                    else:
+                        callback(event.total_packets, event.success_count,
+                                 event.error_count)
+                elif isinstance(event, Done):
+                    return event.result
+                else:
+                    self._handle_event(protocol, event)
+        finally:
+            if frames is not None:
+                frames.close()
+
+    def recv(self, stream, crc_mode=1, retry=16, timeout=60, delay=1, quiet=0, callback=None,
+             write_behind=0, windowed=False, rtt=None, purge_timeout=1,
+             stats=False):
+        '''
+        Receive a stream via the XMODEM protocol.
+
+            >>> stream = open('/etc/issue', 'wb')
+            >>> print(modem.recv(stream))
+            2342
+
+        Returns the number of bytes received on success or ``None`` in case of
+        failure.
+
+        :param stream: The stream object to write data to. Blocks are written
+                       as :class:`memoryview` objects.
+        :type stream: stream (file, etc.)
+        :param crc_mode: XMODEM CRC mode, 0 is standard checksum, 1 is 16-bit checksum.
+        :type crc_mode: int
+        :param retry: The maximum number of times to try to resend a failed
+                      packet before failing.
+        :type retry: int
+        :param timeout: The number of seconds to wait for a response before
+                        timing out.
+        :type timeout: int
+        :param delay: The number of seconds to wait between resend attempts
+        :type delay: int
+        :param quiet: If ``True``, write transfer information to stderr.
+        :type quiet: bool
+        :param callback: Reference to a callback function that has the
+                         following signature::
+
+                           def callback(total_packets: int, success_count: int, error_count: int, packet_size: int)
+
+                         This is useful for tracking progress state while an xmodem transfer is
+                         underway. As packet size may be negotiated, it also included as the final
+                         argument of the callback. note that the value of error_count resets to 0
+                         after any successful block transfer.
+        :type callback: callable
+        :param write_behind: If non-zero, acknowledge valid blocks right away
+                             and write them to ``stream`` in a background
+                             thread, with up to this many blocks queued. A
+                             failed write aborts the transfer, and the number
+                             of bytes returned is the number written.
+        :type write_behind: int
+        :param windowed: If ``True``, acknowledge blocks with their sequence
+                         numbers, for a sender using ``send(window=n)``.
+                         Only for such senders: others take the sequence
+                         numbers for garbage.
+        :type windowed: bool
+        :param rtt: If given, wait for each block as long as this
+                    :class:`RTTEstimator` tells, from the time earlier
+                    blocks took to arrive after the ACK or NAK, rather than
+                    ``timeout`` seconds. The start sequence still waits
+                    ``timeout`` seconds. Not used with ``windowed``.
+        :type rtt: RTTEstimator
+        :param purge_timeout: The number of seconds without input after
+                              which the line is taken as clear, before a
+                              bad block is NAKed. The default of one second
+                              is what XMODEM specifies; with ``flush_input``,
+                              a few tens of milliseconds may do on links
+                              that do not hold data back.
+        :type purge_timeout: float
+        :param stats: If ``True``, the callback is passed the
+                      :data:`ReceiveStats` of the transfer so far as fifth
+                      argument, such as the number of duplicate blocks
+                      acknowledged and discarded, and of blocks received in
+                      fragments.
+        :type stats: bool
+        '''
+        protocol = XMODEMReceiver(crc_mode=crc_mode, retry=retry,
+                                  timeout=timeout, delay=delay, quiet=quiet,
+                                  integrity=self.integrity, windowed=windowed,
+                                  rtt=rtt, purge_timeout=purge_timeout)
+
+        writer = None
+        try:
+            while True:
+                event = protocol.next_event()
+                if isinstance(event, BlockReceived):
+                    if not write_behind:
+                        stream.write(event.data)
+                        continue
+                    if writer is None:
+                        writer = _BlockWriter(stream, write_behind)
+                    if writer.error is not None:
+                        self.log.error('recv error: write failed, '
+                                       'aborting: %s', writer.error)
+                        protocol.cancel()
+                        continue
+                    # the block may be a view of a buffer reused for the
+                    # next block, so the writer gets a copy
+                    writer.write(bytes(event.data))
+                elif isinstance(event, EndOfTransmission):
+                    # make sure all data is written before the EOT is ACKd
+                    if writer is not None:
+                        writer.close()
+                        if writer.error is not None:
+                            self.log.error('recv error: write failed, '
+                                           'aborting: %s', writer.error)
+                            protocol.cancel()
+                elif isinstance(event, Progress):
+                    if not callable(callback):
+                        pass
+                    elif stats:
+                        callback(event.total_packets, event.success_count,
+                                 event.error_count, event.packet_size,
+                                 protocol.stats)
+                    else:
+                        callback(event.total_packets, event.success_count,
+                                 event.error_count, event.packet_size)
+                elif isinstance(event, Done):
+                    if writer is not None and event.result is not None:
+                        return writer.flushed
+                    return event.result
+                else:
+                    self._handle_event(protocol, event)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def _handle_event(self, protocol, event):
+        '''
+        Handle an I/O event of ``protocol`` with the blocking ``getc`` and
+        ``putc`` functions.
+        '''
+        if isinstance(event, SendData):
+            if event.timeout is None:
+                protocol.sent(self.putc(event.data))
+            else:
+                protocol.sent(self.putc(event.data, event.timeout))
+        elif isinstance(event, NeedData):
+            # read sequence + packet + checksum in a single call
+            #
+            # Reading all expected bytes in one getc() call rather than
+            # multiple separate calls reduces timing issues when
+            # communicating with embedded systems over fast serial lines
+            # without hardware flow control. Multiple reads with separate
+            # timeouts can stack up and cause buffer overruns.
+            #
+            # Many USB serial adapters and ptys return a block in fragments
+            # though, so the rest is read until the timeout of the first read
+            # expires, rather than throwing away a good block.
+            size, timeout = event.size, event.timeout
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while True:
+                data = self._getc_data(size, timeout)
+                if not data:
+                    # an empty read times out too, as with pyserial
+                    protocol.timeout()
+                    return
+                protocol.receive_data(data)
+                size -= len(data)
+                if size <= 0:
+                    return
+                if deadline is not None:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        # getc() gave up waiting for the rest
+                        protocol.timeout()
+                        return
+        elif isinstance(event, Purge):
+            # When the receiver wishes to <nak>, it should call a "PURGE"
+            # subroutine, to wait for the line to clear. Recall the sender
+            # tosses any characters in its UART buffer immediately upon
+            # completing sending a block, to ensure no glitches were mis-
+            # interpreted.  The most common technique is for "PURGE" to
+            # call the character receive subroutine, specifying a 1-second
+            # timeout, and looping back to PURGE until a timeout occurs.
+            # The <nak> is then sent, ensuring the other end will see it.
+            if self.flush_input is not None:
+                protocol.purged(self.flush_input(event.timeout))
+                return
+            while True:
+                data = self.getc(1, timeout=event.timeout)
+                if not data:
+                    break
+                protocol.receive_data(data)
+            protocol.timeout()
+        elif isinstance(event, NeedTimeout):
+            time.sleep(event.timeout)
+            protocol.timeout()
+        else:
+            raise ValueError('Unexpected protocol event: {0!r}'
+                             .format(event))
+
+    def _getc_data(self, size, timeout):
+        '''
+        Read up to ``size`` bytes, into a buffer reused for every block when
+        ``getc_into`` is available, or using ``getc``.
+
+        Returns a :class:`memoryview` of the bytes read if the buffer was
+        used, the bytes read otherwise, or ``None`` if nothing was read
+        before the timeout.
+        '''
+        if size > 1 and self.getc_into is not None:
+            if self._block is None or len(self._block) < size:
+                self._block = memoryview(bytearray(max(size, 2 + 1024 + 2)))
+            size = self.getc_into(self._block[:size], timeout)
+            return self._block[:size] if size else None
+        if timeout is None:
+            return self.getc(size)
+        return self.getc(size, timeout)
+
+    def calc_checksum(self, data, checksum=0):
+        '''
+        Calculate the checksum for a given block of data, can also be used to
+        update a checksum.
+
+            >>> csum = modem.calc_checksum(b'hello')
+            >>> csum = modem.calc_checksum(b'world', csum)
+            >>> hex(csum)
+            '0x3c'
+
+        '''
+        return self._calc_checksum(data, checksum)
+
+    def calc_crc(self, data, crc=0):
+        '''
+        Calculate the Cyclic Redundancy Check for a given block of data, can
+        also be used to update a CRC.
+
+            >>> crc = modem.calc_crc(b'hello')
+            >>> crc = modem.calc_crc(b'world', crc)
+            >>> hex(crc)
+            '0x4ab3'
+
+        The calculation is done by the integrity backend selected when this
+        instance was created.
         '''
+        return self._calc_crc(data, crc)
+
+
+def _make_crc_tables(table, count):
+    '''
+    Derive the tables for a slice-by-``count`` CRC-16 from the byte-wise
+    ``table``. Table ``k`` holds the CRC of a byte followed by ``k`` zero
+    bytes, so ``count`` bytes can be folded into the CRC with one lookup
+    each and no dependency between the lookups.
+    '''
+    tables = [list(table)]
+    for _ in range(count - 1):
+        tables.append([((value << 8) & 0xffff) ^ table[value >> 8]
+                       for value in tables[-1]])
+    return tables
+
+
+_crc_tables = _make_crc_tables(XMODEM.crctable, 4)
+
+
+def _calc_crc_sliced(data, crc=0):
+    '''
+    Pure Python CRC-16 (XMODEM), processing four bytes per step.
+    '''
+    t0, t1, t2, t3 = _crc_tables
+    if isinstance(data, memoryview) and data.format != 'B':
+        data = data.cast('B')
+    crc &= 0xffff
+    tail = len(data) & ~3
+    chars = iter(data)
+    for a, b, c, d in zip(chars, chars, chars, chars):
+        crc = (t3[(crc >> 8) ^ a] ^ t2[(crc & 0xff) ^ b] ^
+               t1[c] ^ t0[d])
+    for char in data[tail:]:
+        crc = ((crc << 8) & 0xffff) ^ t0[(crc >> 8) ^ char]
+    return crc
+
+
+def _calc_checksum(data, checksum=0):
+    '''
+    Arithmetic checksum of ``data``, modulo 256.
+    '''
+    return (sum(data) + checksum) & 0xff
+
+
+def _calc_crc_hqx(data, crc=0):
+    '''
+    CRC-16 (XMODEM) using :func:`binascii.crc_hqx`.
+    '''
+    return _crc_hqx(data, crc & 0xffff)
+
+
+#: Name of an integrity backend, and its checksum and CRC functions. Both
+#: functions take the data and an initial value to update, and return the
+#: updated value.
+IntegrityBackend = namedtuple('IntegrityBackend', ['name', 'checksum', 'crc'])
+
+#: Registered integrity backends by name, in order of preference. The first
+#: entry is used when no backend is requested.
+INTEGRITY_BACKENDS = OrderedDict()
+
+
+def register_integrity_backend(name, checksum, crc, preferred=False):
+    '''
+    Register an integrity backend.
+
+    :param name: Name to select the backend by.
+    :type name: str
+    :param checksum: Function calculating the arithmetic checksum, with the
+        same signature as :meth:`XMODEM.calc_checksum`.
+    :type checksum: callable
+    :param crc: Function calculating the 16-bit CRC, with the same signature
+        as :meth:`XMODEM.calc_crc`.
+    :type crc: callable
+    :param preferred: If ``True``, make this the default backend.
+    :type preferred: bool
+    :returns: The registered backend.
+    :rtype: IntegrityBackend
+    '''
+    backend = IntegrityBackend(name, checksum, crc)
+    INTEGRITY_BACKENDS[name] = backend
+    if preferred:
+        INTEGRITY_BACKENDS.move_to_end(name, last=False)
+    return backend
+
 
-        # initialize protocol
+def get_integrity_backend(name=None):
+    '''
+    Look up an integrity backend by name, or the preferred backend if
+    ``name`` is ``None``.
+
+    :raises ValueError: if no backend is registered by that name.
+    :rtype: IntegrityBackend
+    '''
+    if name is None:
+        return next(iter(INTEGRITY_BACKENDS.values()))
+    try:
+        return INTEGRITY_BACKENDS[name]
+    except KeyError:
+        raise ValueError("Invalid integrity backend specified: {0!r}"
+                         .format(name))
+
+
+def verify_integrity_backends(backends=None):
+    '''
+    Self-test that all integrity backends agree with the pure Python
+    backend, on the standard check value and on blocks of every packet size,
+    both in one go and updated incrementally. Blocks are passed as
+    :class:`bytes`, :class:`bytearray` and :class:`memoryview`, including
+    slices of a larger buffer as :meth:`XMODEM.recv` passes them; a backend
+    raising an error on any of them fails the test.
+
+    :param backends: Names of the backends to verify, defaults to all
+        registered backends.
+    :type backends: list
+    :raises ValueError: naming the backends that disagree.
+    '''
+    reference = INTEGRITY_BACKENDS['python']
+    samples = [b'123456789', b'']
+    for size in (1, 3, 127, 128, 129, 1024, 1027):
+        samples.append(bytes(bytearray((n * 131 + size) & 0xff
+                                       for n in range(size))))
+    failed = []
+    for name in (backends or list(INTEGRITY_BACKENDS)):
+        backend = get_integrity_backend(name)
+        for sample in samples:
+            split = len(sample) // 3
+            # a block in the middle of a reused receive buffer
+            view = memoryview(bytearray(3) + sample + bytearray(2))[3:-2]
+            results = set()
+            for func, ref_func in ((backend.checksum, reference.checksum),
+                                   (backend.crc, reference.crc)):
+                expected = ref_func(sample)
+                try:
+                    results.add(func(sample) == expected)
+                    results.add(func(bytearray(sample)) == expected)
+                    results.add(func(memoryview(sample)) == expected)
+                    results.add(func(view) == expected)
+                    results.add(func(sample[split:],
+                                     func(sample[:split])) == expected)
+                    results.add(func(view[split:],
+                                     func(view[:split])) == expected)
+                except (TypeError, ValueError):
+                    results.add(False)
+            if results != {True}:
+                failed.append(name)
+                break
+    if failed:
+        raise ValueError('Integrity backends disagree with the pure Python '
+                         'implementation: {0}'.format(', '.join(failed)))
+
+
+register_integrity_backend('python', _calc_checksum, _calc_crc_sliced)
+try:
+    import crcmod.predefined
+except ImportError:
+    pass
+else:  # pragma: no cover
+    if getattr(crcmod, '_usingExtension', False):
+        register_integrity_backend(
+            'crcmod', _calc_checksum,
+            crcmod.predefined.mkPredefinedCrcFun('xmodem'), preferred=True)
         try:
-            packet_size = dict(
+            verify_integrity_backends(['crcmod'])
+        except ValueError:
+            # such as a version not taking memoryview blocks
+            del INTEGRITY_BACKENDS['crcmod']
+if _crc_hqx is not None:
+    register_integrity_backend('binascii', _calc_checksum, _calc_crc_hqx,
+                               preferred=True)
+
+
+# Events emitted by the protocol state machines, see XMODEMSender and
+# XMODEMReceiver.
+
+#: Write ``data`` to the peer, then report the number of bytes written with
+#: ``sent()``. A ``timeout`` of ``None`` means the transport's default.
+SendData = namedtuple('SendData', ['data', 'timeout'])
+
+#: Read ``size`` bytes from the peer and pass them to ``receive_data()``, or
+#: call ``timeout()`` if they do not all arrive within ``timeout`` seconds.
+#: A ``timeout`` of ``None`` means the transport's default.
+NeedData = namedtuple('NeedData', ['size', 'timeout'])
+
+#: Discard data from the peer until none arrives for ``timeout`` seconds,
+#: then call ``timeout()``. Data passed to ``receive_data()`` meanwhile is
+#: discarded.
+Purge = namedtuple('Purge', ['timeout'])
+
+#: Call ``timeout()`` after ``timeout`` seconds.
+NeedTimeout = namedtuple('NeedTimeout', ['timeout'])
+
+#: Pass the next encoded packet to ``send_frame()``, or ``None`` at the end
+#: of the stream. ``index`` counts packets from ``0``.
+NeedFrame = namedtuple('NeedFrame', ['index', 'sequence', 'packet_size',
+                                     'crc_mode'])
+
+#: A valid block of data was received. Informational.
+BlockReceived = namedtuple('BlockReceived', ['sequence', 'data'])
+
+#: The sender ended the transmission after ``size`` bytes, which is
+#: acknowledged next, unless the transfer is cancelled. Informational.
+EndOfTransmission = namedtuple('EndOfTransmission', ['size'])
+
+#: Progress of the transfer, as passed to callbacks. Informational.
+Progress = namedtuple('Progress', ['total_packets', 'success_count',
+                                   'error_count', 'packet_size'])
+
+#: The transfer ended with ``result``.
+Done = namedtuple('Done', ['result'])
+
+#: Counters of a receiver, passed to callbacks asking for them.
+#: ``duplicate_count`` is the number of blocks received again after their
+#: ACK was lost, which were acknowledged and discarded, and
+#: ``fragment_count`` the number of reads that returned part of a block.
+ReceiveStats = namedtuple('ReceiveStats', ['duplicate_count',
+                                           'fragment_count'])
+
+
+class RTTEstimator(object):
+    '''
+    Derives how long to wait for the peer from the turnaround times of
+    packets, as TCP does for its retransmission timer (RFC 6298): a smoothed
+    round-trip time and its mean deviation are updated with each sample, and
+    the timeout is the former plus four times the latter, kept between
+    ``floor`` and ``ceiling``. Each timeout doubles it, up to ``ceiling``,
+    until a reply is measured again.
+
+    Pass it as ``rtt`` to :meth:`XMODEM.send` or :meth:`XMODEM.recv`, instead
+    of waiting ``timeout`` seconds for every reply. An estimator holds the
+    state of one transfer.
+
+    :param initial: The number of seconds to wait before any turnaround was
+                    measured.
+    :type initial: float
+    :param floor: The shortest timeout, in seconds.
+    :type floor: float
+    :param ceiling: The longest timeout, in seconds.
+    :type ceiling: float
+    :param clock: A function returning the time in seconds, defaults to
+                  :func:`time.monotonic`.
+    :type clock: callable
+    '''
+
+    #: Gains of the smoothed round-trip time and of its deviation.
+    alpha = 1 / 8
+    beta = 1 / 4
+
+    def __init__(self, initial=3, floor=0.1, ceiling=60, clock=time.monotonic):
+        if not 0 < floor <= ceiling:
+            raise ValueError('floor must be positive and at most ceiling, got '
+                             '{0} and {1}'.format(floor, ceiling))
+        self.floor = floor
+        self.ceiling = ceiling
+        self.clock = clock
+        #: The smoothed round-trip time, ``None`` until measured.
+        self.srtt = None
+        #: The mean deviation of the round-trip time.
+        self.rttvar = None
+        #: The number of seconds to wait for the next reply.
+        self.timeout = min(max(initial, floor), ceiling)
+        self._started = None
+
+    def start(self):
+        '''
+        Start timing a turnaround, once a packet is sent.
+        '''
+        self._started = self.clock()
+
+    def stop(self):
+        '''
+        Stop timing at the reply, and update the estimate with the time
+        taken since :meth:`start`, if any.
+        '''
+        if self._started is not None:
+            self.update(self.clock() - self._started)
+            self._started = None
+
+    def discard(self):
+        '''
+        Stop timing without updating the estimate: a reply to a packet sent
+        more than once may answer any copy of it (Karn's algorithm).
+        '''
+        self._started = None
+
+    def update(self, rtt):
+        '''
+        Update the estimate with a turnaround of ``rtt`` seconds.
+        '''
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += self.beta * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += self.alpha * (rtt - self.srtt)
+        self.timeout = min(max(self.srtt + 4 * self.rttvar, self.floor),
+                           self.ceiling)
+
+    def backoff(self):
+        '''
+        Double the timeout after no reply came in time.
+        '''
+        self._started = None
+        self.timeout = min(self.timeout * 2, self.ceiling)
+
+
+class _Protocol(object):
+    '''
+    Base class of the protocol state machines.
+
+    The protocol logic is written as a generator, that yields events and is
+    sent the result of each event: the number of bytes written for
+    :data:`SendData`, the bytes read (or ``None``) for :data:`NeedData`, the
+    number of bytes purged for :data:`Purge`, and the packet for
+    :data:`NeedFrame`.
+    '''
+
+    _informational = (BlockReceived, EndOfTransmission, Progress)
+
+    def __init__(self, timeout, rtt=None):
+        self.timeout_seconds = timeout
+        #: The :class:`RTTEstimator` timing replies to packets, if any.
+        self.rtt = rtt
+        #: The number of times data passed to :meth:`receive_data` was only
+        #: part of what the pending :data:`NeedData` asks for.
+        self.fragment_count = 0
+        self.log = logging.getLogger('xmodem.XMODEM')
+        self._buffer = bytearray()
+        self._purged = 0
+        self._event = None
+        self._gen = self._events()
+        self._resume(None)
+
+    def _events(self):
+        result = yield from self._run()
+        while True:
+            yield Done(result)
+
+    def _run(self):
+        raise NotImplementedError()
+
+    def _resume(self, value):
+        self._event = self._gen.send(value)
+
+    def _abort(self, count=2, timeout=60):
+        for _ in range(count):
+            yield SendData(CAN, timeout)
+
+    def _reply_timeout(self):
+        # The number of seconds to wait for the peer to answer a packet.
+        if self.rtt is None:
+            return self.timeout_seconds
+        return self.rtt.timeout
+
+    def _replied(self, reply, measure=True):
+        # Feed the outcome of waiting for a reply to the RTT estimator: no
+        # reply backs the timeout off, and a reply is measured unless it may
+        # answer an earlier copy of the packet.
+        if self.rtt is None:
+            return
+        if reply is None:
+            self.rtt.backoff()
+        elif measure:
+            self.rtt.stop()
+        else:
+            self.rtt.discard()
+
+    def _expect(self, kind, method):
+        if not isinstance(self._event, kind):
+            raise RuntimeError('{0}() called while the pending event is {1!r}'
+                               .format(method, self._event))
+
+    @property
+    def done(self):
+        '''
+        ``True`` once the transfer has ended.
+        '''
+        return isinstance(self._event, Done)
+
+    def next_event(self):
+        '''
+        Return the next event to handle.
+
+        The same event is returned until it is handled with the method it
+        names, except for informational events, which are returned once.
+        '''
+        while True:
+            event = self._event
+            if isinstance(event, self._informational):
+                self._resume(None)
+                return event
+            if isinstance(event, NeedData) and len(self._buffer) >= event.size:
+                data = bytes(self._buffer[:event.size])
+                del self._buffer[:event.size]
+                self._resume(data)
+                continue
+            if isinstance(event, Purge) and self._buffer:
+                self._purged += len(self._buffer)
+                del self._buffer[:]
+            return event
+
+    def receive_data(self, data):
+        '''
+        Pass bytes received from the peer. Any number of bytes may be passed,
+        whether or not they are asked for yet.
+        '''
+        if not data:
+            return
+        event = self._event
+        if isinstance(event, Purge):
+            self._purged += len(data)
+        elif (isinstance(event, NeedData) and not self._buffer and
+                len(data) == event.size):
+            # hand over exactly the bytes asked for without copying them
+            self._resume(data)
+        else:
+            self._buffer += data
+            if (isinstance(event, NeedData) and
+                    len(self._buffer) < event.size):
+                self.fragment_count += 1
+
+    def timeout(self):
+        '''
+        Signal that the timeout of the pending :data:`NeedData`,
+        :data:`Purge` or :data:`NeedTimeout` event expired.
+        '''
+        self._expect((NeedData, Purge, NeedTimeout), 'timeout')
+        event = self._event
+        if isinstance(event, NeedData):
+            if len(self._buffer) >= event.size:
+                self.next_event()
+                return
+            # hand over what did arrive, if anything
+            data = bytes(self._buffer) or None
+            del self._buffer[:]
+            self._resume(data)
+        elif isinstance(event, Purge):
+            purged, self._purged = self._purged, 0
+            self._resume(purged)
+        else:
+            self._resume(None)
+
+    def purged(self, count):
+        '''
+        Report the result of handling :data:`Purge` by discarding input
+        until the line stayed quiet for its timeout, rather than passing it
+        to :meth:`receive_data`: the number of bytes discarded.
+        '''
+        self._expect(Purge, 'purged')
+        purged, self._purged = self._purged + (count or 0), 0
+        self._resume(purged)
+
+    def sent(self, count):
+        '''
+        Report the result of handling :data:`SendData`: the number of bytes
+        written, or ``None`` if writing failed.
+        '''
+        self._expect(SendData, 'sent')
+        self._resume(count)
+
+    def cancel(self):
+        '''
+        Cancel the transfer. The next events send the abort sequence, after
+        which the transfer is done with a result of ``None``.
+        '''
+        if self.done:
+            return
+        self._gen.close()
+        self._gen = self._cancelled()
+        self._resume(None)
+
+    def _cancelled(self):
+        yield from self._abort(timeout=self.timeout_seconds)
+        while True:
+            yield Done(None)
+
+
+class XMODEMSender(_Protocol):
+    '''
+    XMODEM sender protocol state machine, doing no I/O of its own.
+
+    Drivers repeatedly call :meth:`next_event` and handle the event returned,
+    until it is :data:`Done`. :class:`XMODEM` is the blocking driver, which
+    is also an example of how to write one.
+
+    :param mode: Either ``xmodem`` or ``xmodem1k``, defaults to ``xmodem``.
+    :type mode: string
+    :param retry: The maximum number of times to try to resend a failed
+                  packet before failing.
+    :type retry: int
+    :param timeout: The number of seconds to wait for a response before
+                    timing out.
+    :type timeout: int
+    :param quiet: If True, write transfer information to stderr.
+    :type quiet: bool
+    :param window: If greater than 1, the number of packets to keep in
+                   flight when the receiver acknowledges with sequence
+                   numbers, see :meth:`XMODEM.send`.
+    :type window: int
+    :param adaptive: If ``True``, switch between 1024 and 128 byte packets
+                     with the rate of errors, see :meth:`XMODEM.send`. Only
+                     for ``xmodem1k`` mode.
+    :type adaptive: bool
+    :param rtt: If given, wait for the ACK of each packet as long as this
+                :class:`RTTEstimator` tells, rather than ``timeout``.
+    :type rtt: RTTEstimator
+    '''
+
+    #: Adaptive packet sizes: the number of recent transmissions looked at,
+    #: the share of them failing above which 128 byte packets are sent, and
+    #: the number of 128 byte packets in a row without errors after which
+    #: 1024 byte packets are sent again.
+    adaptive_history = 16
+    adaptive_error_rate = 0.25
+    adaptive_clean_run = 32
+
+    def __init__(self, mode='xmodem', retry=16, timeout=60, quiet=False,
+                 window=0, adaptive=False, rtt=None):
+        try:
+            self.packet_size = dict(
                 xmodem=128,
                 xmodem1k=1024,
-            )[self.mode]
+            )[mode]
         except KeyError:
-            raise ValueError("Invalid mode specified: {self.mode!r}"
-                             .format(self=self))
+            raise ValueError("Invalid mode specified: {0!r}".format(mode))
+        if not 0 <= window < 0x80:
+            raise ValueError('window must be between 0 and 127, got {0}'
+                             .format(window))
+        if adaptive and mode != 'xmodem1k':
+            raise ValueError('adaptive packet sizes need xmodem1k mode, '
+                             'got {0!r}'.format(mode))
+        self.mode = mode
+        self.adaptive = adaptive
+        # outcomes of recent transmissions, True for failures
+        self._history = deque(maxlen=self.adaptive_history)
+        self._clean_run = 0
+        self.retry = retry
+        self.quiet = quiet
+        self.window = window
+        #: ``True`` once the receiver acknowledged the first packet with its
+        #: sequence number, and the window is in use.
+        self.windowed = False
+        #: The checksum mode requested by the receiver, once known.
+        self.crc_mode = None
+        self.total_packets = 0
+        self.success_count = 0
+        self.error_count = 0
+        super(XMODEMSender, self).__init__(timeout, rtt)
+
+    def send_frame(self, frame):
+        '''
+        Pass the packet asked for by :data:`NeedFrame`, or ``None`` at the
+        end of the stream. The packet is sent again as is if it needs to be
+        retransmitted, so it must not change until the next
+        :data:`NeedFrame`.
+        '''
+        self._expect(NeedFrame, 'send_frame')
+        self._resume(frame)
+
+    def _progress(self):
+        return Progress(self.total_packets, self.success_count,
+                        self.error_count, self.packet_size)
+
+    def _record(self, failed):
+        # Track the outcome of a transmission, for adaptive packet sizes.
+        if self.adaptive:
+            self._history.append(failed)
+            self._clean_run = 0 if failed else self._clean_run + 1
+
+    def _adapt(self):
+        # Pick the size of the next packet: 128 bytes once too many recent
+        # transmissions failed, and 1024 bytes again after a run without
+        # errors. A change is reported with a Progress event.
+        if not self.adaptive:
+            return
+        history = self._history
+        if self.packet_size == 1024:
+            if len(history) < 4 or (sum(history) / len(history) <=
+                                    self.adaptive_error_rate):
+                return
+            self.log.info('send: %d of the last %d transmissions failed, '
+                          'switching to 128 byte packets', sum(history),
+                          len(history))
+            self.packet_size = 128
+        else:
+            if self._clean_run < self.adaptive_clean_run:
+                return
+            self.log.info('send: %d packets without errors, switching to '
+                          '1024 byte packets', self._clean_run)
+            self.packet_size = 1024
+        history.clear()
+        self._clean_run = 0
+        yield self._progress()
+
+    def _run(self):
+        crc_mode = yield from self._start_sequence()
+        if crc_mode is None:
+            return False
+        self.crc_mode = crc_mode
+        if self.window > 1:
+            sent = yield from self._send_window(crc_mode)
+        else:
+            sent = yield from self._send_packets(crc_mode)
+        if not sent:
+            return False
+        if not (yield from self._send_eot()):
+            return False
+        self.log.info('Transmission successful (ACK received).')
+        return True
 
-        self.log.debug('Begin start sequence, packet_size=%d', packet_size)
+    def _start_sequence(self):
+        self.log.debug('Begin start sequence, packet_size=%d',
+                       self.packet_size)
         error_count = 0
-        crc_mode = 0
         cancel = 0
         while True:
-            char = self.getc(1)
+            char = yield NeedData(1, None)
             if char:
                 if char == NAK:
                     self.log.debug('standard checksum requested (NAK).')
-                    crc_mode = 0
-                    break
+                    return 0
                 elif char == CRC:
                     self.log.debug('16-bit CRC requested (CRC).')
-                    crc_mode = 1
-                    break
+                    return 1
                 elif char == CAN:
-                    if not quiet:
+                    if not self.quiet:
                         print('received CAN', file=sys.stderr)
                     if cancel:
                         self.log.info('Transmission canceled: received CAN CAN '
                                       'at start-sequence')
-                        return False
+                        return None
                     else:
                         self.log.debug('received CAN at start of sequence.')
                         cancel = 1
                 elif char == EOT:
                     self.log.info('Transmission canceled: received EOT '
                                   'at start-sequence')
-                    return False
+                    return None
                 else:
+                    crc_mode = self._start_char(char)
+                    if crc_mode is not None:
+                        return crc_mode
                     self.log.error('send error: expected NAK, CRC, EOT or CAN; '
                                    'got %r', char)
 
             error_count += 1
-            if error_count > retry:
+            if error_count > self.retry:
                 self.log.error('send error: error_count reached %d, '
-                               'aborting.', retry)
-                self.abort(timeout=timeout)
-                return False
+                               'aborting.', self.retry)
+                yield from self._abort(timeout=self.timeout_seconds)
+                return None
 
-        # send data
-        error_count = 0
-        success_count = 0
-        total_packets = 0
-        sequence = 1
+    def _start_char(self, char):
+        # Returns the checksum mode requested by a start character other
+        # than NAK or CRC, for protocols that define more of them.
+        return None
+
+    def _send_packets(self, crc_mode, sequence=1):
         while True:
-            data = stream.read(packet_size)
-            if not data:
+            yield from self._adapt()
+            frame = yield NeedFrame(self.total_packets, sequence,
+                                    self.packet_size, crc_mode)
+            if frame is None:
                 # end of stream
                 self.log.debug('send: at EOF')
-                break
-            total_packets += 1
-
-            header = self._make_send_header(packet_size, sequence)
-            data = data.ljust(packet_size, self.pad)
-            checksum = self._make_send_checksum(crc_mode, data)
+                return True
+            self.total_packets += 1
 
             # emit packet
+            attempts = 0
             while True:
                 self.log.debug('send: block %d', sequence)
-                self.putc(header + data + checksum)
-                char = self.getc(1, timeout)
+                yield SendData(frame, None)
+                if self.rtt is not None:
+                    self.rtt.start()
+                attempts += 1
+                char = yield NeedData(1, self._reply_timeout())
+                self._replied(char, attempts == 1)
                 if char == ACK:
-                    success_count += 1
-                    if callable(callback):
-                        callback(total_packets, success_count, error_count)
-                    error_count = 0
+                    self.success_count += 1
+                    self._record(False)
+                    yield self._progress()
+                    self.error_count = 0
                     # keep track of sequence
                     sequence = (sequence + 1) % 0x100
                     break
 
                 self.log.error('send error: expected ACK; got %r for block %d',
                                char, sequence)
-                error_count += 1
-                if callable(callback):
-                    callback(total_packets, success_count, error_count)
-                if error_count > retry:
+                self._record(True)
+                self.error_count += 1
+                yield self._progress()
+                if self.error_count > self.retry:
                     # excessive amounts of retransmissions requested,
                     # abort transfer
                     self.log.error('send error: NAK received %d times, '
-                                   'aborting.', error_count)
-                    self.abort(timeout=timeout)
+                                   'aborting.', self.error_count)
+                    yield from self._abort(timeout=self.timeout_seconds)
+                    return False
+
+    def _send_window(self, crc_mode):
+        # Send the first packet and wait for it to be acknowledged. If the
+        # ACK carries the sequence number and its complement, as in
+        # SEAlink, keep up to ``window`` packets in flight for the rest of
+        # the stream; otherwise go on with stop-and-wait.
+        frame = yield NeedFrame(0, 1, self.packet_size, crc_mode)
+        if frame is None:
+            self.log.debug('send: at EOF')
+            return True
+        self.total_packets += 1
+        while True:
+            self.log.debug('send: block 1')
+            yield SendData(frame, None)
+            char = yield NeedData(1, self.timeout_seconds)
+            if char in (ACK, NAK):
+                # a receiver without the extension sends nothing more until
+                # the next packet, so wait for the sequence number briefly
+                reply = yield NeedData(2, min(1, self.timeout_seconds))
+                self.windowed = reply == b'\x01\xfe'
+                if char == ACK:
+                    break
+            self.log.error('send error: expected ACK; got %r for block 1',
+                           char)
+            self._record(True)
+            self.error_count += 1
+            yield self._progress()
+            if self.error_count > self.retry:
+                self.log.error('send error: NAK received %d times, '
+                               'aborting.', self.error_count)
+                yield from self._abort(timeout=self.timeout_seconds)
+                return False
+        self.success_count += 1
+        self._record(False)
+        self.error_count = 0
+        yield self._progress()
+        if not self.windowed:
+            self.log.info('Receiver does not acknowledge with sequence '
+                          'numbers, using stop-and-wait.')
+            return (yield from self._send_packets(crc_mode, sequence=2))
+
+        self.log.debug('send: window of %d packets', self.window)
+        # packets sent and not acknowledged yet, from index ``base``
+        frames = deque()
+        base = index = 1
+        eof = False
+        cancel = 0
+        while True:
+            while not eof and index - base < self.window:
+                yield from self._adapt()
+                frame = yield NeedFrame(index, (index + 1) % 0x100,
+                                        self.packet_size, crc_mode)
+                if frame is None:
+                    self.log.debug('send: at EOF')
+                    eof = True
+                    break
+                if not isinstance(frame, bytes) and not (
+                        isinstance(frame, memoryview) and frame.readonly):
+                    # the reader may reuse its buffer for the next packet
+                    frame = bytes(frame)
+                frames.append(frame)
+                self.total_packets += 1
+                self.log.debug('send: block %d', (index + 1) % 0x100)
+                yield SendData(frame, None)
+                index += 1
+            if base == index:
+                return True
+
+            # take replies as they come while there is room to send more
+            wait = 0 if not eof and index - base < self.window else (
+                self.timeout_seconds)
+            char = yield NeedData(1, wait)
+            retransmit = None
+            if char is None:
+                if not wait:
+                    continue
+                self.log.error('send error: no reply for block %d',
+                               (base + 1) % 0x100)
+                retransmit = base
+            elif char in (ACK, NAK):
+                reply = yield NeedData(2, self.timeout_seconds)
+                if reply is None or len(reply) != 2 or (
+                        reply[0] != 0xff - reply[1]):
+                    self.log.warning('send: bad sequence number after %r: '
+                                     '%r', char, reply)
+                    continue
+                # the packet of the window with that sequence number
+                acked = base + (reply[0] - base - 1) % 0x100
+                if acked >= index:
+                    self.log.debug('send: ignoring %r for block %d', char,
+                                   reply[0])
+                    continue
+                if char == ACK:
+                    acked += 1
+                else:
+                    self.log.error('send error: NAK for block %d', reply[0])
+                    retransmit = acked
+                # everything before the packet asked for was received
+                self.success_count += acked - base
+                for _ in range(acked - base):
+                    frames.popleft()
+                    self._record(False)
+                base = acked
+                if retransmit is None:
+                    cancel = 0
+                    self.error_count = 0
+                    yield self._progress()
+                    continue
+            elif char == CAN:
+                if cancel:
+                    self.log.info('Transmission canceled: received 2xCAN '
+                                  'at block %d', (base + 1) % 0x100)
                     return False
+                cancel = 1
+                continue
+            else:
+                self.log.warning('send: ignoring %r', char)
+                continue
 
+            self._record(True)
+            self.error_count += 1
+            yield self._progress()
+            if self.error_count > self.retry:
+                self.log.error('send error: NAK received %d times, '
+                               'aborting.', self.error_count)
+                yield from self._abort(timeout=self.timeout_seconds)
+                return False
+            # go back to the first packet not received
+            for offset, frame in enumerate(frames):
+                self.log.debug('send: block %d again',
+                               (retransmit + offset + 1) % 0x100)
+                yield SendData(frame, None)
+
+    def _send_eot(self):
         while True:
             self.log.debug('sending EOT, awaiting ACK')
             # end of transmission
-            self.putc(EOT)
+            yield SendData(EOT, None)
 
             # An ACK should be returned
-            char = self.getc(1, timeout)
+            char = yield NeedData(1, self.timeout_seconds)
             if char == ACK:
-                break
+                return True
             else:
                 self.log.error('send error: expected ACK; got %r', char)
-                error_count += 1
-                if callback:
-                    callback(total_packets, success_count, error_count)
-                if error_count > retry:
+                self.error_count += 1
+                yield self._progress()
+                if self.error_count > self.retry:
                     self.log.warning('EOT was not ACKd, aborting transfer')
-                    self.abort(timeout=timeout)
+                    yield from self._abort(timeout=self.timeout_seconds)
                     return False
 
-        self.log.info('Transmission successful (ACK received).')
-        return True
 
-    def _make_send_header(self, packet_size, sequence):
-        assert packet_size in (128, 1024), packet_size
-        _bytes = []
-        if packet_size == 128:
-            _bytes.append(ord(SOH))
-        elif packet_size == 1024:
-            _bytes.append(ord(STX))
-        _bytes.extend([sequence, 0xff - sequence])
-        return bytearray(_bytes)
-
-    def _make_send_checksum(self, crc_mode, data):
-        _bytes = []
-        if crc_mode:
-            crc = self.calc_crc(data)
-            _bytes.extend([crc >> 8, crc & 0xff])
-        else:
-            crc = self.calc_checksum(data)
-            _bytes.append(crc)
-        return bytearray(_bytes)
+class XMODEMReceiver(_Protocol):
+    '''
+    XMODEM receiver protocol state machine, doing no I/O of its own.
+
+    Drivers repeatedly call :meth:`next_event` and handle the event returned,
+    until it is :data:`Done`, with the number of bytes received as result, or
+    ``None`` if the transfer failed. :class:`XMODEM` is the blocking driver.
+
+    :param crc_mode: XMODEM CRC mode, 0 is standard checksum, 1 is 16-bit checksum.
+    :type crc_mode: int
+    :param retry: The maximum number of times to try to resend a failed
+                  packet before failing.
+    :type retry: int
+    :param timeout: The number of seconds to wait for a response before
+                    timing out.
+    :type timeout: int
+    :param delay: The number of seconds to wait between resend attempts
+    :type delay: int
+    :param quiet: If ``True``, write transfer information to stderr.
+    :type quiet: bool
+    :param integrity: The integrity backend, or its name, used to verify
+        checksums and CRCs.
+    :type integrity: IntegrityBackend or str
+    :param windowed: If ``True``, acknowledge blocks with their sequence
+        numbers, so a sender can keep several in flight, see
+        :meth:`XMODEM.recv`.
+    :type windowed: bool
+    :param rtt: If given, wait for each block as long as this
+        :class:`RTTEstimator` tells, rather than ``timeout``.
+    :type rtt: RTTEstimator
+    :param purge_timeout: The number of seconds without input after which
+        the line is taken as clear, before a bad block is NAKed.
+    :type purge_timeout: float
+    '''
 
-    def recv(self, stream, crc_mode=1, retry=16, timeout=60, delay=1, quiet=0, callback=None):
+    #: If ``True``, blocks are not acknowledged, and the transfer is aborted
+    #: at the first error rather than asking for a retransmission.
+    streaming = False
+
+    def __init__(self, crc_mode=1, retry=16, timeout=60, delay=1, quiet=0,
+                 integrity=None, windowed=False, rtt=None, purge_timeout=1):
+        if not isinstance(integrity, IntegrityBackend):
+            integrity = get_integrity_backend(integrity)
+        self.crc_mode = crc_mode
+        self.retry = retry
+        self.windowed = windowed
+        self.purge_timeout = purge_timeout
+        self.delay = delay
+        self.quiet = quiet
+        self._calc_checksum = integrity.checksum
+        self._calc_crc = integrity.crc
+        self.packet_size = 128
+        self.total_packets = 0
+        self.success_count = 0
+        self.error_count = 0
+        self.duplicate_count = 0
+        self.income_size = 0
+        super(XMODEMReceiver, self).__init__(timeout, rtt)
+
+    def _progress(self):
+        return Progress(self.total_packets, self.success_count,
+                        self.error_count, self.packet_size)
+
+    @property
+    def stats(self):
         '''
-        Receive a stream via the XMODEM protocol.
-
-            >>> stream = open('/etc/issue', 'wb')
-            >>> print(modem.recv(stream))
-            2342
-
-        Returns the number of bytes received on success or ``None`` in case of
-        failure.
-
-        :param stream: The stream object to write data to.
-        :type stream: stream (file, etc.)
-        :param crc_mode: XMODEM CRC mode, 0 is standard checksum, 1 is 16-bit checksum.
-        :type crc_mode: int
-        :param retry: The maximum number of times to try to resend a failed
-                      packet before failing.
-        :type retry: int
-        :param timeout: The number of seconds to wait for a response before
-                        timing out.
-        :type timeout: int
-        :param delay: The number of seconds to wait between resend attempts
-        :type delay: int
-        :param quiet: If ``True``, write transfer information to stderr.
-        :type quiet: bool
-        :param callback: Reference to a callback function that has the
-                         following signature::
-
-                           def callback(total_packets: int, success_count: int, error_count: int, packet_size: int)
-
-                         This is useful for tracking progress state while an xmodem transfer is
-                         underway. As packet size may be negotiated, it also included as the final
-                         argument of the callback. note that the value of error_count resets to 0
-                         after any successful block transfer.
-        :type callback: callable
+        The :data:`ReceiveStats` of the transfer so far.
         '''
-
-        # initiate protocol
+        return ReceiveStats(self.duplicate_count, self.fragment_count)
+
+    def _reply_timeout(self):
+        # Only blocks answering an ACK or NAK are timed: windowed and
+        # streaming senders do not wait for either.
+        if self.windowed or self.streaming:
+            return self.timeout_seconds
+        return super(XMODEMReceiver, self)._reply_timeout()
+
+    def _acknowledge(self, char):
+        # Answer a block in stop-and-wait mode, timing the next one.
+        yield SendData(char, None)
+        if self.rtt is not None:
+            self.rtt.start()
+
+    def _run(self):
+        char = yield from self._start_sequence()
+        if char in (None, 0):
+            return char
+        return (yield from self._recv_packets(char))
+
+    def _start_sequence(self):
+        # Returns the first start-of-header byte, None if the transfer was
+        # cancelled, or 0 for an empty file.
+        crc_mode = self.crc_mode
         error_count = 0
         cancel = 0
         empty = 0
         while True:
             # first try CRC mode, if this fails,
             # fall back to checksum mode
-            if error_count >= retry:
-                self.log.error('error_count reached %d, aborting.', retry)
-                self.abort(timeout=timeout)
+            if error_count >= self.retry:
+                self.log.error('error_count reached %d, aborting.', self.retry)
+                yield from self._abort(timeout=self.timeout_seconds)
                 return None
-            elif crc_mode and error_count < (retry // 2):
-                if not self.putc(CRC):
+            elif crc_mode and error_count < (self.retry // 2):
+                if not (yield SendData(CRC, None)):
                     self.log.warning('recv error: putc failed, '
-                                     'sleeping for %d', delay)
-                    time.sleep(delay)
+                                     'sleeping for %d', self.delay)
+                    yield NeedTimeout(self.delay)
                     error_count += 1
             else:
                 crc_mode = 0
-                if not self.putc(NAK):
+                if not (yield SendData(NAK, None)):
                     self.log.warning('recv error: putc failed, '
-                                     'sleeping for %d', delay)
-                    time.sleep(delay)
+                                     'sleeping for %d', self.delay)
+                    yield NeedTimeout(self.delay)
                     error_count += 1
+            self.crc_mode = crc_mode
 
-            char = self.getc(1, timeout)
+            char = yield NeedData(1, self.timeout_seconds)
             if char is None:
                 self.log.warning('recv error: getc timeout in start sequence')
                 error_count += 1
                 continue
             elif char == SOH:
                 self.log.debug('recv: SOH')
-                break
+                return char
             elif char == STX:
                 self.log.debug('recv: STX')
-                break
+                return char
             elif char == CAN:
                 if cancel:
                     self.log.info('Transmission canceled: received 2xCAN '
@@ -474,51 +1647,46 @@ class XMODEM(object):
             elif char == EOT:
                 if empty:
                     self.log.info('transmission canceled: file empty')
-                    self.putc(CAN)
-                    self.putc(CAN)
+                    yield SendData(CAN, None)
+                    yield SendData(CAN, None)
                     # 'purge' any remaining data on the line
-                    while True:
-                        if self.getc(1, timeout=1) is None:
-                            break
-                        time.sleep(.001)  # better cpu usage
+                    yield Purge(self.purge_timeout)
                     return 0
                 else:
                     self.log.debug('first eot received ')
                     empty = 1
             else:
                 error_count += 1
-                if callable(callback):
-                    callback(0, 0, error_count, 128)
+                self.error_count = error_count
+                yield Progress(0, 0, error_count, 128)
 
-        # read data
-        error_count = 0
-        income_size = 0
-        packet_size = 128
+    def _recv_packets(self, char):
+        crc_mode = self.crc_mode
+        self.error_count = 0
         sequence = 1
         cancel = 0
-        total_packets = 0
-        success_count = 0
+        nak_sent = False
         while True:
             while True:
                 if char == SOH:
-                    if packet_size != 128:
+                    if self.packet_size != 128:
                         self.log.debug('recv: SOH, using 128b packet_size')
-                        packet_size = 128
+                        self.packet_size = 128
                     break
                 elif char == STX:
-                    if packet_size != 1024:
+                    if self.packet_size != 1024:
                         self.log.debug('recv: SOH, using 1k packet_size')
-                        packet_size = 1024
+                        self.packet_size = 1024
                     break
                 elif char == EOT:
                     # We received an EOT, so send an ACK and return the
                     # received data length.
-                    self.putc(ACK)
+                    yield EndOfTransmission(self.income_size)
+                    yield SendData(ACK, None)
                     self.log.info("Transmission complete, %d bytes",
-                                  income_size)
-                    if callable(callback):
-                        callback(total_packets, success_count, error_count, packet_size)
-                    return income_size
+                                  self.income_size)
+                    yield self._progress()
+                    return self.income_size
                 elif char == CAN:
                     # cancel at two consecutive cancels
                     if cancel:
@@ -528,54 +1696,85 @@ class XMODEM(object):
                     else:
                         self.log.debug('cancellation at block %d', sequence)
                         cancel = 1
-                        char = self.getc(1, timeout)
+                        char = yield NeedData(1, self.timeout_seconds)
                         continue
+                elif self.windowed and char is not None:
+                    # the rest of a block we are not in step with, or
+                    # noise: skip to the next start-of-header byte
+                    char = yield NeedData(1, self.timeout_seconds)
+                    continue
+                elif self.windowed:
+                    self.log.warning('recv error: timeout waiting for block '
+                                     '%d', sequence)
+                    self.error_count += 1
+                    yield self._progress()
+                    if self.error_count > self.retry:
+                        self.log.info('error_count reached %d, aborting.',
+                                      self.retry)
+                        yield from self._abort()
+                        return None
+                    yield SendData(NAK + bytes([sequence, 0xff - sequence]),
+                                   None)
+                    nak_sent = True
+                    char = yield NeedData(1, self.timeout_seconds)
+                    continue
                 else:
                     err_msg = ('recv error: expected SOH, EOT; '
                                'got {0!r}'.format(char))
-                    if not quiet:
+                    if not self.quiet:
                         print(err_msg, file=sys.stderr)
                     self.log.warning(err_msg)
-                    error_count += 1
-                    if callable(callback):
-                        callback(total_packets, success_count, error_count, packet_size)
-                    if error_count > retry:
+                    self.error_count += 1
+                    yield self._progress()
+                    if self.error_count > self.retry:
                         self.log.info('error_count reached %d, aborting.',
-                                      retry)
-                        self.abort()
+                                      self.retry)
+                        yield from self._abort()
                         return None
                     # break to purge and NAK, rather than sleeping for
                     # the full timeout which causes problems with
                     # embedded systems
                     break
 
-            # read sequence + packet + checksum in a single call
-            #
-            # Reading all expected bytes in one getc() call rather than
-            # multiple separate calls reduces timing issues when
-            # communicating with embedded systems over fast serial lines
-            # without hardware flow control. Multiple reads with separate
-            # timeouts can stack up and cause buffer overruns.
+            # read sequence + packet + checksum at once
+            packet_size = self.packet_size
             cancel = 0
             seq1 = None
             seq2 = None
             self.log.debug('recv: data block %d', sequence)
-            data = self.getc(2 + packet_size + 1 + crc_mode, timeout)
+            data = yield NeedData(2 + packet_size + 1 + crc_mode,
+                                  self._reply_timeout())
             if data is not None and len(data) >= 2:
-                seq1 = ord(data[0:1])
-                seq2 = 0xff - ord(data[1:2])
-                data = data[2:]
+                seq1 = data[0]
+                seq2 = 0xff - data[1]
+                # decode the block through a memoryview, so the payload is
+                # not copied before it is written
+                data = memoryview(data)[2:]
                 if len(data) != (packet_size + 1 + crc_mode):
                     self.log.warning('recv: expected %d data bytes, got %d',
                                      packet_size + 1 + crc_mode, len(data))
                     data = None
             elif data is not None and len(data) == 1:
-                seq1 = ord(data[0:1])
+                seq1 = data[0]
                 self.log.warning('getc failed to get second sequence byte')
                 data = None
             else:
                 self.log.warning('getc failed to get first sequence byte')
                 data = None
+            self._replied(data, seq1 == sequence)
+
+            if (data is not None and self.success_count and
+                    not (self.windowed or self.streaming) and
+                    seq1 == seq2 == (sequence - 1) % 0x100):
+                # the sender did not get our ACK of the previous block and
+                # sent it again: acknowledge and discard it, rather than
+                # asking for it once more with a NAK
+                self.log.warning('recv: block %d again, discarded', seq1)
+                self.duplicate_count += 1
+                yield self._progress()
+                yield from self._acknowledge(ACK)
+                char = yield NeedData(1, self._reply_timeout())
+                continue
 
             if not (seq1 == seq2 == sequence):
                 # data was already consumed by the batched read above;
@@ -590,63 +1789,81 @@ class XMODEM(object):
 
                 # valid data, append chunk
                 if valid:
-                    total_packets += 1
-                    success_count += 1
-                    error_count = 0
-                    if callable(callback):
-                        callback(total_packets, success_count, error_count, packet_size)
-                    income_size += len(data)
-                    stream.write(data)
-                    self.putc(ACK)
+                    self.total_packets += 1
+                    self.success_count += 1
+                    self.error_count = 0
+                    yield self._progress()
+                    self.income_size += len(data)
+                    yield BlockReceived(sequence, data)
+                    if self.windowed:
+                        yield SendData(ACK + bytes([sequence,
+                                                    0xff - sequence]), None)
+                        nak_sent = False
+                    elif not self.streaming:
+                        yield from self._acknowledge(ACK)
                     sequence = (sequence + 1) % 0x100
                     # get next start-of-header byte
-                    char = self.getc(1, timeout)
+                    char = yield NeedData(1, self._reply_timeout())
                     continue
 
+            if self.windowed:
+                if seq1 is not None and seq1 == seq2 and (
+                        0 < (sequence - seq1) % 0x100 < 0x80):
+                    # sent again before our ACK got there; acknowledge
+                    # everything received so far
+                    self.log.debug('recv: block %d again', seq1)
+                    self.duplicate_count += 1
+                    last = (sequence - 1) % 0x100
+                    yield SendData(ACK + bytes([last, 0xff - last]), None)
+                elif not nak_sent:
+                    # later blocks in flight are discarded until the
+                    # sender goes back to this one
+                    self.error_count += 1
+                    yield self._progress()
+                    if self.error_count > self.retry:
+                        self.log.info('error_count reached %d, aborting.',
+                                      self.retry)
+                        yield from self._abort()
+                        return None
+                    yield SendData(NAK + bytes([sequence, 0xff - sequence]),
+                                   None)
+                    nak_sent = True
+                char = yield NeedData(1, self.timeout_seconds)
+                continue
+
+            if self.streaming:
+                self.log.error('recv error: block %d lost while streaming, '
+                               'aborting.', sequence)
+                yield from self._abort(timeout=self.timeout_seconds)
+                return None
+
             # something went wrong, request retransmission
             self.log.warning('recv error: purge, requesting retransmission (NAK)')
-            n_purged = 0
-            while True:
-                # When the receiver wishes to <nak>, it should call a "PURGE"
-                # subroutine, to wait for the line to clear. Recall the sender
-                # tosses any characters in its UART buffer immediately upon
-                # completing sending a block, to ensure no glitches were mis-
-                # interpreted.  The most common technique is for "PURGE" to
-                # call the character receive subroutine, specifying a 1-second
-                # timeout, and looping back to PURGE until a timeout occurs.
-                # The <nak> is then sent, ensuring the other end will see it.
-                data = self.getc(1, timeout=1)
-                if data is None:
-                    break
-                n_purged = len(data)
+            n_purged = yield Purge(self.purge_timeout)
             if n_purged:
                 self.log.warning('%d bytes purged from receiver', n_purged)
-            error_count += 1
-            if callable(callback):
-                callback(total_packets, success_count, error_count, packet_size)
-            self.putc(NAK)
+            self.error_count += 1
+            yield self._progress()
+            yield from self._acknowledge(NAK)
             # get next start-of-header byte
-            char = self.getc(1, timeout)
-            continue
+            char = yield NeedData(1, self._reply_timeout())
 
     def _verify_recv_checksum(self, crc_mode, data):
         if crc_mode:
-            _checksum = bytearray(data[-2:])
-            their_sum = (_checksum[0] << 8) + _checksum[1]
+            their_sum = (data[-2] << 8) + data[-1]
             data = data[:-2]
 
-            our_sum = self.calc_crc(data)
+            our_sum = self._calc_crc(data)
             valid = bool(their_sum == our_sum)
             if not valid:
                 self.log.warning('recv error: checksum fail '
                                  '(theirs=%04x, ours=%04x), ',
                                  their_sum, our_sum)
         else:
-            _checksum = bytearray([data[-1]])
-            their_sum = _checksum[0]
+            their_sum = data[-1]
             data = data[:-1]
 
-            our_sum = self.calc_checksum(data)
+            our_sum = self._calc_checksum(data)
             valid = their_sum == our_sum
             if not valid:
                 self.log.warning('recv error: checksum fail '
@@ -654,37 +1871,505 @@ class XMODEM(object):
                                  their_sum, our_sum)
         return valid, data
 
-    def calc_checksum(self, data, checksum=0):
+
+class FrameTable(object):
+    '''
+    Immutable table of the encoded packets of a stream, for one packet size
+    and checksum type. Packets are served as read-only views of one buffer,
+    so a table can be shared by any number of concurrent transfers.
+
+    :param data: Buffer holding the encoded packets back to back.
+    :type data: bytes
+    :param packet_size: Size of the packet payload, 128 or 1024.
+    :type packet_size: int
+    :param crc_mode: 1 for packets with a CRC, 0 for a checksum.
+    :type crc_mode: int
+    :param size: Size of the stream the packets were encoded from.
+    :type size: int
+    '''
+
+    def __init__(self, data, packet_size, crc_mode, size):
+        self.packet_size = packet_size
+        self.crc_mode = crc_mode
+        self.size = size
+        self.frame_size = 3 + packet_size + 1 + crc_mode
+        self._data = memoryview(data)
+        if len(self._data) % self.frame_size:
+            raise ValueError('Buffer of {0} bytes does not hold packets of {1} '
+                             'bytes'.format(len(self._data), self.frame_size))
+
+    @classmethod
+    def encode(cls, data, packet_size, crc_mode, pad=b'\x1a', integrity=None,
+               workers=0):
         '''
-        Calculate the checksum for a given block of data, can also be used to
-        update a checksum.
+        Encode the packets of ``data`` into a new table.
+
+        :param data: The bytes to encode.
+        :type data: bytes
+        :param integrity: Name of the integrity backend, as for
+            :class:`XMODEM`.
+        :type integrity: str
+        :param workers: If non-zero, encode ranges of packets in this many
+            processes with a :class:`concurrent.futures.ProcessPoolExecutor`.
+            The processes look up the integrity backend by name. Each range
+            is copied to a worker and its packets back, which costs about as
+            much as encoding them with the ``binascii`` backend: the pool
+            only helps with the pure Python backend, on images of many
+            megabytes and with as many free cores.
+        :type workers: int
+        '''
+        if isinstance(integrity, IntegrityBackend):
+            backend = integrity
+        else:
+            backend = get_integrity_backend(integrity)
+        if not workers:
+            frames = _encode_frames(data, packet_size, crc_mode, pad, backend)
+            return cls(frames, packet_size, crc_mode, len(data))
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        # split the packets in a few ranges per worker, so the ranges
+        # finishing last do not leave the other workers idle for long
+        count = -(-len(data) // packet_size)
+        step = max(-(-count // (workers * 4)), 64) * packet_size
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [executor.submit(_encode_frames,
+                                       bytes(data[offset:offset + step]),
+                                       packet_size, crc_mode, pad,
+                                       backend.name, offset // packet_size)
+                       for offset in range(0, len(data), step)]
+            frames = b''.join(future.result() for future in futures)
+        return cls(frames, packet_size, crc_mode, len(data))
+
+    def __len__(self):
+        return len(self._data) // self.frame_size
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError('packet index out of range')
+        offset = index * self.frame_size
+        return self._data[offset:offset + self.frame_size]
+
+
+def _encode_frames(data, packet_size, crc_mode, pad, integrity, first=0):
+    '''
+    Return the encoded packets of ``data`` back to back, numbered as if the
+    first one is packet ``first`` of the stream.
+    '''
+    if not isinstance(integrity, IntegrityBackend):
+        integrity = get_integrity_backend(integrity)
+    count = -(-len(data) // packet_size)
+    frame_size = 3 + packet_size + 1 + crc_mode
+    reader = _FrameReader(io.BytesIO(data), packet_size, crc_mode, pad,
+                          integrity)
+    buffer = bytearray(count * frame_size)
+    view = memoryview(buffer)
+    for index in range(count):
+        reader._fill(view[index * frame_size:(index + 1) * frame_size],
+                     (first + index + 1) % 0x100)
+    view.release()
+    return bytes(buffer)
+
+
+class FrameSet(object):
+    '''
+    The packets of one image, encoded once per packet size and checksum type
+    on first use and shared by every transfer sending it.
 
-            >>> csum = modem.calc_checksum(b'hello')
-            >>> csum = modem.calc_checksum(b'world', csum)
-            >>> hex(csum)
-            '0x3c'
+    Pass it to :meth:`XMODEM.send` instead of a stream, to send the same
+    image to many receivers without encoding it again for each of them. The
+    receivers still choose between checksum and CRC mode independently.
+
+    .. code-block:: python
+
+        frames = FrameSet(open('firmware.bin', 'rb').read())
+        for modem in modems:
+            modem.send(frames)
 
+    :param data: The image to send, as bytes or a stream to read it from.
+    :type data: bytes or stream
+    :param pad: Padding character to make the packets match the packet size
+    :type pad: char
+    :param integrity: Name of the integrity backend, as for :class:`XMODEM`.
+    :type integrity: str
+    :param workers: Number of processes encoding each table, see
+        :meth:`FrameTable.encode`.
+    :type workers: int
+    :param cache: Cache to look up tables in and add them to.
+    :type cache: xmodem.cache.FrameCache
+    '''
+
+    def __init__(self, data, pad=b'\x1a', integrity=None, workers=0,
+                 cache=None):
+        if hasattr(data, 'read'):
+            data = data.read()
+        self.data = bytes(data)
+        self.pad = pad
+        self.integrity = get_integrity_backend(integrity)
+        self.workers = workers
+        self.cache = cache
+        self._digest = None
+        self.tables = {}
+        # kept alive for the tables, see from_tables(); set after them, so
+        # it is released after them
+        self._owner = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_tables(cls, tables, owner=None):
         '''
-        if platform.python_version_tuple() >= ('3', '0', '0'):
-            return (sum(data) + checksum) % 256
+        Return a frame set of tables encoded already, without the image they
+        were encoded from. Only those tables can be sent.
+
+        :param tables: The tables of one image.
+        :type tables: list of FrameTable
+        :param owner: An object to keep alive as long as the frame set, such
+            as the owner of the buffer the tables are views of. It is
+            released after the tables.
+        :type owner: object
+        '''
+        frames = cls(b'')
+        frames.data = None
+        for table in tables:
+            frames.tables[(table.packet_size, table.crc_mode)] = table
+        frames._owner = owner
+        return frames
+
+    def table(self, packet_size, crc_mode):
+        '''
+        Return the :class:`FrameTable` for ``packet_size`` and ``crc_mode``,
+        encoding it first if needed.
+        '''
+        key = (packet_size, crc_mode)
+        with self._lock:
+            table = self.tables.get(key)
+            if table is None and self.data is None:
+                raise ValueError('No table of {0} byte packets with crc_mode '
+                                 '{1} in this frame set'.format(packet_size,
+                                                                crc_mode))
+            elif table is None and self.cache is not None:
+                if self._digest is None:
+                    self._digest = hashlib.sha256(self.data).hexdigest()
+                table = self.tables[key] = self.cache.table(
+                    self.data, packet_size, crc_mode, self.pad,
+                    self.integrity, self.workers, self._digest)
+            elif table is None:
+                table = self.tables[key] = FrameTable.encode(
+                    self.data, packet_size, crc_mode, self.pad,
+                    self.integrity, self.workers)
+            return table
+
+
+def _open_frames(stream, packet_size, crc_mode, pad, integrity, prefetch=0):
+    '''
+    Return a frame reader encoding the packets of ``stream``, reading
+    ``prefetch`` packets ahead in a background thread if non-zero.
+    '''
+    if isinstance(stream, FrameSet):
+        return _TableReader(stream.table(packet_size, crc_mode))
+    if isinstance(stream, FrameTable):
+        if (stream.packet_size, stream.crc_mode) != (packet_size, crc_mode):
+            raise ValueError('Frame table of {0} byte packets with crc_mode '
+                             '{1} does not match {2} byte packets with '
+                             'crc_mode {3}'.format(
+                                 stream.packet_size, stream.crc_mode,
+                                 packet_size, crc_mode))
+        return _TableReader(stream)
+    mapped = _map_source(stream)
+    if mapped is not None:
+        return _MappedFrameReader(stream, packet_size, crc_mode, pad,
+                                  integrity, *mapped)
+    if prefetch:
+        return _FramePrefetcher(stream, packet_size, crc_mode, pad,
+                                integrity, prefetch)
+    return _FrameReader(stream, packet_size, crc_mode, pad, integrity)
+
+
+def _is_file(stream):
+    '''
+    Return whether ``stream`` reads the bytes of its file descriptor as they
+    are: an :class:`io.FileIO`, or a buffered reader of one. Streams such as
+    :class:`gzip.GzipFile` also have the descriptor of a regular file, of
+    which they decode the contents.
+    '''
+    if isinstance(stream, (io.BufferedReader, io.BufferedRandom)):
+        stream = stream.raw
+    return isinstance(stream, io.FileIO)
+
+
+def _map_source(stream):
+    '''
+    Return a memory map of ``stream``, the offset to start sending from and
+    whether the map is ours to close, if ``stream`` is a path, a memory map
+    or a regular file, see :func:`_is_file`. Return ``None`` for other
+    streams.
+    '''
+    if isinstance(stream, mmap.mmap):
+        return stream, stream.tell(), False
+    if isinstance(stream, (str, os.PathLike)):
+        with open(stream, 'rb') as handle:
+            if not os.fstat(handle.fileno()).st_size:
+                return memoryview(b''), 0, False
+            return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ), \
+                0, True
+    if not _is_file(stream):
+        return None
+    try:
+        fileno = stream.fileno()
+        if not stat.S_ISREG(os.fstat(fileno).st_mode):
+            return None
+        offset = stream.tell()
+        if os.fstat(fileno).st_size <= offset:
+            return None
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ), offset, True
+    except (AttributeError, OSError, ValueError):
+        # not a file, or one that can not be mapped
+        return None
+
+
+class _FrameReader(object):
+    '''
+    Reads and encodes the packets of a stream in order, into a single buffer
+    that is reused for every packet.
+    '''
+
+    def __init__(self, stream, packet_size, crc_mode, pad, integrity):
+        self._stream = stream
+        self._packet_size = packet_size
+        self._crc_mode = crc_mode
+        self._pad = pad
+        self._calc_checksum = integrity.checksum
+        self._calc_crc = integrity.crc
+        self._frame = self._new_frame()
+        self._sequence = 1
+
+    def _new_frame(self):
+        return memoryview(bytearray(3 + self._packet_size + 1 +
+                                    self._crc_mode))
+
+    def _read(self, payload):
+        # Read the next block from the stream into ``payload``, returning
+        # the number of bytes read.
+        readinto = getattr(self._stream, 'readinto', None)
+        if readinto is not None:
+            return readinto(payload) or 0
+        data = self._stream.read(len(payload))
+        size = len(data) if data else 0
+        payload[:size] = data
+        return size
+
+    def _fill(self, frame, sequence):
+        # Read the next block from the stream into the payload of ``frame``,
+        # and encode the header, padding and checksum around it in place.
+        # Returns the number of bytes read, which is 0 at the end of the
+        # stream.
+        packet_size = self._packet_size
+        payload = frame[3:3 + packet_size]
+        size = self._read(payload)
+        if not size:
+            return 0
+
+        frame[:3] = _SEND_HEADERS[packet_size][sequence]
+        if size < packet_size:
+            payload[size:] = self._pad * (packet_size - size)
+        if self._crc_mode:
+            crc = self._calc_crc(payload)
+            frame[-2] = crc >> 8
+            frame[-1] = crc & 0xff
         else:
-            return (sum(map(ord, data)) + checksum) % 256
+            frame[-1] = self._calc_checksum(payload)
+        return size
 
-    def calc_crc(self, data, crc=0):
+    def get(self):
         '''
-        Calculate the Cyclic Redundancy Check for a given block of data, can
-        also be used to update a CRC.
+        Return the next encoded packet, or ``None`` at the end of the stream.
+        '''
+        if not self._fill(self._frame, self._sequence):
+            return None
+        self._sequence = (self._sequence + 1) % 0x100
+        return self._frame
 
-            >>> crc = modem.calc_crc('hello')
-            >>> crc = modem.calc_crc('world', crc)
-            >>> hex(crc)
-            '0x4ab3'
+    def resize(self, packet_size):
+        '''
+        Encode the next packets with ``packet_size`` bytes of data, into a
+        new buffer.
+        '''
+        if packet_size != self._packet_size:
+            self._packet_size = packet_size
+            self._frame = self._new_frame()
+
+    def close(self):
+        pass
+
+
+class _TableReader(object):
+    '''
+    Serves the packets of a :class:`FrameTable` in order.
+    '''
+
+    def __init__(self, table):
+        self._table = table
+        self._index = 0
+
+    def get(self):
+        '''
+        Return the next encoded packet, or ``None`` at the end of the table.
+        '''
+        if self._index == len(self._table):
+            return None
+        self._index += 1
+        return self._table[self._index - 1]
+
+    def close(self):
+        pass
+
+
+class _MappedFrameReader(_FrameReader):
+    '''
+    Encodes the packets of a memory mapped stream, copying each block from
+    the map into the packet buffer instead of reading it. A file stream is
+    left positioned after the data sent.
+    '''
+
+    def __init__(self, stream, packet_size, crc_mode, pad, integrity, source,
+                 offset, owned):
+        super(_MappedFrameReader, self).__init__(stream, packet_size,
+                                                 crc_mode, pad, integrity)
+        self._source = source
+        self._view = memoryview(source)
+        self._offset = offset
+        self._owned = owned
+
+    def _read(self, payload):
+        block = self._view[self._offset:self._offset + len(payload)]
+        size = len(block)
+        payload[:size] = block
+        block.release()
+        self._offset += size
+        return size
+
+    def close(self):
+        if self._view is None:
+            return
+        self._view.release()
+        self._view = None
+        if self._owned:
+            self._source.close()
+        if hasattr(self._stream, 'seek'):
+            self._stream.seek(self._offset)
+
+
+class _FramePrefetcher(_FrameReader):
+    '''
+    Reads and encodes up to ``depth`` packets ahead of the sender in a
+    background thread.
 
+    Packets are encoded into a ring of ``depth + 2`` buffers: ``depth``
+    waiting in the queue, one being sent and one being filled, so a buffer
+    is never reused before the sender has moved past it.
+    '''
+
+    def __init__(self, stream, packet_size, crc_mode, pad, integrity, depth):
+        super(_FramePrefetcher, self).__init__(stream, packet_size, crc_mode,
+                                               pad, integrity)
+        self._frames = [self._frame] + [self._new_frame()
+                                        for _ in range(depth + 1)]
+        self._queue = queue.Queue(depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='xmodem-prefetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        sequence = 1
+        index = 0
+        try:
+            while not self._stop.is_set():
+                frame = self._frames[index]
+                if not self._fill(frame, sequence):
+                    break
+                self._put(frame)
+                sequence = (sequence + 1) % 0x100
+                index = (index + 1) % len(self._frames)
+        except Exception as err:
+            self._put(err)
+        else:
+            self._put(None)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self):
+        '''
+        Return the next encoded packet, or ``None`` at the end of the stream.
+        Errors reading the stream are raised here.
+        '''
+        item = self._queue.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class _BlockWriter(object):
+    '''
+    Writes received blocks to a stream in a background thread, with up to
+    ``depth`` blocks queued.
+
+    The first exception raised by the stream is kept in :attr:`error`, and
+    any blocks after it are discarded.
+    '''
+
+    def __init__(self, stream, depth):
+        self._stream = stream
+        self._queue = queue.Queue(depth)
+        self._closed = False
+        self.error = None
+        self.flushed = 0
+        self._thread = threading.Thread(target=self._run,
+                                        name='xmodem-write-behind')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                self._stream.write(data)
+            except Exception as err:
+                self.error = err
+            else:
+                self.flushed += len(data)
+
+    def write(self, data):
+        '''
+        Queue ``data`` to be written, waiting for room in the queue.
+        '''
+        self._queue.put(data)
+
+    def close(self):
+        '''
+        Wait for all queued blocks to be written, and return the number of
+        bytes written.
         '''
-        for char in bytearray(data):
-            crctbl_idx = ((crc >> 8) ^ char) & 0xff
-            crc = ((crc << 8) ^ self.crctable[crctbl_idx]) & 0xffff
-        return crc & 0xffff
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+        return self.flushed
 
 
 XMODEM1k = partial(XMODEM, mode='xmodem1k')
@@ -0,0 +1,230 @@
+'''
+asyncio driver for the XMODEM protocol.
+
+:class:`AsyncXMODEM` runs the same protocol state machines as
+:class:`xmodem.XMODEM`, with coroutines for reading and writing, so one event
+loop can run many transfers at once.
+
+.. code-block:: python
+
+    import asyncio
+    from xmodem.aio import AsyncXMODEM
+
+    async def upload(host, port, filename):
+        reader, writer = await asyncio.open_connection(host, port)
+        modem = AsyncXMODEM.from_streams(reader, writer, mode='xmodem1k')
+        with open(filename, 'rb') as stream:
+            return await modem.send(stream)
+
+Requires Python 3.7 or later.
+'''
+from __future__ import division
+
+import asyncio
+import logging
+
+from xmodem import (
+    CAN,
+    BlockReceived,
+    Done,
+    EndOfTransmission,
+    NeedData,
+    NeedFrame,
+    NeedTimeout,
+    Progress,
+    Purge,
+    SendData,
+    XMODEMReceiver,
+    XMODEMSender,
+    _open_frames,
+    get_integrity_backend,
+)
+
+
+class AsyncXMODEM(object):
+    '''
+    XMODEM protocol handler for asyncio, expects two coroutine functions
+    which encapsulate the read and write operations on the underlying
+    stream.
+
+    :param getc: Coroutine function to retrieve bytes from a stream. It takes
+        the number of bytes to read and a timeout in seconds as parameters,
+        and must return the bytes which were read, or ``None`` if a timeout
+        occurred.
+    :type getc: coroutine function
+    :param putc: Coroutine function to transmit bytes to a stream. It takes
+        the bytes to be written and a timeout in seconds as parameters, and
+        must return the number of bytes written, or ``None`` in case of a
+        timeout.
+    :type putc: coroutine function
+    :param mode: Either ``xmodem`` or ``xmodem1k``, defaults to ``xmodem``.
+    :type mode: string
+    :param pad: Padding character to make the packets match the packet size
+    :type pad: char
+    :param integrity: Name of the integrity backend, as for
+        :class:`xmodem.XMODEM`.
+    :type integrity: str
+    '''
+
+    def __init__(self, getc, putc, mode='xmodem', pad=b'\x1a',
+                 integrity=None):
+        self.getc = getc
+        self.putc = putc
+        self.mode = mode
+        self.pad = pad
+        self.log = logging.getLogger('xmodem.AsyncXMODEM')
+        self.integrity = get_integrity_backend(integrity)
+
+    @classmethod
+    def from_streams(cls, reader, writer, **kwargs):
+        '''
+        Create a protocol handler reading from an :class:`asyncio.StreamReader`
+        and writing to an :class:`asyncio.StreamWriter`. Other keyword
+        arguments are passed on to :class:`AsyncXMODEM`.
+        '''
+        async def getc(size, timeout=1):
+            # collect up to size bytes, giving up at the deadline with
+            # whatever arrived so far
+            loop = asyncio.get_running_loop()
+            deadline = None if timeout is None else loop.time() + timeout
+            data = b''
+            while len(data) < size:
+                wait = None if deadline is None else deadline - loop.time()
+                if wait is not None and wait <= 0:
+                    break
+                try:
+                    chunk = await asyncio.wait_for(
+                        reader.read(size - len(data)), wait)
+                except asyncio.TimeoutError:
+                    break
+                if not chunk:
+                    break
+                data += chunk
+            return data or None
+
+        async def putc(data, timeout=1):
+            # packets are views of buffers that are reused, while the
+            # transport may hold on to what it could not send yet
+            writer.write(bytes(data))
+            try:
+                await asyncio.wait_for(writer.drain(), timeout)
+            except asyncio.TimeoutError:
+                return None
+            return len(data)
+
+        return cls(getc, putc, **kwargs)
+
+    async def abort(self, count=2, timeout=60):
+        '''
+        Send an abort sequence using CAN bytes.
+
+        :param count: how many abort characters to send
+        :type count: int
+        :param timeout: timeout in seconds
+        :type timeout: int
+        '''
+        for _ in range(count):
+            await self.putc(CAN, timeout)
+
+    async def send(self, stream, retry=16, timeout=60, quiet=False,
+                   callback=None):
+        '''
+        Send a stream via the XMODEM protocol, see :meth:`xmodem.XMODEM.send`.
+
+        Returns ``True`` upon successful transmission or ``False`` in case of
+        failure.
+        '''
+        protocol = XMODEMSender(self.mode, retry=retry, timeout=timeout,
+                                quiet=quiet)
+        frames = None
+        try:
+            while True:
+                event = protocol.next_event()
+                if isinstance(event, NeedFrame):
+                    if frames is None:
+                        frames = _open_frames(stream, event.packet_size,
+                                              event.crc_mode, self.pad,
+                                              self.integrity)
+                    protocol.send_frame(frames.get())
+                elif isinstance(event, Progress):
+                    if callable(callback):
+                        callback(event.total_packets, event.success_count,
+                                 event.error_count)
+                elif isinstance(event, Done):
+                    return event.result
+                else:
+                    await self._handle_event(protocol, event)
+        finally:
+            if frames is not None:
+                frames.close()
+
+    async def recv(self, stream, crc_mode=1, retry=16, timeout=60, delay=1,
+                   quiet=0, callback=None):
+        '''
+        Receive a stream via the XMODEM protocol, see
+        :meth:`xmodem.XMODEM.recv`.
+
+        Returns the number of bytes received on success or ``None`` in case of
+        failure.
+        '''
+        protocol = XMODEMReceiver(crc_mode=crc_mode, retry=retry,
+                                  timeout=timeout, delay=delay, quiet=quiet,
+                                  integrity=self.integrity)
+        while True:
+            event = protocol.next_event()
+            if isinstance(event, BlockReceived):
+                stream.write(event.data)
+            elif isinstance(event, EndOfTransmission):
+                pass
+            elif isinstance(event, Progress):
+                if callable(callback):
+                    callback(event.total_packets, event.success_count,
+                             event.error_count, event.packet_size)
+            elif isinstance(event, Done):
+                return event.result
+            else:
+                await self._handle_event(protocol, event)
+
+    async def _handle_event(self, protocol, event):
+        if isinstance(event, SendData):
+            if event.timeout is None:
+                protocol.sent(await self.putc(event.data))
+            else:
+                protocol.sent(await self.putc(event.data, event.timeout))
+        elif isinstance(event, NeedData):
+            # read the rest of a block received in fragments until the
+            # timeout of the first read expires
+            loop = asyncio.get_running_loop()
+            size, timeout = event.size, event.timeout
+            deadline = None if timeout is None else loop.time() + timeout
+            while True:
+                if timeout is None:
+                    data = await self.getc(size)
+                else:
+                    data = await self.getc(size, timeout)
+                if not data:
+                    # an empty read times out too, as with pyserial
+                    protocol.timeout()
+                    return
+                protocol.receive_data(data)
+                size -= len(data)
+                if size <= 0:
+                    return
+                if deadline is not None:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        protocol.timeout()
+                        return
+        elif isinstance(event, Purge):
+            while True:
+                data = await self.getc(1, event.timeout)
+                if not data:
+                    break
+                protocol.receive_data(data)
+            protocol.timeout()
+        elif isinstance(event, NeedTimeout):
+            await asyncio.sleep(event.timeout)
+            protocol.timeout()
+        else:
+            raise ValueError('Unexpected protocol event: {0!r}'
+                             .format(event))
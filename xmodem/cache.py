@@ -0,0 +1,192 @@
+'''
+Persistent cache of encoded packets, shared between processes.
+
+Images sent over and over, like boot loaders and firmware, need not be
+encoded again for every transfer. :class:`FrameCache` stores the
+:class:`xmodem.FrameTable` of an image in a file named after the SHA-256 of
+its contents, the packet size, checksum type and padding, and maps it into
+memory on later use.
+
+.. code-block:: python
+
+    from xmodem import FrameSet, XMODEM
+    from xmodem.cache import FrameCache
+
+    cache = FrameCache('/var/cache/xmodem', max_size=256 * 1024 * 1024)
+    frames = FrameSet(open('firmware.bin', 'rb'), cache=cache)
+    XMODEM(getc, putc).send(frames)
+'''
+from __future__ import division
+
+import binascii
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+from xmodem import FrameTable
+
+# File header: magic and the size of the image the packets were encoded from
+_MAGIC = b'XMODEMFT'
+_HEADER = struct.Struct('>8sQ')
+_SUFFIX = '.frames'
+
+
+class FrameCache(object):
+    '''
+    Directory of encoded packet tables, keyed by the contents of the image,
+    the packet size, the checksum type and the padding byte.
+
+    Files are written to a temporary file and renamed into place, so
+    readers never see a partial file. Once the files take more than
+    ``max_size`` bytes, the least recently used ones are removed. Writes and
+    evictions by several processes are serialized with a lock file, where
+    :mod:`fcntl` is available.
+
+    :param directory: The cache directory, created if needed.
+    :type directory: str
+    :param max_size: Maximum size of the cache in bytes, or ``None`` for no
+        limit.
+    :type max_size: int
+    '''
+
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.log = logging.getLogger('xmodem.cache')
+        #: Number of tables served from and added to the cache.
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, digest, packet_size, crc_mode, pad=b'\x1a'):
+        '''
+        Return the path of the file caching the packets of the image with
+        SHA-256 hex ``digest``.
+        '''
+        name = '{0}-{1}-{2}-{3}{4}'.format(
+            digest, packet_size, 'crc' if crc_mode else 'sum',
+            binascii.hexlify(pad).decode('ascii'), _SUFFIX)
+        return os.path.join(self.directory, name)
+
+    def table(self, data, packet_size, crc_mode, pad=b'\x1a', integrity=None,
+              workers=0, digest=None):
+        '''
+        Return the :class:`xmodem.FrameTable` of ``data``, mapped from the
+        cache if present, and encoded and added to it otherwise.
+
+        :param digest: SHA-256 hex digest of ``data``, if known already.
+        :type digest: str
+        '''
+        if digest is None:
+            digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest, packet_size, crc_mode, pad)
+        table = self._load(path, packet_size, crc_mode)
+        if table is not None:
+            self.hits += 1
+            return table
+
+        self.misses += 1
+        table = FrameTable.encode(data, packet_size, crc_mode, pad, integrity,
+                                  workers)
+        self._store(path, table)
+        return table
+
+    def _load(self, path, packet_size, crc_mode):
+        try:
+            with open(path, 'rb') as handle:
+                mapping = mmap.mmap(handle.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # missing, or empty and not mappable
+            return None
+        try:
+            magic, size = _HEADER.unpack_from(mapping)
+            if magic != _MAGIC:
+                raise ValueError('bad magic {0!r}'.format(magic))
+            table = FrameTable(memoryview(mapping)[_HEADER.size:],
+                               packet_size, crc_mode, size)
+            if len(table) != -(-size // packet_size):
+                raise ValueError('{0} packets for {1} bytes'.format(
+                    len(table), size))
+        except (struct.error, ValueError) as err:
+            self.log.warning('discarding corrupt cache file %s: %s',
+                             path, err)
+            self._remove(path)
+            return None
+        try:
+            # the modification time orders the files for eviction
+            os.utime(path)
+        except OSError:
+            pass
+        return table
+
+    def _store(self, path, table):
+        with self._locked():
+            handle, temp_path = tempfile.mkstemp(
+                dir=self.directory, prefix='.', suffix='.tmp')
+            try:
+                with os.fdopen(handle, 'wb') as stream:
+                    stream.write(_HEADER.pack(_MAGIC, table.size))
+                    stream.write(table._data)
+                os.replace(temp_path, path)
+            except BaseException:
+                self._remove(temp_path)
+                raise
+            self._evict()
+
+    def _evict(self):
+        if self.max_size is None:
+            return
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_size:
+                break
+            self.log.debug('evicting %s', path)
+            self._remove(path)
+            total -= size
+
+    def clear(self):
+        '''
+        Remove all files from the cache.
+        '''
+        with self._locked():
+            for name in os.listdir(self.directory):
+                if name.endswith(_SUFFIX):
+                    self._remove(os.path.join(self.directory, name))
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    @contextmanager
+    def _locked(self):
+        if fcntl is None:  # pragma: no cover
+            yield
+            return
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,428 @@
+'''
+Selector based engine running many XMODEM transfers in one thread.
+
+Each transfer runs the protocol state machines of :class:`xmodem.XMODEM`
+over a non-blocking file descriptor (a serial device, pty or socket), with
+its own timers and retry counters. The engine multiplexes all of them with
+:mod:`selectors`.
+
+.. code-block:: python
+
+    from xmodem.engine import Engine
+
+    engine = Engine()
+    transfers = [engine.submit_send(open_port(name), open(image, 'rb'),
+                                    mode='xmodem1k')
+                 for name in ports]
+    engine.run()
+    print([transfer.result() for transfer in transfers])
+    print(engine.stats())
+
+To push one image to many devices, :func:`broadcast` encodes its packets
+once and shares them between all transfers.
+'''
+from __future__ import division
+
+import errno
+import heapq
+import itertools
+import logging
+import os
+import selectors
+import time
+from collections import namedtuple
+
+from xmodem import (
+    BlockReceived,
+    Done,
+    EndOfTransmission,
+    FrameSet,
+    NeedData,
+    NeedFrame,
+    NeedTimeout,
+    Progress,
+    Purge,
+    SendData,
+    XMODEMReceiver,
+    XMODEMSender,
+    _open_frames,
+    get_integrity_backend,
+)
+
+#: Aggregate statistics of an :class:`Engine`. ``throughput`` is the number
+#: of bytes sent and received per second of ``elapsed`` time.
+EngineStats = namedtuple('EngineStats', [
+    'transfers', 'active', 'bytes_sent', 'bytes_received', 'elapsed',
+    'throughput'])
+
+
+def _fileno(fd):
+    return fd if isinstance(fd, int) else fd.fileno()
+
+
+class Transfer(object):
+    '''
+    A transfer submitted to an :class:`Engine`.
+
+    Not created directly, see :meth:`Engine.submit_send` and
+    :meth:`Engine.submit_recv`.
+    '''
+
+    def __init__(self, engine, fd, protocol, stream, callback, frames=None):
+        self.fd = _fileno(fd)
+        self.protocol = protocol
+        self.stream = stream
+        self.callback = callback
+        self.frames = frames
+        #: Number of bytes written to and read from the file descriptor.
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        #: The error that ended the transfer, if an I/O error did.
+        self.error = None
+        self.cancelled = False
+        self.started = time.monotonic()
+        self.finished = None
+        self._engine = engine
+        self._result = None
+        self._done = False
+        self._outgoing = bytearray()
+        self._waiting = None
+        self._deadline = None
+        # the blocking mode of the file descriptor, restored when done
+        self._blocking = None
+
+    def done(self):
+        '''
+        Return ``True`` if the transfer has ended.
+        '''
+        return self._done
+
+    def cancel(self):
+        '''
+        Cancel the transfer, sending the abort sequence to the peer.
+        '''
+        self._engine.cancel(self)
+
+    def result(self, timeout=None):
+        '''
+        Return the result of the transfer, as returned by
+        :meth:`xmodem.XMODEM.send` or :meth:`xmodem.XMODEM.recv`. If the
+        transfer is still running, run the engine until it is done or
+        ``timeout`` seconds passed.
+
+        :raises TimeoutError: if the transfer is not done after ``timeout``
+            seconds.
+        '''
+        if not self._done and not self._engine.run(until=[self],
+                                                    timeout=timeout):
+            raise TimeoutError('transfer on file descriptor {0} still running '
+                               'after {1} seconds'.format(self.fd, timeout))
+        return self._result
+
+
+class Engine(object):
+    '''
+    Runs many XMODEM transfers in one thread, over non-blocking file
+    descriptors.
+
+    The engine is not thread-safe: transfers are submitted, cancelled and
+    awaited from the thread running it.
+
+    :param selector: The selector to use, defaults to
+        :class:`selectors.DefaultSelector`.
+    :type selector: selectors.BaseSelector
+    :param default_timeout: Timeout in seconds for protocol reads that leave
+        it to the transport, like waiting for the receiver at the start of a
+        transfer.
+    :type default_timeout: float
+    :param read_size: Number of bytes to read at a time.
+    :type read_size: int
+    '''
+
+    def __init__(self, selector=None, default_timeout=1, read_size=4096):
+        self.selector = selector or selectors.DefaultSelector()
+        self.default_timeout = default_timeout
+        self.read_size = read_size
+        self.log = logging.getLogger('xmodem.engine')
+        self.transfers = []
+        self._active = {}
+        self._timers = []
+        self._counter = itertools.count()
+        self._started = None
+        self._finished = None
+
+    def submit_send(self, fd, stream, mode='xmodem', retry=16, timeout=60,
+                    pad=b'\x1a', callback=None, integrity=None, quiet=True):
+        '''
+        Submit a transfer sending ``stream`` over ``fd``, see
+        :meth:`xmodem.XMODEM.send`. ``stream`` may be a
+        :class:`xmodem.FrameSet` shared with other transfers.
+
+        :param fd: File descriptor, or object with a ``fileno()`` method. It
+            is switched to non-blocking mode.
+        :rtype: Transfer
+        '''
+        protocol = XMODEMSender(mode, retry=retry, timeout=timeout,
+                                quiet=quiet)
+        transfer = Transfer(self, fd, protocol, stream, callback)
+        transfer.pad = pad
+        transfer.integrity = get_integrity_backend(integrity)
+        return self._submit(transfer)
+
+    def submit_recv(self, fd, stream, crc_mode=1, retry=16, timeout=60,
+                    delay=1, callback=None, integrity=None, quiet=True):
+        '''
+        Submit a transfer receiving into ``stream`` over ``fd``, see
+        :meth:`xmodem.XMODEM.recv`.
+
+        :param fd: File descriptor, or object with a ``fileno()`` method. It
+            is switched to non-blocking mode.
+        :rtype: Transfer
+        '''
+        protocol = XMODEMReceiver(crc_mode=crc_mode, retry=retry,
+                                  timeout=timeout, delay=delay, quiet=quiet,
+                                  integrity=integrity)
+        return self._submit(Transfer(self, fd, protocol, stream, callback))
+
+    def _submit(self, transfer):
+        if transfer.fd in self._active:
+            raise ValueError('A transfer is already running on file '
+                             'descriptor {0}'.format(transfer.fd))
+        transfer._blocking = os.get_blocking(transfer.fd)
+        os.set_blocking(transfer.fd, False)
+        if self._started is None:
+            self._started = transfer.started
+        self._finished = None
+        self.transfers.append(transfer)
+        self._active[transfer.fd] = transfer
+        self.selector.register(transfer.fd, selectors.EVENT_READ, transfer)
+        self._advance(transfer)
+        return transfer
+
+    def cancel(self, transfer):
+        '''
+        Cancel ``transfer``, sending the abort sequence to the peer.
+        '''
+        if transfer.done():
+            return
+        transfer.cancelled = True
+        transfer.protocol.cancel()
+        self._advance(transfer)
+
+    def stats(self):
+        '''
+        Return the aggregate statistics of all transfers submitted.
+
+        :rtype: EngineStats
+        '''
+        bytes_sent = sum(t.bytes_sent for t in self.transfers)
+        bytes_received = sum(t.bytes_received for t in self.transfers)
+        if self._started is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self._finished or time.monotonic()) - self._started
+        throughput = (bytes_sent + bytes_received) / elapsed if elapsed else 0.0
+        return EngineStats(len(self.transfers), len(self._active), bytes_sent,
+                           bytes_received, elapsed, throughput)
+
+    def run(self, until=None, timeout=None):
+        '''
+        Run the engine until all transfers, or all transfers in ``until``,
+        are done, or ``timeout`` seconds passed.
+
+        Returns ``True`` if the transfers are done.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            pending = [t for t in (until or self.transfers) if not t.done()]
+            if not pending:
+                return True
+            wait = self._next_timer()
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+                if remaining == 0:
+                    return False
+                wait = remaining if wait is None else min(wait, remaining)
+            self.run_once(wait)
+
+    def run_once(self, timeout=None):
+        '''
+        Wait up to ``timeout`` seconds for I/O, and handle it and any expired
+        timers.
+        '''
+        for key, mask in self.selector.select(timeout):
+            transfer = key.data
+            if mask & selectors.EVENT_WRITE and not transfer.done():
+                self._flush(transfer)
+            if mask & selectors.EVENT_READ and not transfer.done():
+                self._read(transfer)
+        self._expire_timers()
+
+    def _next_timer(self):
+        while self._timers:
+            deadline, _, transfer, event = self._timers[0]
+            if transfer._waiting is event and transfer._deadline == deadline:
+                return max(deadline - time.monotonic(), 0)
+            heapq.heappop(self._timers)
+        return None
+
+    def _expire_timers(self):
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            deadline, _, transfer, event = heapq.heappop(self._timers)
+            if (transfer.done() or transfer._waiting is not event or
+                    transfer._deadline != deadline):
+                # stale timer
+                continue
+            transfer._waiting = None
+            transfer.protocol.timeout()
+            self._advance(transfer)
+
+    def _set_timer(self, transfer, event, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        transfer._waiting = event
+        transfer._deadline = time.monotonic() + timeout
+        heapq.heappush(self._timers, (transfer._deadline, next(self._counter),
+                                      transfer, event))
+
+    def _read(self, transfer):
+        try:
+            data = os.read(transfer.fd, self.read_size)
+        except OSError as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self._fail(transfer, err)
+            return
+        if not data:
+            self._fail(transfer, EOFError('end of file on file descriptor '
+                                          '{0}'.format(transfer.fd)))
+            return
+        transfer.bytes_received += len(data)
+        protocol = transfer.protocol
+        waiting = transfer._waiting
+        protocol.receive_data(data)
+        if isinstance(waiting, Purge) and protocol.next_event() is waiting:
+            # the line is not quiet yet, wait for another purge interval
+            self._set_timer(transfer, waiting, waiting.timeout)
+        self._advance(transfer)
+
+    def _write(self, transfer, data):
+        transfer._outgoing += data
+        self._flush(transfer)
+
+    def _flush(self, transfer):
+        outgoing = transfer._outgoing
+        if outgoing:
+            try:
+                written = os.write(transfer.fd, outgoing)
+            except OSError as err:
+                if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                     errno.EINTR):
+                    self._fail(transfer, err)
+                    return
+                written = 0
+            transfer.bytes_sent += written
+            del outgoing[:written]
+        events = selectors.EVENT_READ
+        if outgoing:
+            events |= selectors.EVENT_WRITE
+        if self.selector.get_key(transfer.fd).events != events:
+            self.selector.modify(transfer.fd, events, transfer)
+
+    def _advance(self, transfer):
+        # Handle the events of the transfer until it waits for I/O or time.
+        protocol = transfer.protocol
+        while not transfer.done():
+            event = protocol.next_event()
+            if event is transfer._waiting:
+                return
+            if isinstance(event, SendData):
+                # queued data is written as the descriptor allows; packets
+                # are views of buffers that are reused, so they are copied
+                self._write(transfer, event.data)
+                if transfer.done():
+                    return
+                protocol.sent(len(event.data))
+            elif isinstance(event, (NeedData, Purge, NeedTimeout)):
+                self._set_timer(transfer, event, event.timeout)
+                return
+            elif isinstance(event, NeedFrame):
+                if transfer.frames is None:
+                    transfer.frames = _open_frames(
+                        transfer.stream, event.packet_size, event.crc_mode,
+                        transfer.pad, transfer.integrity)
+                protocol.send_frame(transfer.frames.get())
+            elif isinstance(event, BlockReceived):
+                transfer.stream.write(event.data)
+            elif isinstance(event, Progress):
+                if callable(transfer.callback):
+                    args = tuple(event)
+                    if isinstance(protocol, XMODEMSender):
+                        args = args[:3]
+                    transfer.callback(*args)
+            elif isinstance(event, EndOfTransmission):
+                pass
+            elif isinstance(event, Done):
+                self._finish(transfer, event.result)
+
+    def _fail(self, transfer, error):
+        self.log.error('transfer on file descriptor %d failed: %s',
+                       transfer.fd, error)
+        transfer.error = error
+        self._finish(transfer, False if isinstance(transfer.protocol,
+                                                   XMODEMSender) else None)
+
+    def _finish(self, transfer, result):
+        if transfer._outgoing and transfer.error is None:
+            # let the last bytes, like a final ACK or CAN, go out
+            try:
+                os.write(transfer.fd, transfer._outgoing)
+            except OSError:
+                pass
+        if isinstance(transfer.protocol, XMODEMSender) and result is None:
+            result = False
+        transfer._result = result
+        transfer._done = True
+        transfer._waiting = None
+        transfer.finished = time.monotonic()
+        if transfer.frames is not None:
+            transfer.frames.close()
+        self.selector.unregister(transfer.fd)
+        try:
+            os.set_blocking(transfer.fd, transfer._blocking)
+        except OSError:
+            # closed already
+            pass
+        del self._active[transfer.fd]
+        if not self._active:
+            self._finished = transfer.finished
+
+
+def broadcast(devices, image, mode='xmodem', retry=16, timeout=60,
+              pad=b'\x1a', integrity=None, engine=None):
+    '''
+    Send ``image`` to every device in ``devices`` at once, and return the
+    result of each transfer, in order.
+
+    The packets are encoded once for each checksum type the receivers ask
+    for, and shared read-only by all transfers. Each device negotiates
+    checksum or CRC mode and retries on its own.
+
+    :param devices: File descriptors, or objects with a ``fileno()`` method.
+    :type devices: list
+    :param image: The image to send, as bytes, a stream or a
+        :class:`xmodem.FrameSet`.
+    :param engine: Engine to run the transfers in, along with any transfers
+        it already runs. A new one is used by default.
+    :type engine: Engine
+    :rtype: list
+    '''
+    if not isinstance(image, FrameSet):
+        image = FrameSet(image, pad=pad, integrity=integrity)
+    engine = engine or Engine()
+    transfers = [engine.submit_send(device, image, mode=mode, retry=retry,
+                                    timeout=timeout)
+                 for device in devices]
+    engine.run(until=transfers)
+    return [transfer.result() for transfer in transfers]
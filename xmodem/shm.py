@@ -0,0 +1,205 @@
+'''
+Encoded packets in shared memory, for senders running in many processes.
+
+:class:`SharedFrames` copies the :class:`xmodem.FrameTable` objects of an
+image into one :mod:`multiprocessing.shared_memory` segment. Worker
+processes attach it read-only and send from it without encoding the image,
+or keeping a copy of it, themselves.
+
+.. code-block:: python
+
+    import multiprocessing
+    from xmodem import FrameSet, XMODEM
+    from xmodem.shm import SharedFrames
+
+    def worker(shared, port):
+        with shared:
+            XMODEM(*open_port(port)).send(shared.attach())
+
+    frames = FrameSet(open('firmware.bin', 'rb'))
+    with SharedFrames([frames.table(128, 0), frames.table(128, 1)]) as shared:
+        workers = [multiprocessing.Process(target=worker, args=(shared, port))
+                   for port in ports]
+        ...
+
+The segment counts the processes attached to it, and is removed when the
+last one detaches, whether that is the creator or a worker. The lock
+guarding the count is a :func:`multiprocessing.Lock`, so a
+:class:`SharedFrames` is handed to workers when they are started, like any
+other synchronization primitive.
+
+Requires Python 3.8 or later.
+'''
+from __future__ import division
+
+import multiprocessing
+import os
+import struct
+import sys
+from multiprocessing import resource_tracker, shared_memory
+
+from xmodem import FrameSet, FrameTable
+
+# Segment header: reference count and number of tables, followed by the
+# size, packet size, crc_mode, offset and length of each table
+_HEADER = struct.Struct('=QQ')
+_ENTRY = struct.Struct('=QIIQQ')
+_ALIGN = 64
+
+
+def _attach_segment(name):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track=False)
+    # Before Python 3.13, attaching to a segment registers it with the
+    # resource tracker, which would remove it when this process exits.
+    segment = shared_memory.SharedMemory(name)
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+
+class SharedFrames(object):
+    '''
+    Frame tables of one image in a shared memory segment.
+
+    The creating process holds a reference to the segment until
+    :meth:`close`. Every process, including the creator, calls
+    :meth:`attach` to use the tables and :meth:`close` when done; the
+    segment is removed when no process holds a reference any more. Used as a
+    context manager, :class:`SharedFrames` closes on exit.
+
+    :param tables: The tables to share.
+    :type tables: list of xmodem.FrameTable
+    :param name: Name of the segment, random by default.
+    :type name: str
+    :param context: Multiprocessing context of the worker processes, for
+        the lock guarding the reference count.
+    :type context: multiprocessing.context.BaseContext
+    '''
+
+    def __init__(self, tables, name=None, context=None):
+        tables = list(tables)
+        offset = _HEADER.size + _ENTRY.size * len(tables)
+        entries = []
+        for table in tables:
+            offset = -(-offset // _ALIGN) * _ALIGN
+            entries.append((table.size, table.packet_size, table.crc_mode,
+                            offset, len(table._data)))
+            offset += len(table._data)
+
+        self._lock = (context or multiprocessing).Lock()
+        self._segment = shared_memory.SharedMemory(name, create=True,
+                                                   size=max(offset, 1))
+        self.name = self._segment.name
+        buf = self._segment.buf
+        _HEADER.pack_into(buf, 0, 1, len(tables))
+        for index, (entry, table) in enumerate(zip(entries, tables)):
+            _ENTRY.pack_into(buf, _HEADER.size + index * _ENTRY.size, *entry)
+            buf[entry[3]:entry[3] + entry[4]] = table._data
+        self._owner = True
+        self._frames = None
+        self._pid = os.getpid()
+
+    def _check_process(self):
+        if self._pid != os.getpid():
+            # inherited by a forked process, which holds no reference yet
+            self._segment = None
+            self._owner = False
+            self._frames = None
+            self._pid = os.getpid()
+
+    def __getstate__(self):
+        return {'name': self.name, '_lock': self._lock}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._segment = None
+        self._owner = False
+        self._frames = None
+        self._pid = os.getpid()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def references(self):
+        '''
+        Number of processes holding a reference to the segment.
+        '''
+        self._check_process()
+        with self._lock:
+            segment = self._segment or _attach_segment(self.name)
+            try:
+                return _HEADER.unpack_from(segment.buf)[0]
+            finally:
+                if segment is not self._segment:
+                    segment.close()
+
+    def attach(self):
+        '''
+        Return a read-only :class:`xmodem.FrameSet` of the shared tables, to
+        pass to :meth:`xmodem.XMODEM.send`.
+        '''
+        self._check_process()
+        if self._frames is not None:
+            return self._frames
+        with self._lock:
+            if self._segment is None:
+                self._segment = _attach_segment(self.name)
+                self._add_reference(1)
+            buf = self._segment.buf.toreadonly()
+            _, count = _HEADER.unpack_from(buf)
+            tables = []
+            for index in range(count):
+                size, packet_size, crc_mode, offset, length = (
+                    _ENTRY.unpack_from(buf, _HEADER.size +
+                                       index * _ENTRY.size))
+                tables.append(FrameTable(buf[offset:offset + length],
+                                         packet_size, crc_mode, size))
+        # the segment can only be closed once the packets are released, see
+        # close()
+        self._frames = FrameSet.from_tables(tables, owner=self._segment)
+        return self._frames
+
+    def close(self):
+        '''
+        Release the reference of this process to the segment, removing it if
+        that was the last one.
+        '''
+        self._check_process()
+        with self._lock:
+            segment = self._segment
+            if segment is None:
+                return
+            self._segment = None
+            self._frames = None
+            remaining = self._add_reference(-1, segment)
+            try:
+                segment.close()
+            except BufferError:
+                # packets of this process are still referenced; the frame
+                # set holding them holds the segment too, which is closed
+                # when they are released
+                pass
+            if remaining and not self._owner:
+                return
+            if sys.version_info < (3, 13):
+                # Attaching unregisters the segment, also from the resource
+                # tracker of the creator when it is shared with the workers.
+                # Register it again, to unregister it once below.
+                resource_tracker.register(segment._name, 'shared_memory')
+            if remaining:
+                # the last worker removes the segment, rather than the
+                # resource tracker when this process exits
+                resource_tracker.unregister(segment._name, 'shared_memory')
+            else:
+                segment.unlink()
+
+    def _add_reference(self, count, segment=None):
+        # Called with the lock held.
+        buf = (segment or self._segment).buf
+        references, tables = _HEADER.unpack_from(buf)
+        _HEADER.pack_into(buf, 0, references + count, tables)
+        return references + count
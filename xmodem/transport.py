@@ -0,0 +1,153 @@
+'''
+Transport adapters for the ``getc`` and ``putc`` functions used by
+:class:`xmodem.XMODEM`.
+'''
+from __future__ import division
+
+import time
+
+
+class BufferedTransport(object):
+    '''
+    Wraps a raw ``getc``/``putc`` pair, serving reads from a buffer that is
+    filled with bulk reads.
+
+    XMODEM reads control characters one at a time, and each of those reads
+    is typically a system call (plus a ``select``) on a serial port or pty.
+    Wrapped in this adapter, small reads are served from data already
+    received, and the raw ``getc`` is asked for up to ``size`` bytes at a
+    time.
+
+    .. code-block:: python
+
+        import serial
+        from xmodem import XMODEM, BufferedTransport
+        ser = serial.Serial('/dev/ttyUSB0')
+
+        def getc(size, timeout=1):
+            ser.timeout = timeout
+            return ser.read(min(size, ser.in_waiting) or 1) or None
+
+        def putc(data, timeout=1):
+            return ser.write(data)
+
+        transport = BufferedTransport(getc, putc)
+        modem = XMODEM(transport.getc, transport.putc,
+                       getc_into=transport.getc_into,
+                       flush_input=transport.flush_input)
+
+    :param getc: Function to retrieve bytes from a stream, as for
+        :class:`xmodem.XMODEM`. It should return as soon as any bytes are
+        available, up to the number requested, rather than waiting for all of
+        them.
+    :type getc: callable
+    :param putc: Function to transmit bytes to a stream, as for
+        :class:`xmodem.XMODEM`. It is used as is.
+    :type putc: callable
+    :param size: Number of bytes to ask the raw ``getc`` for at a time.
+    :type size: int
+    '''
+
+    def __init__(self, getc, putc, size=4096):
+        self._getc = getc
+        self.putc = putc
+        self.size = size
+        self._buffer = bytearray()
+        self._offset = 0
+        #: Number of reads served by :meth:`getc` and :meth:`getc_into`.
+        self.reads = 0
+        #: Number of calls made to the raw ``getc``.
+        self.raw_reads = 0
+
+    @property
+    def saved(self):
+        '''
+        Number of raw reads saved by buffering.
+        '''
+        return max(self.reads - self.raw_reads, 0)
+
+    @property
+    def buffered(self):
+        '''
+        Number of bytes received but not read yet.
+        '''
+        return len(self._buffer) - self._offset
+
+    def _fill(self, size, timeout):
+        # Buffer at least ``size`` bytes, or whatever arrives in time.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        wait = timeout
+        while self.buffered < size:
+            data = self._getc(max(self.size, size - self.buffered), wait)
+            self.raw_reads += 1
+            if not data:
+                break
+            self._buffer += data
+            if deadline is not None:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    break
+
+    def _consume(self, size):
+        self._offset += size
+        if self._offset == len(self._buffer):
+            del self._buffer[:]
+            self._offset = 0
+        elif self._offset > self.size:
+            del self._buffer[:self._offset]
+            self._offset = 0
+
+    def getc(self, size, timeout=1):
+        '''
+        Read up to ``size`` bytes, waiting up to ``timeout`` seconds for them
+        to arrive.
+
+        Returns the bytes read, or ``None`` if a timeout occurred before any
+        bytes arrived.
+        '''
+        self.reads += 1
+        if self.buffered < size:
+            self._fill(size, timeout)
+        size = min(size, self.buffered)
+        if not size:
+            return None
+        data = bytes(self._buffer[self._offset:self._offset + size])
+        self._consume(size)
+        return data
+
+    def getc_into(self, buffer, timeout=1):
+        '''
+        Read up to ``len(buffer)`` bytes into ``buffer``, waiting up to
+        ``timeout`` seconds for them to arrive.
+
+        Returns the number of bytes read, or ``None`` if a timeout occurred
+        before any bytes arrived.
+        '''
+        self.reads += 1
+        size = len(buffer)
+        if self.buffered < size:
+            self._fill(size, timeout)
+        size = min(size, self.buffered)
+        if not size:
+            return None
+        buffer[:size] = self._buffer[self._offset:self._offset + size]
+        self._consume(size)
+        return size
+
+    def flush_input(self, quiet=0.05):
+        '''
+        Discard the bytes received but not read yet, and those that arrive
+        until none did for ``quiet`` seconds, reading as many as are
+        available at a time.
+
+        Returns the number of bytes discarded.
+        '''
+        count = self.buffered
+        del self._buffer[:]
+        self._offset = 0
+        while True:
+            data = self._getc(self.size, quiet)
+            self.raw_reads += 1
+            if not data:
+                return count
+            count += len(data)
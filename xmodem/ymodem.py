@@ -0,0 +1,498 @@
+'''
+YMODEM batch file transfers, as described in YMODEM.TXT_.
+
+A YMODEM batch sends any number of files in one session. Each file is
+preceded by a block with sequence number ``0`` holding its name, size and
+modification time; the data blocks and the end of each file are sent as in
+XMODEM. A block ``0`` with an empty name ends the batch. Receivers truncate
+each file to its size, so the padding of the last block is not kept.
+
+.. code-block:: python
+
+    from xmodem.ymodem import YMODEM
+
+    modem = YMODEM(getc, putc)
+    modem.send(['boot.bin', 'kernel.bin', 'rootfs.img'])
+
+    # on the other end
+    modem.recv('/tmp/incoming')
+
+On error free links, the receiver can ask for YMODEM-g with
+``recv(..., streaming=True)``: the sender then sends the blocks back to back
+without waiting for each to be acknowledged, and any error aborts the
+transfer.
+
+.. _YMODEM.TXT: doc/ymodem.txt
+'''
+from __future__ import division
+
+import os
+import time
+from collections import namedtuple
+
+from xmodem import (
+    ACK,
+    CAN,
+    CRC,
+    EOT,
+    NAK,
+    SOH,
+    STX,
+    XMODEM,
+    BlockReceived,
+    Done,
+    EndOfTransmission,
+    IntegrityBackend,
+    NeedData,
+    NeedFrame,
+    NeedTimeout,
+    Progress,
+    Purge,
+    SendData,
+    XMODEMReceiver,
+    XMODEMSender,
+    _encode_frames,
+    _is_file,
+    _open_frames,
+    get_integrity_backend,
+)
+
+#: The header of a file in a batch. ``size`` and ``mtime`` are ``None`` if
+#: unknown. Also the event emitted by :class:`YMODEMReceiver` when a file
+#: starts.
+FileHeader = namedtuple('FileHeader', ['name', 'size', 'mtime'])
+
+#: Start character of a receiver asking for YMODEM-g
+GO = b'G'
+
+
+def _encode_header(header):
+    # Returns the payload of block 0: the name, NUL, and the size in decimal
+    # and modification time in octal, separated by a space.
+    payload = header.name.encode('utf-8', 'surrogateescape') + b'\x00'
+    if header.size is not None:
+        payload += str(header.size).encode('ascii')
+        if header.mtime is not None:
+            payload += ' {0:o}'.format(int(header.mtime)).encode('ascii')
+    return payload
+
+
+def _decode_header(payload):
+    name, _, fields = bytes(payload).partition(b'\x00')
+    fields = fields.split(b'\x00', 1)[0].split()
+    size = mtime = None
+    try:
+        if fields:
+            size = int(fields[0])
+        if len(fields) > 1:
+            mtime = int(fields[1], 8)
+    except ValueError:
+        pass
+    return FileHeader(name.decode('utf-8', 'surrogateescape'), size, mtime)
+
+
+class YMODEMSender(XMODEMSender):
+    '''
+    YMODEM batch sender protocol state machine, doing no I/O of its own.
+
+    Like :class:`xmodem.XMODEMSender`, with :data:`xmodem.NeedFrame` events
+    asking for the packets of the file at :attr:`file_index` in ``files``.
+
+    :param files: The headers of the files to send.
+    :type files: list of FileHeader
+    :param mode: Either ``xmodem`` or ``xmodem1k``, defaults to ``xmodem1k``.
+    :type mode: string
+    :param integrity: The integrity backend, or its name, used to encode the
+        header blocks.
+    :type integrity: IntegrityBackend or str
+    '''
+
+    def __init__(self, files, mode='xmodem1k', retry=16, timeout=60,
+                 quiet=False, integrity=None):
+        self.files = list(files)
+        #: Index of the file being sent.
+        self.file_index = None
+        #: ``True`` once the receiver asked for YMODEM-g.
+        self.streaming = False
+        if not isinstance(integrity, IntegrityBackend):
+            integrity = get_integrity_backend(integrity)
+        self._integrity = integrity
+        super(YMODEMSender, self).__init__(mode, retry=retry,
+                                           timeout=timeout, quiet=quiet)
+
+    def _run(self):
+        crc_mode = yield from self._start_sequence()
+        for index, header in enumerate(self.files):
+            self.file_index = index
+            if crc_mode is None:
+                return False
+            reply = yield from self._send_header(header, crc_mode)
+            if not reply:
+                return False
+            if reply != GO:
+                crc_mode = yield from self._start_sequence()
+                if crc_mode is None:
+                    return False
+            self.crc_mode = crc_mode
+            if self.streaming:
+                sent = yield from self._stream_packets()
+            else:
+                sent = yield from self._send_packets(crc_mode)
+            if not sent:
+                return False
+            if not (yield from self._send_eot()):
+                return False
+            self.log.info('Sent %s', header.name)
+            crc_mode = yield from self._start_sequence()
+
+        self.file_index = None
+        if crc_mode is None:
+            return False
+        if not (yield from self._send_header(None, crc_mode)):
+            return False
+        self.log.info('Batch transmission successful.')
+        return True
+
+    def _start_char(self, char):
+        if char == GO:
+            self.log.debug('YMODEM-g requested (G).')
+            self.streaming = True
+            return 1
+        return None
+
+    def _send_header(self, header, crc_mode):
+        # Send block 0 for ``header``, or the empty one ending the batch.
+        # Returns True once acknowledged, or GO if a streaming receiver asks
+        # for the data right away.
+        payload = b'' if header is None else _encode_header(header)
+        packet_size = 128 if len(payload) <= 128 else 1024
+        frame = _encode_frames(payload.ljust(packet_size, b'\x00'),
+                               packet_size, crc_mode, b'\x00',
+                               self._integrity, first=-1)
+        error_count = 0
+        while True:
+            self.log.debug('send: block 0 for %r', header)
+            yield SendData(frame, None)
+            if header is None and self.streaming:
+                # a streaming receiver does not acknowledge the end of the
+                # batch
+                return True
+            char = yield NeedData(1, self.timeout_seconds)
+            if char == ACK:
+                return True
+            elif char == GO and self.streaming:
+                return GO
+            self.log.error('send error: expected ACK; got %r for block 0',
+                           char)
+            error_count += 1
+            if error_count > self.retry:
+                self.log.error('send error: block 0 not acknowledged, '
+                               'aborting.')
+                yield from self._abort(timeout=self.timeout_seconds)
+                return False
+
+    def _stream_packets(self):
+        # Send all packets back to back, only checking for the receiver
+        # aborting the transfer in between.
+        sequence = 1
+        while True:
+            frame = yield NeedFrame(self.total_packets, sequence,
+                                    self.packet_size, 1)
+            if frame is None:
+                self.log.debug('send: at EOF')
+                return True
+            self.total_packets += 1
+            yield SendData(frame, None)
+            self.success_count += 1
+            yield self._progress()
+            sequence = (sequence + 1) % 0x100
+            char = yield NeedData(1, 0)
+            if char == CAN:
+                char = yield NeedData(1, self.timeout_seconds)
+                if char == CAN:
+                    self.log.info('Transmission canceled: received 2xCAN '
+                                  'at block %d', sequence)
+                    return False
+            elif char is not None:
+                self.log.warning('send: ignoring %r while streaming', char)
+
+
+class YMODEMReceiver(XMODEMReceiver):
+    '''
+    YMODEM batch receiver protocol state machine, doing no I/O of its own.
+
+    Like :class:`xmodem.XMODEMReceiver`, emitting a :data:`FileHeader` when a
+    file starts and :data:`xmodem.EndOfTransmission` when it ends. Blocks
+    past the size in the header are truncated. The transfer is done with the
+    list of headers of the files received, with the number of bytes received
+    as size, or ``None`` if it failed.
+
+    :param streaming: If ``True``, ask for YMODEM-g: the sender streams the
+        blocks without waiting for acknowledgements, and the transfer is
+        aborted at the first error. Only for error free links.
+    :type streaming: bool
+    '''
+
+    _informational = XMODEMReceiver._informational + (FileHeader,)
+
+    def __init__(self, crc_mode=1, retry=16, timeout=60, delay=1, quiet=0,
+                 integrity=None, streaming=False):
+        self.streaming = streaming
+        super(YMODEMReceiver, self).__init__(crc_mode=crc_mode, retry=retry,
+                                             timeout=timeout, delay=delay,
+                                             quiet=quiet, integrity=integrity)
+
+    def _run(self):
+        files = []
+        while True:
+            header = yield from self._recv_header()
+            if header is None:
+                return None
+            if not header.name:
+                self.log.info('Batch complete, %d files', len(files))
+                return files
+            yield header
+            size = yield from self._recv_file(header)
+            if size is None:
+                return None
+            files.append(header._replace(size=size))
+
+    def _request(self):
+        # Ask for the next block with C or NAK, returning the first byte of
+        # the reply, or None once the transfer is cancelled or failed.
+        if self.streaming:
+            char = GO
+        else:
+            char = CRC if self.crc_mode else NAK
+        error_count = 0
+        cancel = 0
+        while True:
+            if error_count > self.retry:
+                self.log.error('error_count reached %d, aborting.',
+                               self.retry)
+                yield from self._abort(timeout=self.timeout_seconds)
+                return None
+            if not (yield SendData(char, None)):
+                self.log.warning('recv error: putc failed, '
+                                 'sleeping for %d', self.delay)
+                yield NeedTimeout(self.delay)
+                error_count += 1
+                continue
+            reply = yield NeedData(1, self.timeout_seconds)
+            if reply in (SOH, STX, EOT):
+                return reply
+            elif reply == CAN:
+                if cancel:
+                    self.log.info('Transmission canceled: received 2xCAN')
+                    return None
+                cancel = 1
+            else:
+                self.log.warning('recv error: expected SOH, STX or EOT; '
+                                 'got %r', reply)
+                error_count += 1
+
+    def _recv_header(self):
+        error_count = 0
+        while True:
+            char = yield from self._request()
+            if char is None:
+                return None
+            if char != EOT:
+                packet_size = 128 if char == SOH else 1024
+                data = yield NeedData(2 + packet_size + 1 + self.crc_mode,
+                                      self.timeout_seconds)
+                if (data is not None and
+                        len(data) == 2 + packet_size + 1 + self.crc_mode and
+                        data[0] == 0 and data[1] == 0xff):
+                    valid, payload = self._verify_recv_checksum(
+                        self.crc_mode, memoryview(data)[2:])
+                    if valid:
+                        if not self.streaming:
+                            yield SendData(ACK, None)
+                        return _decode_header(payload)
+                self.log.warning('recv error: bad block 0')
+                yield Purge(self.purge_timeout)
+            error_count += 1
+            if error_count > self.retry:
+                self.log.error('error_count reached %d, aborting.',
+                               self.retry)
+                yield from self._abort(timeout=self.timeout_seconds)
+                return None
+
+    def _recv_file(self, header):
+        self.income_size = 0
+        self.packet_size = 128
+        char = yield from self._request()
+        if char is None:
+            return None
+        if char == EOT:
+            # an empty file
+            yield EndOfTransmission(0)
+            yield SendData(ACK, None)
+            return 0
+        packets = self._recv_packets(char)
+        if header.size is None:
+            return (yield from packets)
+        return (yield from self._truncate(packets, header.size))
+
+    def _truncate(self, packets, size):
+        # Pass on the events of ``packets``, leaving out data past ``size``.
+        remaining = size
+        value = None
+        while True:
+            try:
+                event = packets.send(value)
+            except StopIteration as stop:
+                return None if stop.value is None else size - remaining
+            if isinstance(event, BlockReceived):
+                data = event.data[:remaining]
+                remaining -= len(data)
+                event = BlockReceived(event.sequence, data)
+            elif isinstance(event, EndOfTransmission):
+                event = EndOfTransmission(size - remaining)
+            value = yield event
+
+
+def _sender_file(item):
+    # Returns the header of ``item``, a path, a file object or a (name,
+    # stream) tuple, and the path or stream to send it from.
+    if isinstance(item, tuple):
+        name, stream = item
+    elif isinstance(item, (str, os.PathLike)):
+        stat = os.stat(item)
+        return (FileHeader(os.path.basename(os.fspath(item)), stat.st_size,
+                           int(stat.st_mtime)), item)
+    else:
+        name, stream = os.path.basename(item.name), item
+    size = mtime = None
+    # the file under a stream such as a gzip file holds other bytes
+    if _is_file(stream):
+        try:
+            stat = os.fstat(stream.fileno())
+            size, mtime = stat.st_size - stream.tell(), int(stat.st_mtime)
+        except (OSError, ValueError):
+            pass
+    if size is None:
+        try:
+            position = stream.tell()
+            size = stream.seek(0, os.SEEK_END) - position
+            stream.seek(position)
+        except (AttributeError, OSError, ValueError):
+            pass
+    return FileHeader(name, size, mtime), stream
+
+
+class YMODEM(XMODEM):
+    '''
+    YMODEM batch protocol handler, expecting the same ``getc`` and ``putc``
+    functions as :class:`xmodem.XMODEM`.
+
+    :param mode: Either ``xmodem`` or ``xmodem1k``, defaults to ``xmodem1k``.
+    :type mode: string
+    '''
+
+    def __init__(self, getc, putc, mode='xmodem1k', pad=b'\x1a',
+                 integrity=None, getc_into=None, flush_input=None):
+        super(YMODEM, self).__init__(getc, putc, mode=mode, pad=pad,
+                                     integrity=integrity,
+                                     getc_into=getc_into,
+                                     flush_input=flush_input)
+
+    def send(self, files, retry=16, timeout=60, quiet=False, callback=None):
+        '''
+        Send a batch of files.
+
+        Returns ``True`` upon successful transmission or ``False`` in case of
+        failure.
+
+        :param files: The files to send, as paths, file objects with a
+            ``name``, or ``(name, stream)`` tuples.
+        :type files: list
+        :param callback: Called as for :meth:`xmodem.XMODEM.send`.
+        :type callback: callable
+        '''
+        sources = [_sender_file(item) for item in files]
+        protocol = YMODEMSender([header for header, _ in sources],
+                                mode=self.mode, retry=retry, timeout=timeout,
+                                quiet=quiet, integrity=self.integrity)
+        frames = None
+        index = None
+        try:
+            while True:
+                event = protocol.next_event()
+                if isinstance(event, NeedFrame):
+                    if index != protocol.file_index:
+                        if frames is not None:
+                            frames.close()
+                        index = protocol.file_index
+                        frames = _open_frames(sources[index][1],
+                                              event.packet_size,
+                                              event.crc_mode, self.pad,
+                                              self.integrity)
+                    protocol.send_frame(frames.get())
+                elif isinstance(event, Progress):
+                    if callable(callback):
+                        callback(event.total_packets, event.success_count,
+                                 event.error_count)
+                elif isinstance(event, Done):
+                    return event.result
+                else:
+                    self._handle_event(protocol, event)
+        finally:
+            if frames is not None:
+                frames.close()
+
+    def recv(self, destination, crc_mode=1, retry=16, timeout=60, delay=1,
+             quiet=0, callback=None, streaming=False):
+        '''
+        Receive a batch of files.
+
+        Returns the list of :data:`FileHeader` of the files received, with
+        the number of bytes received as ``size``, or ``None`` in case of
+        failure.
+
+        :param destination: Directory to write the files to, or a function
+            called with the :data:`FileHeader` of each file, returning the
+            stream to write it to.
+        :type destination: str or callable
+        :param callback: Called as for :meth:`xmodem.XMODEM.recv`.
+        :type callback: callable
+        :param streaming: If ``True``, ask for YMODEM-g, see
+            :class:`YMODEMReceiver`.
+        :type streaming: bool
+        '''
+        protocol = YMODEMReceiver(crc_mode=crc_mode, retry=retry,
+                                  timeout=timeout, delay=delay, quiet=quiet,
+                                  integrity=self.integrity,
+                                  streaming=streaming)
+        stream = path = header = None
+        try:
+            while True:
+                event = protocol.next_event()
+                if isinstance(event, FileHeader):
+                    header = event
+                    if callable(destination):
+                        stream = destination(event)
+                    else:
+                        path = os.path.join(destination,
+                                            os.path.basename(event.name))
+                        stream = open(path, 'wb')
+                elif isinstance(event, BlockReceived):
+                    stream.write(event.data)
+                elif isinstance(event, EndOfTransmission):
+                    if path is not None:
+                        stream.close()
+                        if header.mtime is not None:
+                            os.utime(path, (time.time(), header.mtime))
+                    stream = path = None
+                elif isinstance(event, Progress):
+                    if callable(callback):
+                        callback(event.total_packets, event.success_count,
+                                 event.error_count, event.packet_size)
+                elif isinstance(event, Done):
+                    return event.result
+                else:
+                    self._handle_event(protocol, event)
+        finally:
+            if path is not None:
+                stream.close()
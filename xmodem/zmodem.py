@@ -0,0 +1,915 @@
+'''
+ZMODEM file transfers, as described in ZMODEM.TXT by Chuck Forsberg.
+
+ZMODEM sends a batch of files as a stream of data subpackets, without
+waiting for each to be acknowledged. Frames start with a header carrying
+a byte offset into the file, and subpackets are checked with a CRC-32 when
+both ends support it, a CRC-16 otherwise. When the receiver gets a bad
+subpacket, it asks the sender to go back to the last good offset with
+``ZRPOS``, and the sender resumes from there. The same mechanism resumes an
+interrupted transfer from the data already received.
+
+.. code-block:: python
+
+    from xmodem.zmodem import ZMODEM
+
+    modem = ZMODEM(getc, putc)
+    modem.send(['boot.bin', 'kernel.bin', 'rootfs.img'])
+
+    # on the other end, keeping partial files from an earlier attempt
+    modem.recv('/tmp/incoming', resume=True)
+
+The protocol logic is implemented by :class:`ZMODEMSender` and
+:class:`ZMODEMReceiver`, which do no I/O of their own, like
+:class:`xmodem.XMODEMSender` and :class:`xmodem.XMODEMReceiver`. ZMODEM reads
+its input a byte at a time, so ``getc`` should be buffered, for instance
+with :class:`xmodem.transport.BufferedTransport`. ``getc`` is also called
+with a timeout of ``0`` while streaming, and should then return ``None``
+right away if no data is waiting.
+
+Only binary transfers are implemented: no newline conversion, remote
+commands or file management options.
+'''
+from __future__ import division
+
+import os
+import re
+import struct
+import time
+import zlib
+from collections import namedtuple
+
+from xmodem import (
+    XMODEM,
+    Done,
+    EndOfTransmission,
+    IntegrityBackend,
+    NeedData,
+    SendData,
+    _Protocol,
+    get_integrity_backend,
+)
+from xmodem.ymodem import (
+    FileHeader,
+    _decode_header,
+    _encode_header,
+    _sender_file,
+)
+
+# Framing bytes
+ZPAD = 0x2a
+ZDLE = 0x18
+ZBIN = 0x41
+ZHEX = 0x42
+ZBIN32 = 0x43
+
+# Frame types
+ZRQINIT = 0
+ZRINIT = 1
+ZSINIT = 2
+ZACK = 3
+ZFILE = 4
+ZSKIP = 5
+ZNAK = 6
+ZABORT = 7
+ZFIN = 8
+ZRPOS = 9
+ZDATA = 10
+ZEOF = 11
+ZFERR = 12
+ZCRC = 13
+ZCHALLENGE = 14
+ZCOMPL = 15
+ZCAN = 16
+ZFREECNT = 17
+ZCOMMAND = 18
+ZSTDERR = 19
+
+# Data subpacket ends: end of frame, go on, go on with an ACK, and wait for
+# an ACK
+ZCRCE = 0x68
+ZCRCG = 0x69
+ZCRCQ = 0x6a
+ZCRCW = 0x6b
+ZRUB0 = 0x6c
+ZRUB1 = 0x6d
+
+# ZRINIT flags (ZF0): full duplex, receiving while writing to disk, CRC-32
+CANFDX = 0x01
+CANOVIO = 0x02
+CANFC32 = 0x20
+
+# ZFILE conversion options (ZF0): binary, and resume an interrupted file
+ZCBIN = 1
+ZCRESUM = 3
+
+# Pseudo frame types and bytes for failed reads
+_TIMEOUT = -1
+_ERROR = -2
+_CANCELLED = -3
+
+_XONXOFF = (0x11, 0x13, 0x91, 0x93)
+_FRAME_ENDS = (ZCRCE, ZCRCG, ZCRCQ, ZCRCW)
+
+#: Abort sequence: CANs, then backspaces to erase them on a terminal.
+ABORT = b'\x18' * 10 + b'\x08' * 10
+
+# Bytes escaped with ZDLE when sent: ZDLE itself, DLE, XON and XOFF with or
+# without parity, and CR after @, which Telenet takes as a command.
+_ESCAPE = re.compile(b'[\x10\x11\x13\x18\x90\x91\x93]|(?<=[@\xc0])[\r\x8d]')
+# Bytes needing attention when received.
+_SPECIAL = re.compile(b'[\x11\x13\x18\x91\x93]')
+
+#: Pass up to ``size`` bytes of the file at :attr:`ZMODEMSender.file_index`,
+#: starting ``offset`` bytes into it, to ``send_file_data()``. Fewer bytes
+#: are only passed at the end of the file.
+NeedFileData = namedtuple('NeedFileData', ['offset', 'size'])
+
+#: ``data`` was received at ``offset`` of the current file. Informational.
+DataReceived = namedtuple('DataReceived', ['offset', 'data'])
+
+#: Progress of the current file, as passed to callbacks: its size, if
+#: known, the number of bytes sent or received, and the number of errors.
+#: Informational.
+FileProgress = namedtuple('FileProgress', ['size', 'offset', 'error_count'])
+
+
+def _escape(data):
+    return _ESCAPE.sub(lambda match: bytes([ZDLE, match.group()[0] ^ 0x40]),
+                       data)
+
+
+def _position(args):
+    return struct.unpack('<I', args)[0]
+
+
+def _args(position):
+    return struct.pack('<I', position & 0xffffffff)
+
+
+def _flags(zf0, zf1=0, zf2=0, zf3=0):
+    # Flags are sent in the reverse order of positions.
+    return bytes([zf3, zf2, zf1, zf0])
+
+
+class _ZMODEMProtocol(_Protocol):
+    '''
+    Framing shared by the ZMODEM state machines: headers, data subpackets,
+    and reading the escaped byte stream.
+    '''
+
+    def __init__(self, retry, timeout, integrity):
+        if not isinstance(integrity, IntegrityBackend):
+            integrity = get_integrity_backend(integrity)
+        self._crc16 = integrity.crc
+        self.retry = retry
+        #: Whether the headers and data subpackets sent are checked with
+        #: CRC-32 rather than CRC-16.
+        self.crc32 = False
+        # the same for those received, set by the type of binary header
+        self._crc32_in = False
+        self._pending = b''
+        self._pos = 0
+        super(_ZMODEMProtocol, self).__init__(timeout)
+
+    def _abort(self, count=2, timeout=60):
+        yield SendData(ABORT, timeout)
+
+    # Sending
+
+    def _hex_header(self, frame_type, args):
+        header = bytes([frame_type]) + args
+        crc = self._crc16(header)
+        frame = b'**\x18B' + (header + struct.pack('>H', crc)).hex().encode(
+            'ascii') + b'\r\x8a'
+        if frame_type not in (ZACK, ZFIN):
+            frame += b'\x11'
+        return frame
+
+    def _bin_header(self, frame_type, args):
+        header = bytes([frame_type]) + args
+        if self.crc32:
+            return b'*\x18C' + _escape(
+                header + struct.pack('<I', zlib.crc32(header)))
+        return b'*\x18A' + _escape(
+            header + struct.pack('>H', self._crc16(header)))
+
+    def _subpacket(self, data, end):
+        if self.crc32:
+            crc = struct.pack('<I', zlib.crc32(bytes([end]),
+                                               zlib.crc32(data)))
+        else:
+            crc = struct.pack('>H', self._crc16(bytes([end]),
+                                                self._crc16(data)))
+        packet = _escape(data) + bytes([ZDLE, end]) + _escape(crc)
+        if end == ZCRCW:
+            packet += b'\x11'
+        return packet
+
+    # Receiving
+
+    def _fill(self, timeout):
+        # Wait for input, then take all of it.
+        data = yield NeedData(1, timeout)
+        if data is None:
+            return False
+        self._pending = bytes(data) + bytes(self._buffer)
+        self._pos = 0
+        del self._buffer[:]
+        return True
+
+    def _byte(self, timeout):
+        # Returns the next byte, or _TIMEOUT.
+        if self._pos >= len(self._pending):
+            if not (yield from self._fill(timeout)):
+                return _TIMEOUT
+        char = self._pending[self._pos]
+        self._pos += 1
+        return char
+
+    def _zdl_byte(self, timeout):
+        # Returns the next unescaped byte, a frame end ORed with 0x100,
+        # _TIMEOUT, _ERROR or _CANCELLED.
+        while True:
+            char = yield from self._byte(timeout)
+            if char == ZDLE:
+                break
+            elif char not in _XONXOFF:
+                return char
+        cancels = 1
+        while True:
+            char = yield from self._byte(timeout)
+            if char == _TIMEOUT:
+                return char
+            elif char == ZDLE:
+                cancels += 1
+                if cancels == 5:
+                    return _CANCELLED
+            elif char not in _XONXOFF:
+                break
+        if char in _FRAME_ENDS:
+            return char | 0x100
+        elif char == ZRUB0:
+            return 0x7f
+        elif char == ZRUB1:
+            return 0xff
+        elif char & 0x60 == 0x40:
+            return char ^ 0x40
+        self.log.debug('bad escape sequence ZDLE %r', char)
+        return _ERROR
+
+    def _recv_header(self, timeout):
+        # Hunt for the next header, returning its type and arguments, or
+        # _TIMEOUT, _ERROR or _CANCELLED and None.
+        state = cancels = 0
+        while True:
+            char = yield from self._byte(timeout)
+            if char == _TIMEOUT:
+                return _TIMEOUT, None
+            elif char & 0x7f == ZPAD:
+                state, cancels = 1, 0
+            elif char == ZDLE:
+                cancels += 1
+                if cancels == 5:
+                    self.log.info('Transmission canceled: received 5xCAN')
+                    return _CANCELLED, None
+                state = 2 if state == 1 else 0
+            elif state == 2 and char in (ZHEX, ZBIN, ZBIN32):
+                if char == ZHEX:
+                    result = yield from self._recv_hex_header(timeout)
+                else:
+                    self._crc32_in = char == ZBIN32
+                    result = yield from self._recv_bin_header(timeout)
+                if result[0] >= 0:
+                    self.log.debug('recv: header %d %r', result[0],
+                                   bytes(result[1]))
+                return result
+            else:
+                state = cancels = 0
+
+    def _recv_hex_header(self, timeout):
+        digits = bytearray()
+        while len(digits) < 14:
+            char = yield from self._byte(timeout)
+            if char == _TIMEOUT:
+                return _TIMEOUT, None
+            digits.append(char)
+        try:
+            header = bytes.fromhex(digits.decode('ascii'))
+        except ValueError:
+            self.log.warning('recv error: bad hex header %r', bytes(digits))
+            return _ERROR, None
+        if self._crc16(header[:5]) != struct.unpack('>H', header[5:])[0]:
+            self.log.warning('recv error: bad hex header CRC')
+            return _ERROR, None
+        # throw away the CR LF following it
+        char = yield from self._byte(timeout)
+        if char in (0x0d, 0x8d):
+            yield from self._byte(timeout)
+        return header[0], header[1:5]
+
+    def _recv_bin_header(self, timeout):
+        size = 9 if self._crc32_in else 7
+        header = bytearray()
+        while len(header) < size:
+            char = yield from self._zdl_byte(timeout)
+            if char < 0:
+                return char, None
+            elif char > 0xff:
+                self.log.warning('recv error: frame end in header')
+                return _ERROR, None
+            header.append(char)
+        if self._crc32_in:
+            valid = zlib.crc32(header[:5]) == struct.unpack(
+                '<I', header[5:])[0]
+        else:
+            valid = self._crc16(header[:5]) == struct.unpack(
+                '>H', header[5:])[0]
+        if not valid:
+            self.log.warning('recv error: bad binary header CRC')
+            return _ERROR, None
+        return header[0], bytes(header[1:5])
+
+    def _recv_subpacket(self, limit=8192):
+        # Returns the frame end and data of the next data subpacket, or
+        # _TIMEOUT, _ERROR or _CANCELLED and None.
+        data = bytearray()
+        timeout = self.timeout_seconds
+        while True:
+            # copy runs of bytes that need no unescaping in one go
+            match = _SPECIAL.search(self._pending, self._pos)
+            end = match.start() if match else len(self._pending)
+            data += self._pending[self._pos:end]
+            self._pos = end
+            if len(data) > limit:
+                self.log.warning('recv error: data subpacket too long')
+                return _ERROR, None
+            char = yield from self._zdl_byte(timeout)
+            if char < 0:
+                return char, None
+            elif char > 0xff:
+                break
+            data.append(char)
+        end = char & 0xff
+        crc = bytearray()
+        while len(crc) < (4 if self._crc32_in else 2):
+            char = yield from self._zdl_byte(timeout)
+            if char < 0:
+                return char, None
+            elif char > 0xff:
+                return _ERROR, None
+            crc.append(char)
+        if self._crc32_in:
+            valid = zlib.crc32(bytes([end]), zlib.crc32(data)) == \
+                struct.unpack('<I', crc)[0]
+        else:
+            valid = self._crc16(bytes([end]), self._crc16(data)) == \
+                struct.unpack('>H', crc)[0]
+        if not valid:
+            self.log.warning('recv error: bad data subpacket CRC at %d bytes',
+                             len(data))
+            return _ERROR, None
+        return end, bytes(data)
+
+
+class ZMODEMSender(_ZMODEMProtocol):
+    '''
+    ZMODEM batch sender protocol state machine, doing no I/O of its own.
+
+    It emits :data:`NeedFileData` events asking for the data of the file at
+    :attr:`file_index` in ``files``, at the offsets the receiver asks for,
+    and :data:`FileProgress` as the data is sent. The transfer is done with
+    ``True`` once all files were sent or skipped by the receiver, or
+    ``False`` if it failed.
+
+    :param files: The headers of the files to send.
+    :type files: list of xmodem.ymodem.FileHeader
+    :param retry: The maximum number of errors in a row.
+    :type retry: int
+    :param timeout: The timeout in seconds for replies of the receiver.
+    :type timeout: int
+    :param integrity: The integrity backend, or its name, for CRC-16.
+    :type integrity: IntegrityBackend or str
+    :param resume: If ``True``, ask the receiver to resume files it has a
+        part of already.
+    :type resume: bool
+    :param block_size: The size of the data subpackets.
+    :type block_size: int
+    '''
+
+    _informational = _ZMODEMProtocol._informational + (FileProgress,)
+
+    def __init__(self, files, retry=16, timeout=60, integrity=None,
+                 resume=False, block_size=1024):
+        if not 0 < block_size <= 8192:
+            raise ValueError('block_size must be between 1 and 8192, got {0}'
+                             .format(block_size))
+        self.files = list(files)
+        self.resume = resume
+        self.block_size = block_size
+        #: Index of the file being sent.
+        self.file_index = None
+        #: Receive buffer size of the receiver, ``0`` if it takes a stream.
+        self.window = 0
+        #: ``True`` if the receiver takes data while sending headers.
+        self.streaming = False
+        super(ZMODEMSender, self).__init__(retry, timeout, integrity)
+
+    def send_file_data(self, data):
+        '''
+        Handle :data:`NeedFileData` with the ``data`` read.
+        '''
+        self._expect(NeedFileData, 'send_file_data')
+        self._resume(data)
+
+    def _run(self):
+        if not (yield from self._handshake()):
+            return False
+        remaining = sum(header.size or 0 for header in self.files)
+        for index, header in enumerate(self.files):
+            self.file_index = index
+            result = yield from self._send_file(
+                header, len(self.files) - index, remaining)
+            if result is None:
+                return False
+            remaining -= header.size or 0
+        self.file_index = None
+        return (yield from self._finish())
+
+    def _handshake(self):
+        yield SendData(b'rz\r', None)
+        error_count = 0
+        request = True
+        while True:
+            if request:
+                yield SendData(self._hex_header(ZRQINIT, _args(0)), None)
+            request = True
+            frame, args = yield from self._recv_header(self.timeout_seconds)
+            if frame == ZRINIT:
+                self.window = args[0] | args[1] << 8
+                self.streaming = (args[3] & (CANFDX | CANOVIO) ==
+                                  CANFDX | CANOVIO)
+                self.crc32 = bool(args[3] & CANFC32)
+                self.log.debug('send: receiver window %d, streaming %s, '
+                               'CRC-32 %s', self.window, self.streaming,
+                               self.crc32)
+                return True
+            elif frame == ZCHALLENGE:
+                yield SendData(self._hex_header(ZACK, args), None)
+                request = False
+                continue
+            elif frame == _CANCELLED:
+                return False
+            error_count += 1
+            if error_count > self.retry:
+                self.log.error('send error: no ZRINIT from the receiver, '
+                               'aborting.')
+                yield from self._abort(timeout=self.timeout_seconds)
+                return False
+
+    def _send_file(self, header, files, remaining):
+        # Returns True once the file is sent, False if it was skipped, or
+        # None if the transfer failed.
+        info = _encode_header(header)
+        if header.size is not None:
+            if header.mtime is None:
+                info += b' 0'
+            info += ' 0 0 {0} {1}'.format(files, remaining).encode('ascii')
+        frame = self._bin_header(ZFILE, _flags(
+            ZCRESUM if self.resume else ZCBIN)) + self._subpacket(
+                info + b'\x00', ZCRCW)
+        error_count = 0
+        timeout = None
+        while True:
+            if timeout is None:
+                self.log.debug('send: ZFILE %r', header)
+                yield SendData(frame, None)
+            reply, args = yield from self._recv_header(
+                timeout or self.timeout_seconds)
+            if reply == ZRPOS:
+                offset = _position(args)
+                break
+            elif reply == ZSKIP:
+                self.log.info('Receiver skipped %s', header.name)
+                return False
+            elif reply == _CANCELLED:
+                return None
+            elif reply == ZRINIT and timeout is None:
+                # may be an answer to an earlier header, crossing our ZFILE;
+                # send it again only if nothing else follows soon
+                timeout = 1
+                continue
+            timeout = None
+            error_count += 1
+            if error_count > self.retry:
+                self.log.error('send error: ZFILE not accepted, aborting.')
+                yield from self._abort(timeout=self.timeout_seconds)
+                return None
+
+        while True:
+            offset = yield from self._send_data(header, offset)
+            if offset is None:
+                return None
+            self.log.debug('send: ZEOF at %d', offset)
+            yield SendData(self._bin_header(ZEOF, _args(offset)), None)
+            reply, args = yield from self._recv_header(self.timeout_seconds)
+            if reply == ZRINIT:
+                self.log.info('Sent %s', header.name)
+                return True
+            elif reply == ZRPOS:
+                offset = _position(args)
+                error_count += 1
+            elif reply == _CANCELLED:
+                return None
+            else:
+                error_count += 1
+            if error_count > self.retry:
+                self.log.error('send error: ZEOF not acknowledged, '
+                               'aborting.')
+                yield from self._abort(timeout=self.timeout_seconds)
+                return None
+
+    def _send_data(self, header, offset):
+        # Send the file from ``offset`` to its end, going back to where the
+        # receiver asks for. Returns the size of the file, or None if the
+        # transfer failed.
+        error_count = 0
+        acknowledged = offset
+        while True:
+            self.log.debug('send: ZDATA at %d', offset)
+            yield SendData(self._bin_header(ZDATA, _args(offset)), None)
+            reply = None
+            while reply is None:
+                data = yield NeedFileData(offset, self.block_size)
+                if len(data) < self.block_size:
+                    end = ZCRCE
+                elif not self.streaming or (
+                        self.window and offset + 2 * len(data) -
+                        acknowledged > self.window):
+                    end = ZCRCW
+                else:
+                    end = ZCRCG
+                yield SendData(self._subpacket(data, end), None)
+                offset += len(data)
+                yield FileProgress(header.size, offset, error_count)
+                if end == ZCRCE:
+                    return offset
+                elif end == ZCRCW:
+                    reply, args = yield from self._recv_header(
+                        self.timeout_seconds)
+                    if reply == ZACK:
+                        acknowledged = offset
+                        error_count = 0
+                        reply = None
+                    elif reply != ZRPOS:
+                        offset = acknowledged
+                else:
+                    # see if the receiver interrupted the stream
+                    char = yield from self._byte(0)
+                    if char & 0x7f == ZPAD or char == ZDLE:
+                        self._pos -= 1
+                        reply, args = yield from self._recv_header(
+                            self.timeout_seconds)
+                        if reply == ZACK:
+                            reply = None
+                        else:
+                            # end the frame, so the receiver does not
+                            # take the data in flight for a new header
+                            yield SendData(self._subpacket(b'', ZCRCE), None)
+
+            if reply == _CANCELLED:
+                return None
+            elif reply == ZRPOS:
+                self.log.info('send: receiver asked for offset %d, was at '
+                              '%d', _position(args), offset)
+                offset = acknowledged = _position(args)
+            error_count += 1
+            if error_count > self.retry:
+                self.log.error('send error: error_count reached %d, '
+                               'aborting.', self.retry)
+                yield from self._abort(timeout=self.timeout_seconds)
+                return None
+
+    def _finish(self):
+        error_count = 0
+        while True:
+            yield SendData(self._hex_header(ZFIN, _args(0)), None)
+            reply, args = yield from self._recv_header(self.timeout_seconds)
+            if reply == ZFIN:
+                yield SendData(b'OO', None)
+                self.log.info('Batch transmission successful.')
+                return True
+            elif reply == _CANCELLED:
+                return False
+            error_count += 1
+            if error_count > self.retry:
+                # every file was acknowledged already
+                self.log.warning('send: ZFIN not acknowledged.')
+                return True
+
+
+class ZMODEMReceiver(_ZMODEMProtocol):
+    '''
+    ZMODEM batch receiver protocol state machine, doing no I/O of its own.
+
+    When a file starts, it emits a :data:`xmodem.ymodem.FileHeader`, to be
+    handled with :meth:`accept` or :meth:`skip`. The data of the file is
+    emitted in order with :data:`DataReceived`, followed by
+    :data:`xmodem.EndOfTransmission`. The transfer is done with the list of
+    headers of the files received, with the number of bytes received as
+    size, or ``None`` if it failed.
+
+    :param retry: The maximum number of errors in a row.
+    :type retry: int
+    :param timeout: The timeout in seconds for data from the sender.
+    :type timeout: int
+    :param integrity: The integrity backend, or its name, for CRC-16.
+    :type integrity: IntegrityBackend or str
+    :param crc32: If ``True``, ask for CRC-32 rather than CRC-16.
+    :type crc32: bool
+    '''
+
+    _informational = _ZMODEMProtocol._informational + (
+        DataReceived, EndOfTransmission, FileProgress)
+
+    def __init__(self, retry=16, timeout=60, integrity=None, crc32=True):
+        self.flags = CANFDX | CANOVIO | (CANFC32 if crc32 else 0)
+        super(ZMODEMReceiver, self).__init__(retry, timeout, integrity)
+
+    def accept(self, offset=0):
+        '''
+        Handle :data:`xmodem.ymodem.FileHeader` by receiving the file,
+        starting ``offset`` bytes into it to resume a partial file.
+        '''
+        self._expect(FileHeader, 'accept')
+        self._resume(offset)
+
+    def skip(self):
+        '''
+        Handle :data:`xmodem.ymodem.FileHeader` by skipping the file.
+        '''
+        self._expect(FileHeader, 'skip')
+        self._resume(None)
+
+    def _run(self):
+        files = []
+        error_count = 0
+        ready = True
+        while True:
+            if ready:
+                yield SendData(self._hex_header(
+                    ZRINIT, _flags(self.flags)), None)
+            ready = True
+            frame, args = yield from self._recv_header(self.timeout_seconds)
+            if frame == ZRQINIT:
+                continue
+            elif frame == ZFILE:
+                end, info = yield from self._recv_subpacket()
+                if info is None:
+                    if end == _CANCELLED:
+                        return None
+                    yield SendData(self._hex_header(ZNAK, _args(0)), None)
+                    ready = False
+                else:
+                    header = _decode_header(info)
+                    if not header.mtime:
+                        # sent as 0 when unknown
+                        header = header._replace(mtime=None)
+                    offset = yield header
+                    if offset is None:
+                        self.log.info('Skipping %s', header.name)
+                        yield SendData(self._hex_header(ZSKIP, _args(0)),
+                                       None)
+                        ready = False
+                        continue
+                    size = yield from self._recv_file(header, offset)
+                    if size is None:
+                        return None
+                    files.append(header._replace(size=size))
+                    error_count = 0
+                    continue
+            elif frame == ZSINIT:
+                yield from self._recv_subpacket()
+                yield SendData(self._hex_header(ZACK, _args(0)), None)
+                ready = False
+                continue
+            elif frame == ZFIN:
+                yield SendData(self._hex_header(ZFIN, _args(0)), None)
+                # the sender's over and out
+                for _ in range(2):
+                    yield from self._byte(1)
+                self.log.info('Batch complete, %d files', len(files))
+                return files
+            elif frame == _CANCELLED:
+                return None
+            error_count += 1
+            if error_count > self.retry:
+                self.log.error('error_count reached %d, aborting.',
+                               self.retry)
+                yield from self._abort(timeout=self.timeout_seconds)
+                return None
+
+    def _recv_file(self, header, offset):
+        # Returns the number of bytes received, or None if the transfer
+        # failed.
+        error_count = 0
+        while True:
+            if error_count > self.retry:
+                self.log.error('error_count reached %d, aborting.',
+                               self.retry)
+                yield from self._abort(timeout=self.timeout_seconds)
+                return None
+            self.log.debug('recv: ZRPOS %d', offset)
+            yield SendData(self._hex_header(ZRPOS, _args(offset)), None)
+            while True:
+                frame, args = yield from self._recv_header(
+                    self.timeout_seconds)
+                if frame == ZDATA:
+                    if _position(args) != offset:
+                        self.log.warning('recv error: ZDATA at %d, expected '
+                                         '%d', _position(args), offset)
+                        error_count += 1
+                        break
+                    end = yield from self._recv_data(header, offset,
+                                                     error_count)
+                    if end == _CANCELLED:
+                        return None
+                    offset = self._offset
+                    if end < 0:
+                        error_count += 1
+                        break
+                    error_count = 0
+                elif frame == ZEOF:
+                    if _position(args) != offset:
+                        # sent before our ZRPOS got there; wait for the
+                        # data we asked for
+                        continue
+                    yield EndOfTransmission(offset)
+                    return offset
+                elif frame == ZFILE:
+                    # our ZRPOS was lost
+                    yield from self._recv_subpacket()
+                    break
+                elif frame == _CANCELLED:
+                    return None
+                else:
+                    error_count += 1
+                    break
+
+    def _recv_data(self, header, offset, error_count):
+        # Receive the data subpackets of a frame, keeping the offset of the
+        # data received in _offset. Returns the last frame end, or _TIMEOUT,
+        # _ERROR or _CANCELLED.
+        self._offset = offset
+        while True:
+            end, data = yield from self._recv_subpacket()
+            if data is None:
+                return end
+            if data:
+                yield DataReceived(self._offset, data)
+                self._offset += len(data)
+                yield FileProgress(header.size, self._offset, error_count)
+            if end in (ZCRCW, ZCRCQ):
+                yield SendData(self._hex_header(ZACK, _args(self._offset)),
+                               None)
+            if end in (ZCRCW, ZCRCE):
+                return end
+
+
+class ZMODEM(XMODEM):
+    '''
+    ZMODEM batch protocol handler, expecting the same ``getc`` and ``putc``
+    functions as :class:`xmodem.XMODEM`.
+    '''
+
+    def __init__(self, getc, putc, integrity=None, getc_into=None):
+        super(ZMODEM, self).__init__(getc, putc, integrity=integrity,
+                                     getc_into=getc_into)
+
+    def send(self, files, retry=16, timeout=60, callback=None, resume=False,
+             block_size=1024):
+        '''
+        Send a batch of files.
+
+        Returns ``True`` upon successful transmission or ``False`` in case of
+        failure.
+
+        :param files: The files to send, as paths, file objects with a
+            ``name``, or ``(name, stream)`` tuples. Streams are read from
+            their current position, and must be seekable for the sender to
+            go back after an error.
+        :type files: list
+        :param callback: Called with the size of the current file (or
+            ``None`` if unknown), the number of bytes sent and the number of
+            errors in a row.
+        :type callback: callable
+        :param resume: If ``True``, ask the receiver to resume files it has
+            a part of already.
+        :type resume: bool
+        :param block_size: The size of the data subpackets, up to 8192.
+        :type block_size: int
+        '''
+        sources = [_sender_file(item) for item in files]
+        protocol = ZMODEMSender([header for header, _ in sources],
+                                retry=retry, timeout=timeout,
+                                integrity=self.integrity, resume=resume,
+                                block_size=block_size)
+        index = stream = None
+        owned = False
+        try:
+            while True:
+                event = protocol.next_event()
+                if isinstance(event, NeedFileData):
+                    if index != protocol.file_index:
+                        if owned:
+                            stream.close()
+                        index = protocol.file_index
+                        stream = sources[index][1]
+                        owned = not hasattr(stream, 'read')
+                        if owned:
+                            stream = open(stream, 'rb')
+                        start = position = stream.tell()
+                    if start + event.offset != position:
+                        stream.seek(start + event.offset)
+                    data = stream.read(event.size)
+                    position = start + event.offset + len(data)
+                    protocol.send_file_data(data)
+                elif isinstance(event, FileProgress):
+                    if callable(callback):
+                        callback(event.size, event.offset, event.error_count)
+                elif isinstance(event, Done):
+                    return event.result
+                else:
+                    self._handle_event(protocol, event)
+        finally:
+            if owned:
+                stream.close()
+
+    def recv(self, destination, retry=16, timeout=60, callback=None,
+             resume=False, crc32=True):
+        '''
+        Receive a batch of files.
+
+        Returns the list of :data:`xmodem.ymodem.FileHeader` of the files
+        received, with the number of bytes received as ``size``, or ``None``
+        in case of failure.
+
+        :param destination: Directory to write the files to, or a function
+            called with the :data:`xmodem.ymodem.FileHeader` of each file,
+            returning the stream to write it to, or ``None`` to skip it.
+        :type destination: str or callable
+        :param callback: Called as for :meth:`send`, with the number of
+            bytes received.
+        :type callback: callable
+        :param resume: If ``True``, files are resumed from the data already
+            there: the end of existing files in ``destination``, or the
+            current position of the streams it returns.
+        :type resume: bool
+        :param crc32: If ``True``, ask for CRC-32 rather than CRC-16.
+        :type crc32: bool
+        '''
+        protocol = ZMODEMReceiver(retry=retry, timeout=timeout,
+                                  integrity=self.integrity, crc32=crc32)
+        stream = path = header = None
+        try:
+            while True:
+                event = protocol.next_event()
+                if isinstance(event, FileHeader):
+                    header = event
+                    if callable(destination):
+                        stream = destination(event)
+                    else:
+                        path = os.path.join(destination,
+                                            os.path.basename(event.name))
+                        exists = resume and os.path.exists(path)
+                        stream = open(path, 'r+b' if exists else 'wb')
+                        stream.seek(0, os.SEEK_END)
+                    if stream is None:
+                        protocol.skip()
+                        continue
+                    offset = stream.tell() if resume else 0
+                    if header.size is not None and offset > header.size:
+                        # not a part of this file
+                        offset = 0
+                    if path is not None:
+                        stream.seek(offset)
+                        stream.truncate()
+                    protocol.accept(offset)
+                elif isinstance(event, DataReceived):
+                    stream.write(event.data)
+                elif isinstance(event, EndOfTransmission):
+                    if path is not None:
+                        stream.close()
+                        if header.mtime:
+                            os.utime(path, (time.time(), header.mtime))
+                    stream = path = None
+                elif isinstance(event, FileProgress):
+                    if callable(callback):
+                        callback(event.size, event.offset, event.error_count)
+                elif isinstance(event, Done):
+                    return event.result
+                else:
+                    self._handle_event(protocol, event)
+        finally:
+            if path is not None:
+                stream.close()